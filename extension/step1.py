@@ -22,6 +22,7 @@ import math
 import itertools
 
 import parameters
+import settings
 from steps import read_config
 from steps import series
 from steps.giss_data import valid, invalid, MISSING
@@ -36,7 +37,7 @@ def step1_adjust():
     By convention the month is 1 for January."""
 
     adjust = {}
-    for line in open('config/step1_adjust', 'r'):
+    for line in open(settings.SOURCES_DIR + 'step1_adjust', 'r'):
         line = line.split('#')[0].strip()
         if line == '':
             continue
@@ -436,8 +437,8 @@ def pre_step1(records):
     if parameters.combine_records:
         print("Extension: combine and adjust records (old GISTEMP step 1).")
         global comb_log, pieces_log
-        comb_log = open('log/comb.log', 'w')
-        pieces_log = open('log/pieces.log', 'w')
+        comb_log = settings.Log('comb.log')
+        pieces_log = settings.Log('pieces.log')
         combined = comb_records(records)
         adjusted = adjust_discont(combined)
         records = comb_pieces(adjusted)
@@ -0,0 +1,88 @@
+#! /usr/bin/env python
+#
+# parameters/dependencies.py
+
+"""The first step of the GISTEMP algorithm that is affected by each
+parameter.
+
+This is not one of the parameter files (it is not imported by
+parameters/__init__.py).  It is used by tool/sweep.py: the steps before
+the first step affected by a parameter give the same results whatever
+the value of the parameter, so they are only run once for all the
+values.  (tool/daemon.py and tool/append.py use it in the same way, to
+decide which outputs can be used again.)  A parameter that is added to
+one of the parameter files should be added here too.
+
+Use `first_step_of`, which allows for the parameters whose first step
+depends on the other parameters.
+"""
+
+first_step = dict(
+    # parameters/standard.py
+    station_drop_minimum_months=2,
+    rural_designator=2,
+    urban_adjustment_min_years=2,
+    urban_adjustment_proportion_good=2,
+    urban_adjustment_min_rural_stations=2,
+    urban_adjustment_min_leg=2,
+    urban_adjustment_short_leg=2,
+    urban_adjustment_steep_leg=2,
+    urban_adjustment_leg_difference=2,
+    urban_adjustment_reverse_gradient=2,
+    urban_adjustment_full_radius=2,
+    rural_station_min_overlap=2,
+    gridding_min_overlap=3,
+    gridding_radius=3,
+    gridding_reference_period=3,
+    sea_surface_cutoff_temp=4,
+    subbox_min_valid=5,
+    subbox_land_range=5,
+    subbox_reference_period=5,
+    box_min_overlap=5,
+    box_reference_period=5,
+    zone_annual_min_months=5,
+
+    # parameters/extensions.py
+    data_sources=0,
+    ocean_source=4,
+    element=0,
+    augment_metadata=0,
+    work_file_format=0,
+    analysis_region=2,
+    step5_analyses=5,
+    step5_processes=5,
+    output_queue_size=0,
+    step0_run_size=0,
+    step0_processes=0,
+    step2_checkpoint_stations=2,
+
+    # parameters/obsolete.py
+    combine_records=1,
+    station_combine_min_overlap=1,
+    station_combine_bucket_radius=1,
+    station_combine_min_mid_years=1,
+)
+"""Dict mapping the name of each parameter to the number of the
+first step (0 to 5) that uses it."""
+
+
+regional_first_step = dict(
+    # Step 2 selects the stations near the region by it.
+    gridding_radius=2,
+)
+"""Dict mapping the name of each parameter that is used by an earlier
+step in a regional analysis (see parameters.analysis_region) to the
+number of that step."""
+
+
+def first_step_of(name, regional=None):
+    """The number of the first step that uses the parameter *name*.
+    *regional* says whether the analysis is regional; by default, it is
+    decided by the current value of parameters.analysis_region."""
+
+    if regional is None:
+        import parameters
+        regional = bool(parameters.analysis_region.strip())
+    if regional and name in regional_first_step:
+        return regional_first_step[name]
+    return first_step.get(name, 0)
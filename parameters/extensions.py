@@ -58,3 +58,63 @@ work_file_format = "v4"
 The format of the intermediate files written to the 'work' directory:
 'v3' for GHCN v3.
 """
+
+step5_analyses = "land mixed"
+"""
+Which analyses are made by Step 5 (space separated string): 'land'
+(meteorological stations only), 'mixed' (the usual land--ocean
+analysis), 'ocean' (sea surface temperatures only).
+"""
+
+analysis_region = ""
+"""
+Restrict the analysis to a region (space separated string; empty for
+the whole globe).  Each item is a bounding box 'S,N,W,E' (latitudes
+and longitudes in degrees; W greater than E for a box that crosses the
+date line), or the number (1 to 80) of one of the boxes of
+`eqarea.grid`.  Only the subboxes that overlap the region are made (by
+Step 3) and written, and only the boxes that contain them (by Step 5),
+each from its subboxes in the region.  The zonal means are not made.
+Step 2 only adjusts and outputs the stations within gridding_radius of
+those subboxes (using the rural stations near them).  See
+steps/region.py.
+"""
+
+step5_processes = 1
+"""
+The number of worker processes used to run the Step 5 analyses (see
+*step5_analyses*).  With 1 the analyses are run one after another;
+otherwise each analysis runs in its own process, and writes its own
+result files.
+"""
+
+output_queue_size = 1000
+"""
+The number of records that may be waiting to be written to each output
+file (see `gio.BackgroundWriter`).  The output files are written by
+background threads, and a step that gets this far ahead of its output
+waits for the writer to catch up.  With 0 the records are written
+immediately, without any background threads.
+"""
+
+step0_run_size = 10000
+"""
+The number of records that Step 0 sorts in memory at a time.  Records
+from a data source that is not already in station ID order are sorted
+in runs of this size, and each run is written to a temporary file in
+the 'work' directory; the runs (and the data sources) are then merged.
+"""
+
+step0_processes = 1
+"""
+The number of worker processes used by Step 0 to load the data sources
+(see *data_sources*).  With 1 the sources are read one after another;
+otherwise each source is loaded by a worker process, which returns its
+records as a compact `giss_data.StationBatch`.
+"""
+
+step2_checkpoint_stations = 500
+"""
+The number of urban stations that Step 2 adjusts between checkpoints
+(see tool/checkpoint.py, and the --resume option of tool/run.py).
+"""
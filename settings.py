@@ -19,3 +19,132 @@ LOG_DIR = TMP_DIR + 'log/'
 RESULT_DIR = TMP_DIR + 'result/'
 
 WORK_DIR = TMP_DIR + 'work/'
+
+# A local mirror of the input files shared by several runs (see
+# tool/fetch.py); None for no mirror.
+MIRROR_DIR = os.environ.get('GISTEMP_MIRROR')
+
+
+class Workspace(object):
+    """The directories written by one run of the GISTEMP procedure:
+    every run has its own work, result, log, and progress directories,
+    under *tmp_dir*.  The input files are read from *input_dir* (by
+    default the input directory under *tmp_dir*).
+
+    The log files are opened (in the log directory) when they are
+    first written, see `Log`; when *logs* is False, the logs are
+    discarded instead.
+    """
+
+    def __init__(self, tmp_dir=TMP_DIR, input_dir=None, logs=True):
+        self.tmp_dir = os.path.join(os.path.abspath(tmp_dir), '')
+        self.progress_dir = self.tmp_dir + 'progress/'
+        if input_dir is None:
+            self.input_dir = self.tmp_dir + 'input/'
+        else:
+            self.input_dir = os.path.join(os.path.abspath(input_dir), '')
+        self.log_dir = self.tmp_dir + 'log/'
+        self.result_dir = self.tmp_dir + 'result/'
+        self.work_dir = self.tmp_dir + 'work/'
+        self.keep_logs = logs
+        self.logs = {}
+
+    def makedirs(self):
+        """Create all the directories of the workspace, unless they
+        exist already."""
+        for d in [self.progress_dir, self.input_dir, self.log_dir,
+                  self.result_dir, self.work_dir]:
+            os.makedirs(d, exist_ok=True)
+
+    def log_file(self, name):
+        """Return the log file *name*, opening it when it is first
+        used."""
+        if name not in self.logs:
+            if self.keep_logs:
+                self.logs[name] = open(os.path.join(self.log_dir, name), 'w')
+            else:
+                self.logs[name] = open(os.devnull, 'w')
+        return self.logs[name]
+
+    def flush(self):
+        """Flush the log files (before forking a process that might
+        write to them, say)."""
+        for log in self.logs.values():
+            log.flush()
+
+    def sync_logs(self):
+        """Write the log files to disk, and return a dict mapping the
+        name of each to its size (see `restore_logs`)."""
+        sizes = {}
+        for name, log in self.logs.items():
+            log.flush()
+            if self.keep_logs:
+                os.fsync(log.fileno())
+            sizes[name] = log.tell()
+        return sizes
+
+    def restore_logs(self, sizes):
+        """Go back to the *sizes* of the log files returned by
+        `sync_logs` (when resuming a run from a checkpoint), and write
+        from there on.  The other log files are started afresh when
+        they are first written, as is a log file that has been removed
+        since.  (A log file is cut to size when it is closed, so that
+        it can be restored to a later checkpoint.)
+        """
+        if not self.keep_logs:
+            return
+        for name, size in sizes.items():
+            if name in self.logs:
+                self.logs[name].flush()
+            else:
+                path = os.path.join(self.log_dir, name)
+                try:
+                    self.logs[name] = open(path, 'r+')
+                except FileNotFoundError:
+                    self.logs[name] = open(path, 'w')
+            log = self.logs[name]
+            log.seek(min(size, os.fstat(log.fileno()).st_size))
+
+    def close(self):
+        """Close the log files."""
+        for log in self.logs.values():
+            if self.keep_logs:
+                log.truncate()
+            log.close()
+        self.logs.clear()
+
+
+class Log(object):
+    """The log file *name* of the current workspace, see `Workspace`.
+    Each write goes to the log file of the workspace in use at the
+    time."""
+
+    def __init__(self, name):
+        self.name = name
+
+    def write(self, text):
+        return workspace.log_file(self.name).write(text)
+
+    def flush(self):
+        workspace.log_file(self.name).flush()
+
+
+# The workspace of the run in progress.  A run in another workspace
+# (say, a parameter variant) is made in its own process, after calling
+# `use_workspace`.  Use settings.workspace (it is not imported by
+# "from settings import *", which would bind the workspace in use at
+# the time).
+workspace = Workspace()
+
+
+def use_workspace(ws):
+    """Make *ws* (a `Workspace`) the workspace of the run in progress,
+    and return the previous one."""
+    global workspace
+    old, workspace = workspace, ws
+    return old
+
+
+__all__ = ['BASE_DIR', 'BASE_PATH', 'TMP_DIR', 'PROGRESS_DIR',
+           'SOURCES_DIR', 'INPUT_DIR', 'LOG_DIR', 'RESULT_DIR', 'WORK_DIR',
+           'MIRROR_DIR', 'Workspace', 'Log', 'use_workspace']
@@ -23,8 +23,11 @@ the `StationMetaData` and `SubboxMetaData` classes.
 
 """
 
+import copy
 import sys
 
+import numpy as np
+
 #: The base year for time series data. Data before this time is not
 #: used in calculations.
 BASE_YEAR = 1880
@@ -56,6 +59,232 @@ class Station(object):
         return "Station(%r)" % self.__dict__
 
 
+#: The value held in an integer column of a `StationTable` for a field
+#: that is blank in the metadata file (read as None).
+BLANK = np.iinfo(np.int64).min
+
+
+class StationTable(object):
+    """The metadata for a collection of stations, held column by column.
+
+    *rows* is a NumPy structured array with one row per station and one
+    field per metadata attribute (see io.station_metadata()); it must
+    have a 'uid' field.  Integer fields hold `BLANK` where the value is
+    blank.
+
+    A `StationTable` is used like a dictionary of `Station` instances,
+    keyed by uid: ``table[uid]`` returns a `StationView`, a small object
+    that reads its attributes from the row.  Extra attributes for a
+    station can be added with `augment`.
+    """
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.index = dict((uid, i) for i, uid in enumerate(rows['uid'].tolist()))
+        # Augmented attributes, as a dict for each row that has any.
+        self.extra = {}
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, uid):
+        return uid in self.index
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __getitem__(self, uid):
+        return StationView(self, self.index[uid])
+
+    def get(self, uid, default=None):
+        if uid in self.index:
+            return self[uid]
+        return default
+
+    def keys(self):
+        return self.index.keys()
+
+    def values(self):
+        return (StationView(self, i) for i in self.index.values())
+
+    def items(self):
+        return ((uid, StationView(self, i)) for uid, i in self.index.items())
+
+    def augment(self, uid, values):
+        """Add (or replace) the attributes in the dict *values* for the
+        station *uid*."""
+        self.extra.setdefault(self.index[uid], {}).update(values)
+
+    def value(self, row, name):
+        """The attribute *name* of the station in row *row*.  Raises
+        KeyError if there is no such attribute."""
+        extra = self.extra.get(row)
+        if extra and name in extra:
+            return extra[name]
+        if name not in self.rows.dtype.names:
+            raise KeyError(name)
+        v = self.rows[name][row].item()
+        if v == BLANK and self.rows.dtype[name].kind == 'i':
+            return None
+        return v
+
+    def asdict(self, row):
+        d = dict((name, self.value(row, name)) for name in self.rows.dtype.names)
+        d.update(self.extra.get(row, {}))
+        return d
+
+
+class StationView(object):
+    """A station's metadata, read from a row of a `StationTable`.  It
+    has the same attributes as the corresponding `Station` would."""
+
+    __slots__ = ('_table', '_row')
+
+    def __init__(self, table, row):
+        self._table = table
+        self._row = row
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        try:
+            return self._table.value(self._row, name)
+        except KeyError:
+            raise AttributeError(name)
+
+    def __getstate__(self):
+        return self._table, self._row
+
+    def __setstate__(self, state):
+        self._table, self._row = state
+
+    @property
+    def __dict__(self):
+        return self._table.asdict(self._row)
+
+    def __repr__(self):
+        return "Station(%r)" % self.__dict__
+
+
+class StationBatch(object):
+    """A batch of station records, held column by column in NumPy
+    arrays.  It is an alternative to a stream of `Series` instances
+    that is much quicker to work on as a whole (and to pickle).
+
+    For the record at index i:
+
+    :Ivar uid:
+        uid[i] is its uid.
+    :Ivar stations:
+        stations[i] is its station (None for a record without one).
+    :Ivar first_month, length:
+        The record covers *length[i]* months starting with
+        *first_month[i]* (see `Series.first_month`).
+    :Ivar values:
+        A (records, months) array: values[i, j] is the value for month
+        *base_month* + j, and is MISSING for months outside the record.
+    :Ivar missing:
+        A (records, months) array that is True where *values* is
+        MISSING.
+    :Ivar first_valid, last_valid:
+        The first and last months with valid data (as returned by
+        `Series.first_valid_month` and `Series.last_valid_month`).
+
+    Only these attributes of a record are kept in a batch.  Iterating
+    over a batch yields its records as `Series` instances, so a batch
+    can be used wherever a stream of records is expected.
+
+    The arrays of a batch should not be changed once it has been made;
+    the functions that work on batches make new ones.
+    """
+
+    def __init__(self, uid, stations, first_month, length, base_month, values):
+        self.uid = uid
+        self.stations = stations
+        self.first_month = first_month
+        self.length = length
+        self.base_month = base_month
+        self.values = values
+        self.missing = values == MISSING
+        valid = ~self.missing
+        any_valid = valid.any(axis=1)
+        months = values.shape[1]
+        if months:
+            first = valid.argmax(axis=1) + base_month
+            last = months - 1 - valid[:, ::-1].argmax(axis=1) + base_month
+        else:
+            first = last = np.zeros(len(values), dtype=np.int64)
+        # Like Series.first_valid_month and Series.last_valid_month, a
+        # large and a small number for records with no valid data.
+        self.first_valid = np.where(any_valid, first, 9999 * 12)
+        self.last_valid = np.where(any_valid, last, 1)
+
+    @classmethod
+    def from_series(cls, records):
+        """Make a batch from the iterable of `Series` *records*."""
+
+        records = list(records)
+        first_month = np.array([record.first_month for record in records],
+                               dtype=np.int64)
+        length = np.array([len(record.series) for record in records],
+                          dtype=np.int64)
+        base_month, months = extent(first_month, length)
+        values = np.full((len(records), months), MISSING)
+        for i, record in enumerate(records):
+            start = first_month[i] - base_month
+            values[i, start:start + length[i]] = record.series
+        return cls(np.array([record.uid for record in records], dtype=str),
+                   [getattr(record, 'station', None) for record in records],
+                   first_month, length, base_month, values)
+
+    def __len__(self):
+        return len(self.uid)
+
+    def __iter__(self):
+        return self.to_series()
+
+    def take(self, index):
+        """Return a batch of the records selected by *index* (an array
+        of indexes, or a boolean array)."""
+
+        index = np.arange(len(self))[index]
+        return StationBatch(self.uid[index], [self.stations[i] for i in index],
+                            self.first_month[index], self.length[index],
+                            self.base_month, self.values[index])
+
+    def sorted(self):
+        """Return a batch of the same records, sorted by uid.  Records
+        with the same uid stay in their original order."""
+
+        return self.take(np.argsort(self.uid, kind='stable'))
+
+    def to_series(self):
+        """Yield each record in the batch as a `Series` instance."""
+
+        uids = self.uid.tolist()
+        first_months = self.first_month.tolist()
+        lengths = self.length.tolist()
+        for i, uid in enumerate(uids):
+            key = dict(uid=uid)
+            if self.stations[i] is not None:
+                key['station'] = self.stations[i]
+            record = Series(**key)
+            start = first_months[i] - self.base_month
+            record.set_series(first_months[i],
+                              self.values[i, start:start + lengths[i]].tolist())
+            yield record
+
+
+def extent(first_month, length):
+    """The (*base_month*, *months*) extent of a `StationBatch` for
+    records with the given arrays of *first_month* and *length*."""
+
+    if not len(first_month):
+        return BASE_YEAR * 12 + 1, 0
+    base_month = int(first_month.min())
+    return base_month, int((first_month + length).max()) - base_month
+
+
 def get_last_year():
     """Get the latest year of the data.
 
@@ -322,6 +551,16 @@ class Series(object):
                     for i, v in enumerate(self._series)
                     if v != MISSING)
 
+    def copy(self):
+        """Return a copy of the series.  The copy has its own list of
+        values (and annual anomalies), so it is not affected by later
+        changes to this series."""
+
+        result = copy.copy(self)
+        result._series = list(self._series)
+        result.ann_anoms = list(self.ann_anoms)
+        return result
+
     def first_valid_year(self):
         """The first calendar year with any valid data."""
         return (self.first_valid_month() - 1) // 12
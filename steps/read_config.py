@@ -5,7 +5,12 @@
 # Nick Barnes, Ravenbrook Limited, 2010-01-16
 # Avi Persin, Revision 2016-01-06
 
+import os
+
+import numpy as np
+
 from settings import *
+import settings
 
 """
 Python code to read the various config and station files used by
@@ -27,7 +32,7 @@ def get_changes_dict():
     dict = {}
     # for line in open(INPUT_DIR + 'Ts.strange.v4SCAR.list.IN_full', 'r'):
 
-    for line in open(INPUT_DIR + 'Ts.strange.v4.list.IN_full', 'r'):
+    for line in open(settings.workspace.input_dir + 'Ts.strange.v4.list.IN_full', 'r'):
         split_line = line.split()
         id = split_line[0]
         try:
@@ -39,3 +44,42 @@ def get_changes_dict():
         dict[id] = dict.get(id, [])
         dict[id].append(val)
     return dict
+
+
+_changes_index = {}
+
+
+def get_changes_index():
+    """Return the changes in input/Ts.strange.v4.list.IN_full (see
+    get_changes_dict()) compiled into a dict that maps each ID to a
+    pair of integer arrays (*first*, *last*).  Each change is the
+    interval of months from first[i] to last[i] inclusive, where
+    months are numbered year*12 + month - 1: 'years' changes span
+    whole years, 'month' changes a single month.
+
+    The compiled index is cached, and only made again when the file
+    changes.
+    """
+
+    path = settings.workspace.input_dir + 'Ts.strange.v4.list.IN_full'
+    stat = os.stat(path)
+    key = (stat.st_mtime, stat.st_size)
+    cached = _changes_index.get(path)
+    if cached and cached[0] == key:
+        return cached[1]
+
+    index = {}
+    for id, changes in get_changes_dict().items():
+        first = []
+        last = []
+        for kind, a, b in changes:
+            if kind == 'years':
+                first.append(a * 12)
+                last.append(b * 12 + 11)
+            else:
+                first.append(a * 12 + b - 1)
+                last.append(a * 12 + b - 1)
+        index[id] = (np.array(first, dtype=np.int64),
+                     np.array(last, dtype=np.int64))
+    _changes_index[path] = (key, index)
+    return index
@@ -0,0 +1,157 @@
+#! /usr/bin/env python
+#
+# region.py
+
+"""The region of a regional analysis (see parameters.analysis_region):
+which of the 8000 subboxes are made, and which station records are
+needed to make them.
+
+The subboxes are numbered from 0 to 7999, in the order of
+`eqarea.grid8k` (which is the order of the Step 3 and Step 4 output).
+"""
+
+import math
+
+import numpy as np
+
+import parameters
+from steps import earth, eqarea
+
+# The subboxes selected by the current value of
+# parameters.analysis_region, as a (value, subboxes) pair.
+_selection = None
+
+# A little more than the radius is searched, so that no station
+# within the radius is missed because of rounding.  (A station that is
+# kept but not needed makes no difference.)
+SLACK = 1e-9
+
+
+def regional():
+    """True when the analysis is of a region, not the whole globe."""
+    return bool(parameters.analysis_region.strip())
+
+
+def parse(text):
+    """Parse *text* (as for parameters.analysis_region).  Returns a
+    pair: a list of the (s, n, w, e) bounding boxes, and a set of the
+    box numbers (from 1 to 80)."""
+
+    bounds = []
+    numbers = set()
+    for item in text.split():
+        parts = item.split(',')
+        try:
+            if len(parts) == 1:
+                number = int(item)
+                if not 1 <= number <= 80:
+                    raise ValueError(item)
+                numbers.add(number)
+            elif len(parts) == 4:
+                s, n, w, e = [float(part) for part in parts]
+                if not -90 <= s < n <= 90:
+                    raise ValueError(item)
+                bounds.append((s, n, w, e))
+            else:
+                raise ValueError(item)
+        except ValueError:
+            raise ValueError("Can't understand %r in parameters.analysis_region"
+                             % item)
+    return bounds, numbers
+
+
+def overlaps(subbox, bounds):
+    """True when *subbox* overlaps the bounding box *bounds* (with
+    some area, not only an edge)."""
+
+    s, n, w, e = subbox
+    south, north, west, east = bounds
+    if not (s < north and south < n):
+        return False
+    if west <= east:
+        return w < east and west < e
+    # The bounding box crosses the date line.
+    return w < east or west < e
+
+
+def subboxes():
+    """Return the set of the numbers of the subboxes in the region,
+    or None when the analysis is not regional."""
+
+    global _selection
+
+    text = parameters.analysis_region
+    if not regional():
+        return None
+    if _selection and _selection[0] == text:
+        return _selection[1]
+    bounds, numbers = parse(text)
+    selected = set()
+    i = 0
+    for number, (box, subgen) in enumerate(eqarea.gridsub(), 1):
+        for subbox in subgen:
+            if number in numbers or any(overlaps(subbox, b) for b in bounds):
+                selected.add(i)
+            i += 1
+    _selection = (text, selected)
+    return selected
+
+
+def subbox_centre(subbox):
+    """The centre of *subbox* used to find its stations (see
+    `step3.iter_subbox_grid`): all the subboxes that touch a pole
+    share the pole as their centre."""
+
+    centre = eqarea.centre(subbox)
+    if round(centre[0]) >= 84:
+        centre = (90, 0)
+    if round(centre[0]) <= -84:
+        centre = (-90, 0)
+    return centre
+
+
+def select(cells):
+    """Take an iterable of subboxes, in the usual order, and with
+    metadata first (as made by Step 3 or read from an SBBX file), and
+    return an iterator of the metadata and the subboxes in the region.
+    When the analysis is not regional, *cells* is returned unchanged.
+    """
+
+    selected = subboxes()
+    if selected is None:
+        return cells
+
+    def selection():
+        cell_iter = iter(cells)
+        yield next(cell_iter)
+        for i, cell in enumerate(cell_iter):
+            if i in selected:
+                yield cell
+    return selection()
+
+
+def near(records, radius):
+    """Take an iterable of station records and return a list of those
+    (in the same order) whose stations are within *radius* kilometres
+    of the centre of a subbox in the region.  When the analysis is not
+    regional, *records* is returned unchanged."""
+
+    selected = subboxes()
+    if selected is None:
+        return records
+
+    records = list(records)
+    lat = np.radians([record.station.lat for record in records])
+    lon = np.radians([record.station.lon for record in records])
+    sinlat, coslat = np.sin(lat), np.cos(lat)
+    sinlon, coslon = np.sin(lon), np.cos(lon)
+    cosarc = math.cos(radius / earth.radius) - SLACK
+    keep = np.zeros(len(records), dtype=bool)
+    centres = set(subbox_centre(subbox)
+                  for i, subbox in enumerate(eqarea.grid8k()) if i in selected)
+    for clat, clon in centres:
+        clat, clon = math.radians(clat), math.radians(clon)
+        cosd = (sinlat * math.sin(clat) + coslat * math.cos(clat) *
+                (coslon * math.cos(clon) + sinlon * math.sin(clon)))
+        keep |= cosd > cosarc
+    return [record for record, k in zip(records, keep.tolist()) if k]
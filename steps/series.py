@@ -5,6 +5,8 @@
 # Nick Barnes, Ravenbrook Limited, 2010-03-08
 # Avi Persin, Revision 2016-01-06
 
+import numpy as np
+
 from steps.giss_data import valid, invalid, MISSING
 
 """
@@ -64,6 +66,57 @@ def combine(composite, weight, new, new_weight, min_overlap):
     return data_combined
 
 
+def combine_array(composite, weight, new, new_weight, min_overlap):
+    """As `combine`, but operating on NumPy arrays; all 12 months of
+    the year are processed at once.  *composite*, *weight* and *new*
+    should be 1-dimensional float arrays of the same length, which
+    must be a whole number of years.  *new_weight* is either a
+    constant or an array like *weight*.  *composite* and *weight* are
+    updated in place.
+
+    The list of 12 counts (of combined data, per month) is returned,
+    just as for `combine`, and the arithmetic is arranged so that the
+    results are identical to those of `combine`.
+    """
+
+    composite = composite.reshape(-1, 12)
+    weight = weight.reshape(-1, 12)
+    new = new.reshape(-1, 12)
+    new_weight = np.broadcast_to(new_weight, new.shape[0] * 12)
+    new_weight = new_weight.reshape(-1, 12)
+
+    new_valid = new != MISSING
+    both = new_valid & (composite != MISSING)
+    count = both.sum(axis=0)
+    # Months with enough overlap get combined.
+    use = count >= min_overlap
+    sum = ordered_sum(np.where(both, composite, 0.0))
+    sum_new = ordered_sum(np.where(both, new, 0.0))
+    bias = (sum - sum_new) / np.maximum(count, 1)
+
+    update = new_valid & use
+    bias = np.broadcast_to(bias, new.shape)[update]
+    old_weight = weight[update]
+    add_weight = new_weight[update]
+    new_month_weight = old_weight + add_weight
+    composite[update] = (old_weight * composite[update]
+                         + add_weight * (new[update] + bias)) / new_month_weight
+    weight[update] = new_month_weight
+    return [int(x) for x in np.where(use, new_valid.sum(axis=0), 0)]
+
+
+def ordered_sum(a):
+    """Sum the array *a* along its first axis, adding the elements in
+    order just as a Python loop starting from 0.0 does (`numpy.sum`
+    adds pairwise, which can differ in the last bit).
+    """
+
+    if len(a) == 0:
+        return np.zeros(a.shape[1:])
+    # Adding 0.0 turns a -0.0 total into 0.0, as the Python loop would.
+    return np.cumsum(a, axis=0)[-1] + 0.0
+
+
 def ensure_array(exemplar, item):
     """Coerces *item* to be an array (linear sequence); if *item* is
     already an array it is returned unchanged.  Otherwise, an array of
@@ -97,6 +150,39 @@ def anomalize(data, reference_period=None, base_year=-9999):
         data[m::12] = anoms[m]
 
 
+def anomalize_array(data, reference_period=None, base_year=-9999):
+    """As `anomalize`, but *data* is a 1-dimensional NumPy array whose
+    length is a whole number of years.  *data* is mutated, and the
+    results are identical to those of `anomalize`.
+    """
+
+    rows = data.reshape(-1, 12)
+    if reference_period:
+        base = reference_period[0] - base_year
+        limit = reference_period[1] - base_year + 1
+    else:
+        base = 0
+        limit = 0
+    good = rows != MISSING
+    mean = valid_mean_array(rows[base:limit], good[base:limit])
+    # Fall back to using entire period.
+    mean = np.where(mean == MISSING, valid_mean_array(rows, good), mean)
+    good &= mean != MISSING
+    rows[:] = np.where(good, rows - mean, MISSING)
+
+
+def valid_mean_array(rows, good, min=1):
+    """As `valid_mean`, but for each column of the 2-dimensional array
+    *rows*; *good* is the matching array of validity flags.  An array
+    of means (MISSING where there are fewer than *min* valid items) is
+    returned.
+    """
+
+    count = good.sum(axis=0)
+    sum = ordered_sum(np.where(good, rows, 0.0))
+    return np.where(count >= min, sum / np.maximum(count, 1), MISSING)
+
+
 def valid_mean(seq, min=1):
     """Takes a sequence, *seq*, and computes the mean of the valid
     items (using the valid() function).  If there are fewer than *min*
@@ -8,32 +8,108 @@
 #
 # BSD license, see license.txt
 from settings import *
+import settings
 
 """
 Python code for the STEP0 part of the GISTEMP algorithm: combining
 diverse inputs into a single dataset.
 """
 
+import heapq
+import itertools
+import operator
+import pickle
+import tempfile
 
-def earthly(records):
+import parameters
+from steps import giss_data
+from tool import gio
+
+
+def on_earth(record):
+    """True if the station for *record* has a valid latitude and
+    longitude; otherwise reports the station, and returns False."""
+
+    station = record.station
+    if (-90.0 <= station.lat <= 90.0) and (-180.0 <= station.lon <= 180.0):
+        return True
+    print("%s has invalid latitude/longitude" % station.uid)
+    return False
+
+
+class SpilledRun(object):
+    """A sequence of records, written to a temporary file in the work
+    directory, that can be read back (once) by iterating over it.
+
+    The records are pickled, except for their stations (which are
+    generally shared with other records, and refer to the whole
+    table of station metadata).  Those are kept in memory and
+    reattached when the records are read.
     """
-    `records` is a dict of records. records for stations that
-    have no lat/lon metadata ("not on Earth") are removed. The
-    input dict is not modified, a fresh sequence of (id, record)
-    pairs dict is returned.
+
+    def __init__(self, records):
+        self.file = tempfile.TemporaryFile(dir=settings.workspace.work_dir)
+        self.stations = []
+        pickler = pickle.Pickler(self.file, pickle.HIGHEST_PROTOCOL)
+        pickler.persistent_id = self.persistent_id
+        for record in records:
+            pickler.dump(record)
+            pickler.clear_memo()
+
+    def persistent_id(self, obj):
+        if isinstance(obj, (giss_data.Station, giss_data.StationView)):
+            self.stations.append(obj)
+            return len(self.stations) - 1
+        return None
+
+    def __iter__(self):
+        self.file.seek(0)
+        unpickler = pickle.Unpickler(self.file)
+        unpickler.persistent_load = self.stations.__getitem__
+        try:
+            while True:
+                yield unpickler.load()
+        except EOFError:
+            pass
+        finally:
+            self.file.close()
+
+
+def uid(record):
+    return record.uid
+
+
+def keyed(records, i):
+    """Yield a (uid, *i*, record) triple for each record in *records*."""
+    for record in records:
+        yield record.uid, i, record
+
+
+def sorted_by_uid(records, run_size):
+    """Yield the records of *records* sorted by uid.  Records with the
+    same uid stay in their original order.  At most *run_size* records
+    are held in memory: each run of that many is sorted and spilled to
+    disk (see `SpilledRun`), and the runs are merged.
     """
-    for id, record in records.items():
-        station = record.station
-        if (-90.0 <= station.lat <= 90.0) and (-180.0 <= station.lon <= 180.0):
-            yield id, record
-        else:
-            print("%s has invalid latitude/longitude" % station.uid)
+
+    runs = []
+    run = []
+    for record in records:
+        run.append(record)
+        if len(run) >= run_size:
+            run.sort(key=uid)
+            runs.append(SpilledRun(run))
+            run = []
+    run.sort(key=uid)
+    # heapq.merge takes equal records from earlier runs first.
+    return heapq.merge(*(runs + [run]), key=uid)
 
 
 def append_scar():
-    scar_data = open(INPUT_DIR + "antarc1.list").readlines() + open(INPUT_DIR + "antarc2.list").readlines() + open(
-        INPUT_DIR + "antarc3.list").readlines()
-    with open(INPUT_DIR + "v4.inv", "a") as file:
+    input_dir = settings.workspace.input_dir
+    scar_data = open(input_dir + "antarc1.list").readlines() + open(input_dir + "antarc2.list").readlines() + open(
+        input_dir + "antarc3.list").readlines()
+    with open(input_dir + "v4.inv", "a") as file:
         for station in scar_data:
             id = station[:11].strip()
             name = station[12:41]
@@ -43,41 +119,93 @@ def append_scar():
     file.close()
 
 
+def load_batch(input, source):
+    """Load all the records from *source* as a `giss_data.StationBatch`,
+    sorted by uid.  Run in a worker process by load_batches()."""
+
+    batch = giss_data.StationBatch.from_series(input.open(source))
+    if not input.is_sorted(source):
+        batch = batch.sorted()
+    return batch
+
+
+def load_batches(input, processes):
+    """Load each of the sources of *input* in a pool of *processes*
+    worker processes.  Returns a list of `giss_data.StationBatch`
+    instances, one for each source, in order."""
+
+    import multiprocessing
+
+    # Fork the workers only when no output is being written in the
+    # background.
+    gio.wait_for_output()
+    processes = min(processes, len(input.sources))
+    with multiprocessing.Pool(processes) as pool:
+        results = []
+        for source in input.sources:
+            print("Load %s records" % source.upper())
+            results.append(pool.apply_async(load_batch, (input, source)))
+        return [result.get() for result in results]
+
+
+def prepare_inventory():
+    """Add the brightness index to the station inventory (v4.inv) in
+    the input directory, unless it has been added already.  The input
+    directory is locked meanwhile, as it may be shared by runs in other
+    workspaces."""
+    from tool import generate_brightness
+
+    with generate_brightness.locked(settings.workspace.input_dir):
+        with open(settings.workspace.input_dir + "v4.inv", 'r') as f:
+            if len(f.readline().split()) > 5:
+                return
+        # append scar data to inv file
+        # append_scar()
+
+        # generate BI for inv file
+        generate_brightness.run()
+
+
 def step0(input):
     """
     An iterator for Step 0.  Produces a stream of `giss_data.Series`
     instances.  *input* should be an instance that has an open()
-    method.  input.open(x) is called for each data source x.
+    method.  input.open(x) is called for each data source x, and
+    input.is_sorted(x) says whether its records are in uid order.
     (typically, this input object is made by the tool.io.step0_input()
     function).
     """
-    if len(open(INPUT_DIR + "v4.inv", 'r').readlines()[0].split()) > 5:
-        pass
+    prepare_inventory()
+
+    # Read each data input in uid order, sorting the sources that
+    # are not already sorted.
+    streams = []
+    if parameters.step0_processes > 1 and len(input.sources) > 1:
+        for i, batch in enumerate(load_batches(input, parameters.step0_processes)):
+            streams.append(keyed(batch.to_series(), i))
     else:
-        # append scar data to inv file
-        # append_scar()
+        for i, source in enumerate(input.sources):
+            print("Load %s records" % source.upper())
 
-        # generate BI for inv file
-        from tool import generate_brightness
-        generate_brightness.run()
+            records = input.open(source)
+            if not input.is_sorted(source):
+                records = sorted_by_uid(records, parameters.step0_run_size)
+            streams.append(keyed(records, i))
 
-    # Read each data input into dictionary form.
-    data = {}
-    for source in input.sources:
-        print("Load %s records" % source.upper())
-
-        records = input.open(source)
-        data[source] = dict((record.uid, record) for record in records)
-
-    # Join all data sources together; and remove stations with
-    # no lat/lon metadata.
-    records = {}
-    for source in input.sources:
-        records.update(earthly(data[source]))
-
-    # We sort here - as does GISTEMP - so that all the records for a
-    # given 11-digit station ID are grouped together, ready for
-    # combining in the next step.
-    for _, record in sorted(records.items()):
-        if record:
-            yield record
+    # Join all data sources together, in uid order (as GISTEMP does),
+    # so that all the records for a given 11-digit station ID are
+    # grouped together, ready for combining in the next step.  For
+    # each uid, the last record from a source wins, and the last
+    # source with a record for a station that is on Earth (has valid
+    # lat/lon metadata) wins.
+    merged = heapq.merge(*streams, key=operator.itemgetter(0))
+    for _, group in itertools.groupby(merged, key=operator.itemgetter(0)):
+        last = {}
+        for _, i, record in group:
+            last[i] = record
+        chosen = None
+        for i in sorted(last):
+            if on_earth(last[i]):
+                chosen = last[i]
+        if chosen:
+            yield chosen
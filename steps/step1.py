@@ -20,8 +20,10 @@ Ts.strange.v4.list.IN_full
 """
 
 # Clear Climate Code
+import numpy as np
+
 from steps import read_config
-from steps.giss_data import MISSING, BASE_YEAR
+from steps.giss_data import MISSING, BASE_YEAR, StationBatch
 
 
 def drop_strange(data):
@@ -29,57 +31,131 @@ def drop_strange(data):
     the file 'tmp/input/Ts.strange.v4.list.IN_full' file.
     """
 
-    changes_dict = read_config.get_changes_dict()
+    changes_index = read_config.get_changes_index()
     for record in data:
-        changes = changes_dict.get(record.uid, [])
-        series = record.series
-        begin = record.first_year
-        end = begin + (len(series) // 12) - 1
-        for (kind, year, x) in changes:
-            if kind == 'years':
-                # omit all the data from year1 to year2, inclusive
-                year1 = year
-                year2 = x
-
-                if year1 <= begin and year2 >= end:
-                    # Drop this whole record.  Note: avoids "else:"
-                    # clause at end of "for" loop.
-                    break
-
-                # Clamp range of deleted years to the range of the
-                # series.
-                year1 = max(year1, begin)
-                year2 = min(year2, end)
-                if year2 < year1:
-                    # Happens when deleted range is entirely outside the
-                    # range of the series.  In which case, pass record
-                    # unchanged.
-                    continue
-                # Invalidate the data.
-                nmonths = (year2 + 1 - year1) * 12
-                series[(year1 - begin) * 12:(year2 + 1 - begin) * 12] = [MISSING] * nmonths
-
-            else:  # remove a single month
-                # It can happen that the datum-to-be-removed is outside
-                # the date range for this record (if we are using new
-                # config files, and old data).  So we check.
-                if begin <= year <= end:
-                    series[(year - begin) * 12 + x - 1] = MISSING
-        else:
-            record.set_series(begin * 12 + 1, series)
+        if remove_strange(record, changes_index):
             yield record
 
 
+def remove_strange(record, changes_index):
+    """Invalidate the parts of *record* given by *changes_index* (see
+    read_config.get_changes_index()).  Returns False when the whole
+    record is to be dropped, True otherwise.
+    """
+
+    series = record.series
+    begin = record.first_year
+    end = begin + (len(series) // 12) - 1
+    if record.uid in changes_index:
+        first, last = changes_index[record.uid]
+        # Months of the series, numbered as in the index.
+        lo = begin * 12
+        hi = end * 12 + 11
+        if ((first <= lo) & (last >= hi)).any():
+            # A change covers the whole record: drop it.
+            return False
+        # Clamp the changes to the range of the series; those
+        # entirely outside it leave the series unchanged.
+        first = np.maximum(first, lo) - lo
+        last = np.minimum(last, hi) - lo
+        inside = first <= last
+        # Mark the months of each change with +1 at its start and
+        # -1 after its end; the running total is then positive
+        # over every month that a change covers.
+        delta = np.zeros(len(series) + 1, dtype=np.int64)
+        np.add.at(delta, first[inside], 1)
+        np.add.at(delta, last[inside] + 1, -1)
+        mask = np.cumsum(delta[:-1]) > 0
+        if mask.any():
+            series = np.array(series)
+            series[mask] = MISSING
+            series = series.tolist()
+    record.set_series(begin * 12 + 1, series)
+    return True
+
+
+def drop_strange_batch(batch):
+    """Like drop_strange(), but for the records in the
+    giss_data.StationBatch *batch*; the changes for all the records
+    are applied at once.  Returns a new StationBatch.
+    """
+
+    if (batch.first_month % 12 != 1).any():
+        # Records that do not start in January.
+        return StationBatch.from_series(drop_strange(batch))
+
+    changes_index = read_config.get_changes_index()
+    rows = []
+    first = []
+    last = []
+    for i, uid in enumerate(batch.uid.tolist()):
+        if uid in changes_index:
+            f, l = changes_index[uid]
+            rows.append(np.full(len(f), i))
+            first.append(f)
+            last.append(l)
+    if not rows:
+        return batch
+    rows = np.concatenate(rows)
+    first = np.concatenate(first)
+    last = np.concatenate(last)
+
+    # Months of each series, numbered as in the index.
+    begin = (batch.first_month - 1) // 12
+    end = begin + batch.length // 12 - 1
+    lo = (begin * 12)[rows]
+    hi = (end * 12 + 11)[rows]
+    # Drop the records that a change covers entirely.
+    keep = np.ones(len(batch), dtype=bool)
+    keep[rows[(first <= lo) & (last >= hi)]] = False
+    # Clamp the other changes to the range of their series; those
+    # entirely outside it leave the series unchanged.
+    first = np.maximum(first, lo)
+    last = np.minimum(last, hi)
+    inside = keep[rows] & (first <= last)
+    rows = rows[inside]
+    # Columns of *batch.values* (whose month numbers start at 1).
+    first = first[inside] + 1 - batch.base_month
+    last = last[inside] + 1 - batch.base_month
+
+    values = batch.values[keep]
+    if len(rows):
+        # Rows of *values* for the records that are changed.
+        new_row = np.cumsum(keep) - 1
+        changed, position = np.unique(new_row[rows], return_inverse=True)
+        # Mark the months of each change with +1 at its start and -1
+        # after its end; the running total is then positive over
+        # every month that a change covers.
+        delta = np.zeros((len(changed), values.shape[1] + 1), dtype=np.int64)
+        np.add.at(delta, (position, first), 1)
+        np.add.at(delta, (position, last + 1), -1)
+        mask = np.cumsum(delta[:, :-1], axis=1) > 0
+        block = values[changed]
+        block[mask] = MISSING
+        values[changed] = block
+    index = np.flatnonzero(keep)
+    return StationBatch(batch.uid[index], [batch.stations[i] for i in index],
+                        batch.first_month[index], batch.length[index],
+                        batch.base_month, values)
+
+
 def step1(records):
     """An iterator for step 1.  Produces a stream of
     `giss_data.Series` instances.
 
     :Param records:
         An iterable source of `giss_data.Series` instances (which it
-        will assume are station records).
+        will assume are station records).  If *records* is a
+        `giss_data.StationBatch`, then so is the result.
     """
-    # without_strange = records
-    without_strange = drop_strange(records)
-    for record in without_strange:
+    if isinstance(records, StationBatch):
+        batch = drop_strange_batch(records)
+        assert ((batch.first_month - 1) // 12 == BASE_YEAR).all()
+        return batch
+    return check_first_year(drop_strange(records))
+
+
+def check_first_year(records):
+    for record in records:
         assert record.first_year == BASE_YEAR
         yield record
@@ -18,12 +18,16 @@ Additionally in this step, all stations with short records are discarded
 # Standard Python
 import math
 
-from steps import earth, giss_data
+import numpy as np
+
+from steps import earth, giss_data, region
 import parameters
 from steps.giss_data import valid, invalid, MISSING
+from tool import checkpoint, gio
 from settings import *
+import settings
 
-log = open(os.path.join(LOG_DIR, 'step2.log'), 'w')
+log = settings.Log('step2.log')
 
 
 def urban_adjustments(record_stream):
@@ -54,31 +58,83 @@ def urban_adjustments(record_stream):
         record, try a second time for this urban station, with a
         larger radius.  If there is still not enough data, discard the
         urban station.
+
+    A checkpoint is saved (see tool/checkpoint.py) once the records
+    have been annotated, and after each
+    *parameters.step2_checkpoint_stations* urban stations; when a run
+    is resumed, the records and adjustments are taken from the
+    checkpoints, and the adjustments carry on from the last one.
     """
-    rural_stations, urban_stations, all = annotate_records(record_stream)
+    state = checkpoint.load('step2.input')
+    if state is None:
+        state = annotate_records(record_stream)
+        checkpoint.save('step2.input', state)
+    rural_stations, urban_stations, all = state
+
+    # In a regional analysis (see steps/region.py) only the records
+    # that Step 3 will use are adjusted and output; the others are
+    # only used as rural neighbours.
+    wanted = None
+    if region.regional():
+        wanted = set(record.uid for record in
+                     region.near(all, parameters.gridding_radius))
+
+    # *done* is the number of records in *all* that have been dealt
+    # with, and *part* the number of the next checkpoint.
+    done = 0
+    part = 0
+    while True:
+        state = checkpoint.load('step2.part%d' % part)
+        if state is None:
+            break
+        done, records = state
+        for record in records:
+            yield record
+        part += 1
+
+    # The records (copies of them, in case they are changed by a later
+    # step) output since the last checkpoint, and the number of urban
+    # stations among them.  The copies are only made when checkpoints
+    # are being saved.
+    output = []
+    urban = 0
     # Combine time series for rural stations around each urban station
-    for record in all:
+    for i in range(done, len(all)):
+        record = all[i]
+        if wanted is not None and record.uid not in wanted:
+            continue
         us = urban_stations.get(record, None)
 
         if us is None:
             # Not an urban station.  Pass through unchanged.
             log.write('%s step2-action "rural"\n' % record.uid)
+            if checkpoint.enabled:
+                output.append(gio.snapshot(record))
             yield record
             continue
 
+        urban += 1
         points, quorate_count = rural_difference(us, rural_stations)
 
         if not points:
             log.write('%s step2-action "dropped"\n' % record.uid)
-            continue
-        fit = getfit(points)
+        else:
+            fit = getfit(points)
+
+            # The first and last years, in the urban series, that will
+            # be adjusted.
+            adjust_first, adjust_last = extend_range(
+                us.anomalies, quorate_count, fit.first, fit.last)
+            adjust_record(record, fit, adjust_first, adjust_last)
+            if checkpoint.enabled:
+                output.append(gio.snapshot(record))
+            yield record
 
-        # The first and last years, in the urban series, that will be
-        # adjusted.
-        adjust_first, adjust_last = extend_range(
-            us.anomalies, quorate_count, fit.first, fit.last)
-        adjust_record(record, fit, adjust_first, adjust_last)
-        yield record
+        if urban == parameters.step2_checkpoint_stations:
+            checkpoint.save('step2.part%d' % part, (i + 1, output))
+            part += 1
+            output = []
+            urban = 0
 
 
 def annotate_records(stream):
@@ -208,11 +264,12 @@ def rural_test():
     """Returns a list of triples (field_name, comparison, value) which
     are derived from parameters.rural_designator.  Parsing the
     parameter into this list is quite laborious, so we only want to do
-    it once."""
+    it once (for each value of the parameter, which can be changed
+    between runs in the same process, see tool/daemon.py)."""
     global _rural_test
 
-    if _rural_test:
-        return _rural_test
+    if _rural_test and _rural_test[0] == parameters.rural_designator:
+        return _rural_test[1]
 
     comp_dict = {'=': lambda x, y: x == y,
                  '<': lambda x, y: x < y,
@@ -243,8 +300,8 @@ def rural_test():
             assert 0, "Malformed test in parameters.rural_designator: '%s'" % test
         tests.append((field, comparison, value))
 
-    _rural_test = tests
-    return _rural_test
+    _rural_test = (parameters.rural_designator, tests)
+    return tests
 
 
 def is_rural(station):
@@ -707,16 +764,61 @@ def drop_short_records(record_source):
     with at least *parameters.station_drop_minimum_months* valid data.
     """
     for record in record_source:
-        mmax = max(record.get_monthly_valid_counts())
-        if mmax >= parameters.station_drop_minimum_months:
+        if long_enough(record):
+            yield record
+
+
+def long_enough(record):
+    """True when *record* has a month index with at least
+    *parameters.station_drop_minimum_months* valid data; otherwise
+    logs the record as dropped and returns False."""
+
+    mmax = max(record.get_monthly_valid_counts())
+    if mmax >= parameters.station_drop_minimum_months:
+        return True
+    log.write('%s step2-action "short"\n' % record.uid)
+    return False
+
+
+def drop_short_batch(batch):
+    """Like drop_short_records(), but for the records in the
+    giss_data.StationBatch *batch*: the valid counts for all the
+    records are made at once, then each record is yielded (or logged)
+    in turn."""
+
+    # The calendar month (0 for January) of each column.
+    months = batch.values.shape[1]
+    calendar = (batch.base_month - 1 + np.arange(months)) % 12
+    counts = np.zeros((len(batch), 12), dtype=np.int64)
+    for m in range(12):
+        counts[:, m] = (~batch.missing[:, calendar == m]).sum(axis=1)
+    keep = counts.max(axis=1, initial=0) >= parameters.station_drop_minimum_months
+    for record, k in zip(batch, keep.tolist()):
+        if k:
             yield record
         else:
             log.write('%s step2-action "short"\n' % record.uid)
 
 
+def near_region(records):
+    """In a regional analysis (see steps/region.py) only the stations
+    near the region are needed: those that Step 3 uses, and their rural
+    neighbours.  Returns those of *records* (or *records* unchanged,
+    when the analysis is not regional)."""
+    return region.near(records, parameters.gridding_radius +
+                       parameters.urban_adjustment_full_radius)
+
+
 def step2(record_source):
+    """An iterator for step 2.  Produces a stream of
+    `giss_data.Series` instances.  *record_source* is an iterable of
+    station records, or a giss_data.StationBatch."""
     # data = record_source
-    data = drop_short_records(record_source)
+    if isinstance(record_source, giss_data.StationBatch):
+        data = drop_short_batch(record_source)
+    else:
+        data = drop_short_records(record_source)
+    data = near_region(data)
     # adjusted = data
     adjusted = urban_adjustments(data)
     for record in adjusted:
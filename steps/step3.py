@@ -12,12 +12,14 @@ Python code reproducing the STEP3 part of the GISTEMP algorithm.
 import math
 
 import parameters
-from steps import eqarea, giss_data, series
+from steps import eqarea, giss_data, region, series
 from steps.giss_data import MISSING, valid
+from tool import checkpoint, gio
 
 from settings import *
+import settings
 
-log = open(os.path.join(LOG_DIR, 'step3.log'), 'w')
+log = settings.Log('step3.log')
 
 
 def incircle(iterable, arc, lat, lon):
@@ -79,13 +81,31 @@ def iter_subbox_grid(station_records, max_months, first_year, radius):
     *max_months* is the maximum number of months in any station
     record.  *first_year* is the first year in the dataset.  *radius*
     is the combining radius in kilometres.
+
+    A checkpoint is saved (see tool/checkpoint.py) once the records
+    have been read, and after each region; when a run is resumed, the
+    records and the subboxes of the completed regions are taken from
+    the checkpoints.
+
+    In a regional analysis (see steps/region.py) only the subboxes in
+    the region are made, from the stations near them.
     """
 
     # Clear Climate Code
     from steps import earth  # required for radius.
 
-    # Convert to list because we re-use it for each box (region).
-    station_records = list(station_records)
+    grid = (max_months, first_year, radius)
+    state = checkpoint.load('step3.input')
+    if state is None:
+        # Convert to list because we re-use it for each box (region).
+        station_records = list(region.near(station_records, radius))
+        checkpoint.save('step3.input', (grid, station_records))
+    else:
+        saved_grid, station_records = state
+        if saved_grid != grid:
+            raise Exception("Can't resume Step 3: the checkpoint is for "
+                            "(months, first year, radius) %r, not %r" %
+                            (saved_grid, grid))
 
     # Descending sort by number of good records.
     station_records = sorted(station_records, key=lambda x: x.good_count, reverse=True)
@@ -93,7 +113,7 @@ def iter_subbox_grid(station_records, max_months, first_year, radius):
     import sys
 
     dribble = sys.stdout
-    progress = open(PROGRESS_DIR + 'progress.txt', 'a')
+    progress = open(settings.workspace.progress_dir + 'progress.txt', 'a')
     progress.write("COMPUTING 80 REGIONS from 8000 SUBBOXES:")
 
     # Critical radius as an angle of arc
@@ -101,20 +121,36 @@ def iter_subbox_grid(station_records, max_months, first_year, radius):
     arcdeg = arc * 180 / math.pi
 
     regions = list(eqarea.gridsub())
-    for region in regions:
-        box, subboxes = region[0], list(region[1])
+    selected = region.subboxes()
+    # The number (see steps/region.py) of the first subbox of each box.
+    first_subbox = 0
+    resuming = True
+    for i, (box, subboxes) in enumerate(regions):
+        subboxes = list(subboxes)
+        numbers = range(first_subbox, first_subbox + len(subboxes))
+        first_subbox += len(subboxes)
+
+        if resuming:
+            done = checkpoint.load('step3.region%02d' % i)
+            resuming = done is not None
+            if resuming:
+                for box_obj in done:
+                    yield box_obj
+                dribble.write('Region (%+03.0f/%+03.0f S/N %+04.0f/%+04.0f W/E): '
+                              'from checkpoint.\n' % tuple(box))
+                continue
+        # Copies of the subboxes of this region, for its checkpoint (only
+        # made when checkpoints are being saved).
+        done = []
 
         # Count how many cells are empty
         n_empty_cells = 0
-        for subbox in subboxes:
+        for number, subbox in zip(numbers, subboxes):
+            if selected is not None and number not in selected:
+                continue
             # Select and weight stations
             # Treat all boxes that touch the poles as a single box.
-            centre = eqarea.centre(subbox)
-            if round(centre[0]) >= 84:
-                centre = (90, 0)
-
-            if round(centre[0]) <= -84:
-                centre = (-90, 0)
+            centre = region.subbox_centre(subbox)
 
             dribble.write("\rsubbox at %+05.1f%+06.1f (%d empty)" % (centre + (n_empty_cells,)))
             dribble.flush()
@@ -129,6 +165,8 @@ def iter_subbox_grid(station_records, max_months, first_year, radius):
                                            box=list(subbox), stations=0, station_months=0,
                                            d=MISSING)
                 n_empty_cells += 1
+                if checkpoint.enabled:
+                    done.append(gio.snapshot(box_obj))
                 yield box_obj
                 continue
 
@@ -188,6 +226,8 @@ def iter_subbox_grid(station_records, max_months, first_year, radius):
                                        d=radius * (1 - max_weight))
             log.write("%s stations %s\n" % (box_obj.uid,
                                             asjson(contributed)))
+            if checkpoint.enabled:
+                done.append(gio.snapshot(box_obj))
             yield box_obj
         plural_suffix = 's'
         if n_empty_cells == 1:
@@ -197,6 +237,7 @@ def iter_subbox_grid(station_records, max_months, first_year, radius):
         progress.write('\rRegion (%+03.0f/%+03.0f S/N %+04.0f/%+04.0f W/E): %d empty cell%s.' % (
             tuple(box) + (n_empty_cells, plural_suffix)))
         progress.flush()
+        checkpoint.save('step3.region%02d' % i, done)
     dribble.write("\n")
 
 
@@ -208,12 +249,16 @@ def asjson(obj):
     return repr(obj).replace("'", '"')
 
 
-def step3(records, radius=parameters.gridding_radius, year_begin=1880):
+def step3(records, radius=None, year_begin=1880):
     """Step 3 of the GISS processing.
 
     *records* should be a generator that yields each station.
+    *radius* is the gridding radius (by default,
+    parameters.gridding_radius).
 
     """
+    if radius is None:
+        radius = parameters.gridding_radius
     # Most of the metadata here used to be synthesized in step2.py and
     # copied from the first yielded record.  Now we synthesize here
     # instead.
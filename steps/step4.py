@@ -8,6 +8,7 @@ sea-surface temperature anomaly boxed dataset.
 
 from tool import gio
 import parameters
+from steps import region
 from steps.giss_data import MISSING, invalid
 
 IYRBEG = 1880  # first year
@@ -76,6 +77,9 @@ def step4(data):
     """
 
     land, ocean, monthlies = data
+    # In a regional analysis (see steps/region.py) the land has only
+    # the subboxes in the region, and so must the ocean.
+    ocean = region.select(ocean)
     if monthlies is not None:
         sst, dates = monthlies
         ocean = merge_ocean(ocean, sst, dates)
@@ -15,13 +15,17 @@ are computed from monthly anomalies.
 """
 import parameters
 from settings import *
-from steps import eqarea, giss_data, series
-from steps.giss_data import valid, MISSING
+import settings
+from steps import eqarea, giss_data, region, series
+from steps.giss_data import MISSING
 from tool import gio
 
-import os
+import re
+import threading
 
-log = open(os.path.join(LOG_DIR, 'step5.log'), 'w')
+import numpy as np
+
+log = settings.Log('step5.log')
 
 
 def as_boxes(data):
@@ -31,9 +35,10 @@ def as_boxes(data):
 
 
 def land_ocean_boxes(meta, cells):
-    """From the input data, *cells*, 3 separate series of boxes are
-    made: one for a land-only series, one for an ocean-only series, and
-    one mixed series (the usual analysis).
+    """From the input data, *cells*, up to 3 separate analyses are
+    prepared: a land-only analysis, an ocean-only analysis, and a
+    mixed analysis (the usual analysis).  Which analyses are prepared
+    is controlled by parameters.step5_analyses.
 
     *meta* is a triple of (mask,land,ocean) meta data.
 
@@ -44,91 +49,230 @@ def land_ocean_boxes(meta, cells):
     intermediate weights are supported.  Typically these weights are
     generated by `ensure_weight`.
 
-    A triple of (meta,data) pairs is returned.
+    A triple (*subboxes*, *analyses*, *land_boxes*) is returned.
+    *subboxes* is a `SubboxArrays` instance holding the land and ocean
+    series of every subbox; *analyses* is a list of (meta, kind,
+    celltype) triples, one for each analysis, where *kind* is one of
+    'land', 'ocean', 'mixed'.  Each analysis is run by `run_analysis`.
+    *land_boxes* is a (not yet started) `LandBoxesWriter` for the
+    GHCNv4BoxesLand text file.
     """
 
     mask_meta, land_meta, ocean_meta = meta
-    begin_year = str(1880)
-    end_year = ocean_meta.title.decode().strip()[-4:]
-
-    land_file = open(RESULT_DIR + "GHCNv4BoxesLand." + str(int(land_meta.gridding_radius)) + ".txt", 'w')
-    print("GHCNv3 Temperature Anomalies (C) Land Only", file=land_file)
-    print(begin_year + " " + end_year + ' 9999.0 ' + str(
-        int(land_meta.gridding_radius)) + ' (=first year, last year, missing data flag, smoothing radius)',
-          file=land_file)
+    end_year = int(ocean_meta.title.decode().strip()[-4:])
 
     assert land_meta.mavg == 6
     land_meta.mode = 'land'
     ocean_meta.mode = 'ocean'
 
+    # All the series are held in a single frame of months, the one
+    # used by the mixed analysis.
+    first_year = min(land_meta.yrbeg, ocean_meta.yrbeg)
+    land_limit_year = land_meta.yrbeg + land_meta.monm // 12
+    ocean_limit_year = ocean_meta.yrbeg + ocean_meta.monm // 12
+    limit_year = max(land_limit_year, ocean_limit_year)
+    max_months = (limit_year - first_year) * 12
+
     # List of cells for each series.
     land = []
-    mixed = []
+    ocean = []
+    landmask = []
+
+    for landweight, landcell, oceancell in cells:
+        land.append(landcell)
+        ocean.append(oceancell)
+        # Simple version of mixed selects either land or ocean.
+        assert landweight in (0, 1)
+        landmask.append(bool(landweight))
+
+    subboxes = SubboxArrays(first_year, max_months, land, ocean, landmask)
+    land_boxes = LandBoxesWriter(
+        settings.workspace.result_dir + "GHCNv4BoxesLand." +
+        str(int(land_meta.gridding_radius)) + ".txt",
+        land_meta.gridding_radius, [cell.box + [cell.d] for cell in land],
+        subboxes, 1880, end_year)
+    del land, ocean
 
     # It's a mistake to do the land--ocean mixed analysis using land
     # data up to 2010-12 and ocean data only up to 2010-11 (say).
     # We detect that here, by keeping track of the the min and max
     # months (with data) for the land cells and ocean cells that are
     # used by the mixed series.
-    minland = 999999
-    maxland = -999999
-    minocean = 999999
-    maxocean = -999999
-    for landweight, landcell, oceancell in cells:
-        land.append(landcell)
-        # Simple version of mixed selects either land or ocean.
-        assert landweight in (0, 1)
-        if landweight:
-            mixedcell = landcell
-            minland = min(minland, landcell.first_valid_month())
-            maxland = max(maxland, landcell.last_valid_month())
-        else:
-            mixedcell = oceancell
-            minocean = min(minocean, oceancell.first_valid_month())
-            maxocean = max(maxocean, oceancell.last_valid_month())
-        mixed.append(mixedcell)
-
-        if landcell != '':
-            print(*landcell.box + [landcell.d], file=land_file)
-            for entry in landcell.get_set_of_years(1880, int(end_year)):
-                entry = [round(x, 5) for x in entry]
-                print(*entry, file=land_file)
-
-    del landweight, landcell, oceancell
+    mask = subboxes.landmask
+    minland = min(subboxes.land_first[mask].tolist(), default=999999)
+    maxland = max(subboxes.land_last[mask].tolist(), default=-999999)
+    minocean = min(subboxes.ocean_first[~mask].tolist(), default=999999)
+    maxocean = max(subboxes.ocean_last[~mask].tolist(), default=-999999)
     if (minland, maxland) != (minocean, maxocean):
         warn_land_ocean(minland, maxland, minocean, maxocean)
 
-    def iterland():
-        return land_meta, subbox_to_box(land_meta, land, celltype='LND')
-
-    def itermixed():
-        first_year = min(land_meta.yrbeg, ocean_meta.yrbeg)
-        land_limit_year = land_meta.yrbeg + land_meta.monm // 12
-        ocean_limit_year = ocean_meta.yrbeg + ocean_meta.monm // 12
-        limit_year = max(land_limit_year, ocean_limit_year)
-        max_months = (limit_year - first_year) * 12
-
-        # For the metadata for the mixed analysis, start with a copy of
-        # the land metadata.
-        mixed_meta = giss_data.StationMetaData(
-            land_month_range=(minland, maxland),
-            ocean_month_range=(minocean, maxocean),
-            **land_meta.__dict__)
-
-        mixed_meta.yrbeg = first_year
-        mixed_meta.monm = max_months
-        mixed_meta.mode = 'mixed'
-        mixed_meta.ocean_source = ocean_meta.ocean_source
-        year_min = (min(minocean, minland) - 1) // 12
-        year_max = (max(maxocean, maxland) - 1) // 12
-        mixed_meta.title = (
-            'Combined Land--Ocean Temperature Anomaly (C) CR %4dkm %s to %s.' %
-            (land_meta.gridding_radius, str(year_min), str(year_max)))
-        land_meta.months_data = max(maxland, maxocean)
-        mixed_meta.months_data = max(maxland, maxocean)
-        return mixed_meta, subbox_to_box(mixed_meta, mixed, celltype='MIX')
-
-    return iterland(), itermixed()
+    # For the metadata for the mixed analysis, start with a copy of
+    # the land metadata.
+    mixed_meta = giss_data.StationMetaData(
+        land_month_range=(minland, maxland),
+        ocean_month_range=(minocean, maxocean),
+        **land_meta.__dict__)
+
+    mixed_meta.yrbeg = first_year
+    mixed_meta.monm = max_months
+    mixed_meta.mode = 'mixed'
+    mixed_meta.ocean_source = ocean_meta.ocean_source
+    year_min = (min(minocean, minland) - 1) // 12
+    year_max = (max(maxocean, maxland) - 1) // 12
+    mixed_meta.title = (
+        'Combined Land--Ocean Temperature Anomaly (C) CR %4dkm %s to %s.' %
+        (land_meta.gridding_radius, str(year_min), str(year_max)))
+    land_meta.months_data = max(maxland, maxocean)
+    mixed_meta.months_data = max(maxland, maxocean)
+    ocean_meta.months_data = max(subboxes.ocean_last.tolist(), default=-999999)
+
+    analyses = dict(land=(land_meta, 'land', 'LND'),
+                    mixed=(mixed_meta, 'mixed', 'MIX'),
+                    ocean=(ocean_meta, 'ocean', 'OCN'))
+    return (subboxes,
+            [analyses[kind] for kind in parameters.step5_analyses.split()],
+            land_boxes)
+
+
+class SubboxArrays(object):
+    """The land and ocean series for all the subboxes (typically
+    8000), held as (cells, months) arrays.  These arrays are built
+    once, by `land_ocean_boxes`, and shared by all the Step 5 analyses.
+
+    :Ivar first_year:
+        The year of the first column of the arrays.
+    :Ivar land, ocean:
+        The land and ocean series, padded with MISSING.
+    :Ivar land_good, ocean_good:
+        Lists giving the good_count of each land and ocean series.
+    :Ivar land_uid, ocean_uid:
+        Lists giving the uid of each land and ocean series.
+    :Ivar land_first, land_last, ocean_first, ocean_last:
+        Arrays giving the first and last valid month of each series
+        (see `giss_data.Series.first_valid_month`).
+    :Ivar landmask:
+        Boolean array, True where the mixed analysis uses the land
+        series.
+    :Ivar box_index:
+        Array giving the index (into `eqarea.grid()`) of the box that
+        contains each subbox.
+    """
+
+    def __init__(self, first_year, months, land, ocean, landmask):
+        self.first_year = first_year
+        self.land, self.land_first, self.land_last = self._matrix(land, months)
+        self.ocean, self.ocean_first, self.ocean_last = self._matrix(ocean, months)
+        self.land_good = [cell.good_count for cell in land]
+        self.ocean_good = [cell.good_count for cell in ocean]
+        self.land_uid = [cell.uid for cell in land]
+        self.ocean_uid = [cell.uid for cell in ocean]
+        self.landmask = np.array(landmask, dtype=bool)
+        boxes = list(eqarea.grid())
+        self.box_index = np.array(
+            [boxes.index(whichbox(boxes, cell.box)) for cell in land])
+
+    def _matrix(self, cells, months):
+        """Return the (cells, months) array for the series *cells*,
+        and arrays of the first and last valid months of each."""
+
+        result = np.full((len(cells), months), MISSING)
+        for row, cell in zip(result, cells):
+            offset = 12 * (cell.first_year - self.first_year)
+            row[offset:offset + len(cell)] = cell.series
+        good = result != MISSING
+        has_data = good.any(axis=1)
+        first_month = self.first_year * 12 + 1
+        # Same conventions as the Series methods, when there is no
+        # valid data.
+        first = np.where(has_data, good.argmax(axis=1) + first_month,
+                         9999 * 12)
+        last = np.where(has_data,
+                        months - 1 - good[:, ::-1].argmax(axis=1) + first_month,
+                        1)
+        return result, first, last
+
+    def cells(self, kind):
+        """Return the series, good counts, and uids, for the cells
+        used by the analysis *kind* ('land', 'ocean', or 'mixed'), as a
+        triple."""
+
+        if kind == 'land':
+            return self.land, self.land_good, self.land_uid
+        if kind == 'ocean':
+            return self.ocean, self.ocean_good, self.ocean_uid
+        assert kind == 'mixed'
+        mask = self.landmask
+        series = np.where(mask[:, None], self.land, self.ocean)
+        good = [l if m else o
+                for m, l, o in zip(mask, self.land_good, self.ocean_good)]
+        uid = [l if m else o
+               for m, l, o in zip(mask, self.land_uid, self.ocean_uid)]
+        return series, good, uid
+
+
+class LandBoxesWriter(threading.Thread):
+    """A thread that writes the land series of every subbox to the text
+    file *path*, for the years *first_year* to *last_year*: for each
+    subbox a line giving its bounds and land distance, followed by one
+    line of 12 monthly values (rounded to 5 decimal places) per year.
+
+    *bounds* is a list giving the bounds and land distance of each
+    subbox, and *subboxes* is the `SubboxArrays` holding the series.
+
+    The thread is started with `start` (so that the file is written
+    while the boxes are being combined), and `join` re-raises any
+    exception that happened while writing.
+    """
+
+    def __init__(self, path, radius, bounds, subboxes, first_year, last_year):
+        threading.Thread.__init__(self, name='LandBoxesWriter')
+        self.path = path
+        self.radius = radius
+        self.bounds = bounds
+        self.subboxes = subboxes
+        self.first_year = first_year
+        self.last_year = last_year
+        self.error = None
+
+    def run(self):
+        try:
+            self.write()
+        except BaseException as e:
+            self.error = e
+
+    def join(self, timeout=None):
+        threading.Thread.join(self, timeout)
+        if self.error is not None:
+            raise self.error
+
+    def write(self):
+        years = self.last_year - self.first_year + 1
+        # Each year is formatted with '%.5f' and then trailing zeros
+        # are removed (and the smallest values put in exponent form),
+        # which gives the same text as printing the value rounded to 5
+        # places.
+        template = ('%.5f ' * 11 + '%.5f\n') * years
+        trailing_zeros = re.compile(r'(\.\d+?)0+(?=[ \n])')
+        tiny = re.compile(r'(?<![\d.])(-?)0\.0000([1-9])(?=[ \n])')
+        land = self.subboxes.land
+        start = 12 * (self.first_year - self.subboxes.first_year)
+        stop = start + 12 * years
+        with open(self.path, 'w') as out:
+            out.write("GHCNv3 Temperature Anomalies (C) Land Only\n")
+            out.write("%d %d 9999.0 %d (=first year, last year, missing data "
+                      "flag, smoothing radius)\n" %
+                      (self.first_year, self.last_year, int(self.radius)))
+            for bounds, row in zip(self.bounds, land):
+                if 0 <= start and stop <= len(row):
+                    values = row[start:stop]
+                else:
+                    values = np.full(stop - start, MISSING)
+                    lo, hi = max(start, 0), min(stop, len(row))
+                    if lo < hi:
+                        values[lo - start:hi - start] = row[lo:hi]
+                out.write(' '.join(map(str, bounds)) + '\n')
+                text = trailing_zeros.sub(r'\1', template % tuple(values.tolist()))
+                out.write(tiny.sub(r'\1\2e-05', text))
 
 
 def warn_land_ocean(*l):
@@ -146,14 +290,17 @@ def warn_land_ocean(*l):
           tuple(map(iso8601, l)))
 
 
-def subbox_to_box(meta, cells, celltype='BOX'):
+def subbox_to_box_array(meta, subboxes, kind, celltype='BOX', log=log):
     """Aggregate the subboxes (aka cells, typically 8000 per globe)
     into boxes (typically 80 boxes per globe), and combine records to
-    produce one time series per box.
+    produce one time series per box.  The cells are taken from the
+    `SubboxArrays` instance *subboxes*: those used by the analysis
+    *kind* (see `SubboxArrays.cells`).  The cell series are combined
+    with `series.combine_array` and `series.anomalize_array`.
 
     *celltype* is used for logging, using a distinct (3 character) code
     will allow the log output for the land, ocean, and land--ocean
-    analyses to be separated.
+    analyses to be separated.  The log records are written to *log*.
 
     *meta* specifies the meta data and is used to determine the first
     year (meta.yrbeg) and length (meta.monm) for all the resulting
@@ -161,67 +308,53 @@ def subbox_to_box(meta, cells, celltype='BOX'):
 
     Returns an iterator of box data: for each box a quadruple of
     (*anom*, *weight*, *ngood*, *box*) is yielded.  *anom* is the
-    temperature anomaly series, *weight* is the weights for the series
-    (number of cells contributing for each month), *ngood* is total
-    number of valid data in the series, *box* is a 4-tuple that
-    describes the regions bounds: (southern, northern, western, eastern).
+    temperature anomaly series (an array), *weight* is the weights for
+    the series (an array of the number of cells contributing for each
+    month), *ngood* is total number of valid data in the series, *box*
+    is a 4-tuple that describes the regions bounds: (southern,
+    northern, western, eastern).
     """
 
-    # The (80) large boxes.
     boxes = list(eqarea.grid())
-    # For each box, make a list of contributors (cells that contribute
-    # to the box time series); initially empty.
-    contributordict = dict((box, []) for box in boxes)
-
-    # Partition the cells into the boxes.
-    for cell in cells:
-        box = whichbox(boxes, cell.box)
-        contributordict[box].append(cell)
-
-    def padded_series(s):
-        """Produce a series, that is padded to start in meta.yrbeg and
-        is of length meta.monm months.
-        *s* should be a giss_data.Series instance.
-        """
-
-        result = [MISSING] * meta.monm
-        offset = 12 * (s.first_year - meta.yrbeg)
-        result[offset:offset + len(s)] = s.series
-        return result
+    cells, good_count, uids = subboxes.cells(kind)
+    # The columns of *cells* that are in the frame given by *meta*.
+    offset = 12 * (meta.yrbeg - subboxes.first_year)
+    cells = cells[:, offset:offset + meta.monm]
 
-    # For each box, sort and combine the contributing cells, and output
-    # the result (by yielding it).
     for idx, box in enumerate(boxes):
-
-        contributors = sorted(contributordict[box], key=lambda x: x.good_count, reverse=True)
+        contributors = np.flatnonzero(subboxes.box_index == idx).tolist()
+        if not contributors:
+            # In a regional analysis (see steps/region.py) the boxes
+            # with no subboxes in the region are not made.
+            continue
+        contributors = sorted(contributors, key=lambda i: good_count[i],
+                              reverse=True)
 
         best = contributors[0]
-        box_series = padded_series(best)
-        box_weight = [float(valid(a)) for a in box_series]
+        box_series = cells[best].copy()
+        box_weight = (box_series != MISSING).astype(float)
 
         # Start the *contributed* list with this cell.
-        l = [any(valid(v) for v in box_series[i::12]) for i in range(12)]
-        s = ''.join('01'[x] for x in l)
-        contributed = [[best.uid, 1.0, s]]
+        l = (box_series.reshape(-1, 12) != MISSING).any(axis=0)
+        s = ''.join('01'[int(x)] for x in l)
+        contributed = [[uids[best], 1.0, s]]
         # Loop over the remaining contributors.
         for cell in contributors[1:]:
-            if cell.good_count >= parameters.subbox_min_valid:
-                addend_series = padded_series(cell)
-
+            if good_count[cell] >= parameters.subbox_min_valid:
                 weight = 1.0
-                station_months = series.combine(box_series, box_weight,
-                                                addend_series, weight, parameters.box_min_overlap)
+                station_months = series.combine_array(
+                    box_series, box_weight, cells[cell], weight,
+                    parameters.box_min_overlap)
                 s = ''.join('01'[bool(x)] for x in station_months)
             else:
                 weight = 0.0
                 s = '0' * 12
-            contributed.append([cell.uid, weight, s])
-        box_first_year = meta.yrbeg
-        series.anomalize(box_series, parameters.subbox_reference_period,
-                         box_first_year)
+            contributed.append([uids[cell], weight, s])
+        series.anomalize_array(box_series, parameters.subbox_reference_period,
+                               meta.yrbeg)
         uid = giss_data.boxuid(box, celltype=celltype)
         log.write("%s cells %s\n" % (uid, asjson(contributed)))
-        ngood = sum(valid(a) for a in box_series)
+        ngood = int(np.count_nonzero(box_series != MISSING))
 
         yield (box_series, box_weight, ngood, box)
 
@@ -241,13 +374,16 @@ def whichbox(boxes, cell):
             return box
 
 
-def zonav(meta, boxed_data):
+def zonav_array(meta, boxed_data):
     """Zonal Averaging.
 
-    The input *boxed_data* is an iterator of boxed time series.
-    The data in the boxes are combined to produce averages over
-    various latitudinal zones.  Returns an iterator of
-    (averages, weights, title) tuples, one per zone.
+    *boxed_data* is an iterator of (series, weight, ngood, box) tuples,
+    one for each of the 80 boxes (as produced by `subbox_to_box_array`);
+    the box series and weights are gathered into two (80, monm) matrices.
+    The data in the boxes are combined (with `series.combine_array`
+    and `series.anomalize_array`) to produce averages over various
+    latitudinal zones.  A pair of (16, monm) arrays is returned: the
+    averages and the weights for each zone.
 
     16 zones are produced.  The first 8 are the basic belts that are used
     for the equal area grid, the remaining 8 are combinations:
@@ -272,97 +408,64 @@ def zonav(meta, boxed_data):
     monm = meta.monm
 
     boxes_in_band, band_in_zone = zones()
-
     bands = len(boxes_in_band)
 
+    boxed_data = list(boxed_data)
+    assert len(boxed_data) == sum(boxes_in_band), "Wrong number of boxes"
+    box_series = np.array([box[0] for box in boxed_data], dtype=float)
+    box_weights = np.array([box[1] for box in boxed_data], dtype=float)
+    box_lengths = [box[2] for box in boxed_data]
+
+    avg = np.full((len(band_in_zone) + bands, monm), MISSING)
+    wt = np.zeros((len(band_in_zone) + bands, monm))
     lenz = [None] * bands
-    wt = [None] * bands
-    avg = [None] * bands
-    # For each band, combine all the boxes in that band to create a band
-    # record.
+    # Index of the first box in the current band.
+    first = 0
     for band in range(bands):
-        # The temperature (anomaly) series for each of the boxes in this
-        # band.
-        box_series = [None] * boxes_in_band[band]
-        # The weight series for each of the boxes in this band.
-        box_weights = [None] * boxes_in_band[band]
-        # "length" is the number of months (with valid data) in the box
-        # series.  For each box in this band.
-        box_length = [None] * boxes_in_band[band]
-
-        for box in range(boxes_in_band[band]):
-            # The last element in the tuple is the boundaries of the
-            # box.  We ignore it.
-            box_series[box], box_weights[box], box_length[box], _ = (next(boxed_data))
-
-        # total number of valid data in band's boxes
-        total_length = sum(box_length)
-
-        if total_length == 0:
-            wt[band] = [0.0] * monm
-            avg[band] = [MISSING] * monm
-        else:
+        n_boxes = boxes_in_band[band]
+        box_length = box_lengths[first:first + n_boxes]
+        if sum(box_length) != 0:
             box_length, IORD = sort_perm(box_length)
-            nr = IORD[0]
-
-            # Copy the longest box record into *wt* and *avg*.
-            # Using list both performs a copy and converts into a mutable
-            # list.
-            wt[band] = list(box_weights[nr])
-            avg[band] = list(box_series[nr])
-
-            # And combine the remaining series.
-            for n in range(1, boxes_in_band[band]):
-                nr = IORD[n]
+            nr = first + IORD[0]
+            avg[band] = box_series[nr]
+            wt[band] = box_weights[nr]
+            for n in range(1, n_boxes):
                 if box_length[n] == 0:
-                    # Nothing in this box, and since we sorted by length,
-                    # all the remaining boxes will also be empty.  We can
-                    # stop combining boxes.
+                    # Since we sorted by length, all the remaining
+                    # boxes will also be empty.
                     break
-
-                series.combine(avg[band], wt[band],
-                               box_series[nr], box_weights[nr],
-                               parameters.box_min_overlap)
-        series.anomalize(avg[band], parameters.box_reference_period, iyrbeg)
-        lenz[band] = sum(valid(a) for a in avg[band])
-
-        yield (avg[band], wt[band])
-
-    # We expect to have consumed all the boxes (the first 8 bands form a
-    # partition of the boxes).  We check that the boxed_data stream is
-    # exhausted and contains no more boxes.
-    try:
-        next(boxed_data)
-        assert 0, "Too many boxes found"
-    except StopIteration:
-        # We fully expect to get here.
-        pass
-
-    # *lenz* contains the lengths of each zone 0 to 7 (the number of
-    # valid months in each zone).
+                nr = first + IORD[n]
+                series.combine_array(avg[band], wt[band],
+                                     box_series[nr], box_weights[nr],
+                                     parameters.box_min_overlap)
+        series.anomalize_array(avg[band], parameters.box_reference_period,
+                               iyrbeg)
+        lenz[band] = int(np.count_nonzero(avg[band] != MISSING))
+        first += n_boxes
+
+    # Combine the bands into the compound zones.
     lenz, iord = sort_perm(lenz)
     for zone in range(len(band_in_zone)):
-        # Find the longest band that is in the compound zone.
         for j1 in range(bands):
             if iord[j1] in band_in_zone[zone]:
                 break
         else:
-            # Should be an assertion really.
             raise Exception('No band in compound zone %d.' % zone)
         band = iord[j1]
         if lenz[band] == 0:
             print('**** NO DATA FOR ZONE %d' % band)
-        wtg = list(wt[band])
-        avgg = list(avg[band])
-        # Add in the remaining bands, in length order.
+        z = bands + zone
+        avg[z] = avg[band]
+        wt[z] = wt[band]
         for j in range(j1 + 1, bands):
             band = iord[j]
             if band not in band_in_zone[zone]:
                 continue
-            series.combine(avgg, wtg, avg[band], wt[band],
-                           parameters.box_min_overlap)
-        series.anomalize(avgg, parameters.box_reference_period, iyrbeg)
-        yield (avgg, wtg)
+            series.combine_array(avg[z], wt[z], avg[band], wt[band],
+                                 parameters.box_min_overlap)
+        series.anomalize_array(avg[z], parameters.box_reference_period,
+                               iyrbeg)
+    return avg, wt
 
 
 def sort_perm(a):
@@ -410,11 +513,9 @@ def zones():
     return boxes_in_band, band_in_zone
 
 
-def annzon(meta, zoned_averages, alternate=None):
-    if alternate is None:
-        alternate = {'global': 2, 'hemi': True}
-    """Compute annual zoned anomalies. *zoned_averages* is an iterator
-    of zoned averages produced by `zonav`.
+def annzon_array(meta, zoned_averages, alternate=None):
+    """Compute annual zoned anomalies.  *zoned_averages* is the pair of
+    (16, monm) arrays returned by `zonav_array`.
 
     The *alternate* argument controls whether alternate algorithms are
     used to compute the global and hemispheric means.
@@ -422,92 +523,59 @@ def annzon(meta, zoned_averages, alternate=None):
     alternate computations, or false to not compute an alternative;
     alternate['hemi'] is true to compute an alternative, false
     otherwise.
+
+    The result is a tuple (*meta*, *data*, *wt*, *ann*, *monmin*):
+    *data* and *wt* are (16, years, 12) arrays of the monthly zonal
+    means and their weights, *ann* is a (16, years) array of the annual
+    means, and *monmin* is the minimum number of months for an annual
+    mean (parameters.zone_annual_min_months).
     """
 
-    zones = 16
-    monm = meta.monm
-    iyrs = monm // 12
-
-    # Allocate the 2- and 3- dimensional arrays.
-    # The *data* and *wt* arrays are properly 3 dimensional
-    # ([zone][year][month]), but the inner frames are only allocated
-    # when we read the data, see :read:zonal below.
-    data = [None for _ in range(zones)]
-    wt = [None for _ in range(zones)]
-    ann = [[MISSING] * iyrs for _ in range(zones)]
-
-    # Collect zonal means.
-    for zone in range(zones):
-        (tdata, twt) = next(zoned_averages)
-
-        # Regroup the *data* and *wt* series so that they come in blocks of 12.
-        # Uses essentially the same trick as the `grouper()` recipe in
-        # http://docs.python.org/library/itertools.html#recipes
-        data[zone] = list(zip(*[iter(tdata)] * 12))
-
-        wt[zone] = zip(*[iter(twt)] * 12)
-
-    # Find (compute) the annual means.
-    for zone in range(zones):
-        for iy in range(iyrs):
-            anniy = 0.
-            mon = 0
-            for m in range(12):
-                if data[zone][iy][m] == MISSING:
-                    continue
-                mon += 1
-                anniy += data[zone][iy][m]
-
-            if mon >= parameters.zone_annual_min_months:
-                ann[zone][iy] = float(anniy) / mon
+    if alternate is None:
+        alternate = {'global': 2, 'hemi': True}
+
+    avg, weight = zoned_averages
+    zones = len(avg)
+    iyrs = meta.monm // 12
+
+    data = avg[:, :iyrs * 12].reshape(zones, iyrs, 12).copy()
+    wt = weight[:, :iyrs * 12].reshape(zones, iyrs, 12).copy()
+
+    # Find (compute) the annual means; the months are summed in order.
+    good = data != MISSING
+    mon = good.sum(axis=2)
+    anniy = np.cumsum(np.where(good, data, 0.0), axis=2)[..., -1] + 0.0
+    ann = np.where(mon >= parameters.zone_annual_min_months,
+                   anniy / np.maximum(mon, 1), MISSING)
 
     # Alternate global mean.
     if alternate['global']:
         glb = alternate['global']
         assert glb in (1, 2)
         # Pick which "four" zones to use.
-        # (subtracting 1 from each zone to convert to Python convention)
         if glb == 1:
             zone = [8, 9, 9, 10]
         else:
             zone = [8, 3, 4, 10]
         wtsp = [3., 2., 2., 3.]
-        for iy in range(iyrs):
+        for a in [ann, data]:
             glob = 0.
-            ann[-1][iy] = MISSING
+            bad = False
             for z, w in zip(zone, wtsp):
-                if ann[z][iy] == MISSING:
-                    # Note: Rather ugly use of "for...else" to emulate GOTO.
-                    break
-                glob += ann[z][iy] * w
-            else:
-                ann[-1][iy] = .1 * glob
-        for iy in range(iyrs):
-            data[-1][iy] = [MISSING] * 12
-            for m in range(12):
-                glob = 0.
-                for z, w in zip(zone, wtsp):
-                    if data[z][iy][m] == MISSING:
-                        break
-                    glob += data[z][iy][m] * w
-                else:
-                    data[-1][iy][m] = .1 * glob
+                bad = bad | (a[z] == MISSING)
+                glob = glob + a[z] * w
+            a[-1] = np.where(bad, MISSING, .1 * glob)
 
-    # Alternate hemispheric means.
+    # Alternate hemispheric means.  For the computations it will be
+    # useful to recall how the zones are numbered; see `zonav_array`.
     if alternate['hemi']:
-        # For the computations it will be useful to recall how the zones
-        # are numbered.  There is a useful docstring at the beginning of
-        # zonav().
         for ihem in range(2):
-            for iy in range(iyrs):
-                ann[ihem + 11][iy] = MISSING
-                if ann[ihem + 3][iy] != MISSING and ann[2 * ihem + 8][iy] != MISSING:
-                    ann[ihem + 11][iy] = (0.4 * ann[ihem + 3][iy] + 0.6 * ann[2 * ihem + 8][iy])
-            for iy in range(iyrs):
-                data[ihem + 11][iy] = [MISSING] * 12
-                for m in range(12):
-                    if data[ihem + 3][iy][m] != MISSING and data[2 * ihem + 8][iy][m] != MISSING:
-                        data[ihem + 11][iy][m] = (0.4 * data[ihem + 3][iy][m] + 0.6 * data[2 * ihem + 8][iy][m])
+            for a in [ann, data]:
+                north = a[ihem + 3]
+                south = a[2 * ihem + 8]
+                a[ihem + 11] = np.where(
+                    (north != MISSING) & (south != MISSING),
+                    0.4 * north + 0.6 * south, MISSING)
 
     return meta, data, wt, ann, parameters.zone_annual_min_months
 
@@ -540,6 +608,96 @@ def ensure_weight(data):
             yield landmask, land, ocean
 
 
+def run_analysis(meta, subboxes, kind, celltype, log=log):
+    """Run a single Step 5 analysis, of kind *kind* (see
+    `land_ocean_boxes`), on the `SubboxArrays` *subboxes*.  The box
+    (BX) file is written as the boxes are made.  The tuple produced by
+    `annzon_array` is returned; or None in a regional analysis (see
+    steps/region.py), which only makes the boxes.
+    """
+
+    boxes = subbox_to_box_array(meta, subboxes, kind, celltype, log)
+    boxes = gio.step5_bx_output(meta, boxes)
+    if region.regional():
+        for _ in boxes:
+            pass
+        return None
+    zoned_averages = zonav_array(meta, boxes)
+    return annzon_array(meta, zoned_averages)
+
+
+# The subboxes shared by the worker processes of `run_analyses`.
+worker_subboxes = None
+
+
+def init_worker(subboxes):
+    global worker_subboxes
+    worker_subboxes = subboxes
+
+
+def analysis_worker(analysis):
+    """Run (in a worker process) the analysis described by the
+    (meta, kind, celltype) triple *analysis*, and write all of its
+    output files.  A pair of the `annzon_array` result and the log
+    output is returned; the log output is written to the log file by
+    the parent process, so that it appears in the usual order.
+    """
+
+    import io
+
+    meta, kind, celltype = analysis
+    log_output = io.StringIO()
+    result = run_analysis(meta, worker_subboxes, kind, celltype,
+                          log=log_output)
+    if result is not None:
+        gio.step5_output_one(result)
+    gio.wait_for_output()
+    return result, log_output.getvalue()
+
+
+def run_analyses(subboxes, analyses, background=()):
+    """Run each of the *analyses* on *subboxes*.  When
+    parameters.step5_processes is more than 1 the analyses are run
+    concurrently, each in its own worker process.  A list of results,
+    one for each analysis, is returned.
+
+    *background* is a sequence of threads (not yet started) that run
+    alongside the analyses; they are started after any worker
+    processes have been created, and joined before returning.
+    """
+
+    processes = min(parameters.step5_processes, len(analyses))
+    if processes <= 1:
+        for thread in background:
+            thread.start()
+        result = [run_analysis(meta, subboxes, kind, celltype)
+                  for meta, kind, celltype in analyses]
+        for thread in background:
+            thread.join()
+        return result
+
+    import multiprocessing
+
+    # Finish writing the output of the earlier steps before forking.
+    gio.wait_for_output()
+    pool = multiprocessing.Pool(processes, initializer=init_worker,
+                                initargs=(subboxes,))
+    for thread in background:
+        thread.start()
+    try:
+        done = pool.map(analysis_worker, analyses, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+        for thread in background:
+            thread.join()
+    result = []
+    for item, log_output in done:
+        log.write(log_output)
+        result.append(item)
+    return result
+
+
 def step5(data):
 
     """Step 5 of GISTEMP.
@@ -559,14 +717,8 @@ def step5(data):
     subboxes = ensure_weight(data)
     subboxes = gio.step5_mask_output(subboxes)
 
-    # The result of `as_boxes` is a stream of boxes for each of 3
-    # separate analyses: land only, land and ocean combined.
-    land, mixed = as_boxes(subboxes)
-
-    result = []
-
-    for meta, boxes in [land, mixed]:
-        boxes = gio.step5_bx_output(meta, boxes)
-        zoned_averages = zonav(meta, boxes)
-        result.append(annzon(meta, zoned_averages))
-    return result
+    # The result of `as_boxes` is the subbox data, and a list of the
+    # separate analyses to be made from it: usually land only, and
+    # land and ocean combined.
+    subboxes, analyses, land_boxes = as_boxes(subboxes)
+    return run_analyses(subboxes, analyses, [land_boxes])
@@ -0,0 +1,189 @@
+#!/usr/local/bin/python3.4
+#
+# api.py -- run the GISTEMP algorithm from Python
+
+"""Run Steps 0 to 5 of the GISTEMP algorithm in memory, and return
+the results as arrays::
+
+    from tool import api
+    result = api.run(params={'gridding_radius': 250})
+    result.analyses['mixed'].annual
+
+Unlike tool/run.py no work or result files are written, unless they
+are asked for with the *sinks* argument of `run`.  (The input files are
+still read from the input directory, and the logs written to the log
+directory, of the workspace; see `settings.Workspace`.)
+"""
+
+import io
+import os
+import sys
+
+# gio imports fort, which lives alongside this module.
+_tool_dir = os.path.dirname(os.path.abspath(__file__))
+if _tool_dir not in sys.path:
+    sys.path.append(_tool_dir)
+
+import numpy as np
+
+import parameters
+import settings
+from tool import gio
+
+
+class Analysis(object):
+    """The arrays made by one of the Step 5 analyses.
+
+    :Ivar meta:
+        The metadata of the analysis (its *mode* is 'land', 'ocean',
+        or 'mixed'); *meta.yrbeg* is the year of the first column of
+        each of the arrays.
+    :Ivar boxes:
+        List of the bounds (see `eqarea.grid`) of each of the 80 boxes.
+    :Ivar box_series, box_weights:
+        The (80, months) arrays of box anomalies and weights, as
+        written to the BX file.
+    :Ivar zone_series, zone_weights:
+        The (16, years, 12) arrays of zonal anomalies and weights (see
+        `step5.annzon_array` for the order of the zones).
+    :Ivar annual:
+        The (16, years) array of annual zonal anomalies.  In a regional
+        analysis (see parameters.analysis_region) there are no zonal
+        means, and these are None; *boxes* and the box arrays hold only
+        the boxes that have subboxes in the region.
+    :Ivar log:
+        The text that the analysis writes to the Step 5 log.
+    """
+
+    def __init__(self, meta, boxes, zones, log):
+        self.meta = meta
+        self.boxes = [box[3] for box in boxes]
+        self.box_series = np.array([box[0] for box in boxes], dtype=float)
+        self.box_weights = np.array([box[1] for box in boxes], dtype=float)
+        self.zones = zones
+        if zones is None:
+            self.zone_series = self.zone_weights = self.annual = None
+        else:
+            _, self.zone_series, self.zone_weights, self.annual, _ = zones
+        self.log = log
+
+
+class Result(object):
+    """The result of `run`.
+
+    :Ivar subboxes:
+        The `step5.SubboxArrays` holding the land (Step 3) and ocean
+        (Step 4) series of every subbox, and the land mask.
+    :Ivar analyses:
+        Dict mapping the kind of each analysis made (see
+        parameters.step5_analyses) to its `Analysis`.
+    """
+
+    def __init__(self, subboxes, analyses):
+        self.subboxes = subboxes
+        self.analyses = analyses
+
+
+def run(inputs=None, params=None, sinks=(), workspace=None):
+    """Run Steps 0 to 5 and return a `Result`.
+
+    :Param inputs:
+        The Step 0 input, an object like `gio.Input` (by default,
+        `gio.step0_input()`).
+    :Param params:
+        A dict of parameters (see the parameters package) to change
+        for this run; the parameters are restored afterwards.
+    :Param sinks:
+        The steps ('0' to '5', as for the --steps option of
+        tool/run.py) whose usual output files are to be written.
+    :Param workspace:
+        The `settings.Workspace` to use for this run (by default,
+        settings.workspace).
+    """
+
+    params = params or {}
+    for name in params:
+        if not hasattr(parameters, name):
+            raise ValueError("Unknown parameter %r" % name)
+    saved = dict((name, getattr(parameters, name)) for name in params)
+    if workspace is not None:
+        workspace.makedirs()
+        previous = settings.use_workspace(workspace)
+    try:
+        for name, value in params.items():
+            setattr(parameters, name, value)
+        result = run_steps(inputs, set(sinks))
+        gio.wait_for_output()
+        return result
+    finally:
+        for name, value in saved.items():
+            setattr(parameters, name, value)
+        if workspace is not None:
+            settings.use_workspace(previous).close()
+
+
+def run_steps(inputs, sinks):
+    return run_grid_steps(run_station_steps(inputs, sinks), sinks)
+
+
+def run_station_steps(inputs, sinks):
+    """Steps 0 to 2, which work on the station records.  Returns an
+    iterator of the Step 2 records."""
+
+    from steps import step0, step1, step2
+    from extension import step1 as estep1
+
+    if inputs is None:
+        inputs = gio.step0_input()
+    data = step0.step0(inputs)
+    if '0' in sinks:
+        data = gio.step0_output(data)
+    data = estep1.post_step1(step1.step1(estep1.pre_step1(data)))
+    if '1' in sinks:
+        data = gio.step1_output(data)
+    data = step2.step2(data)
+    if '2' in sinks:
+        data = gio.step2_output(data)
+    return data
+
+
+def run_grid_steps(data, sinks, ocean=None):
+    """Steps 3 to 5, which make the gridded analyses from the Step 2
+    records *data*.  *ocean* is the ocean data, as returned by
+    `gio.step4_ocean` (by default, it is read from the input
+    directory).  Returns a `Result`."""
+
+    from steps import region, step3, step4, step5
+
+    data = step3.step3(data)
+    if '3' in sinks:
+        data = gio.step3_output(data)
+    data = step4.step4(gio.step4_input(data, ocean))
+    if '4' in sinks:
+        data = gio.step4_output(data)
+
+    cells = step5.ensure_weight(gio.step5_input(data))
+    if '5' in sinks:
+        cells = gio.step5_mask_output(cells)
+    subboxes, analyses, land_boxes = step5.as_boxes(cells)
+    if '5' in sinks:
+        land_boxes.start()
+    result = {}
+    for meta, kind, celltype in analyses:
+        log = io.StringIO()
+        boxes = step5.subbox_to_box_array(meta, subboxes, kind, celltype,
+                                          log=log)
+        if '5' in sinks:
+            boxes = gio.step5_bx_output(meta, boxes)
+        boxes = list(boxes)
+        zones = None
+        if not region.regional():
+            zones = step5.annzon_array(meta, step5.zonav_array(meta, boxes))
+        if '5' in sinks:
+            step5.log.write(log.getvalue())
+            if zones is not None:
+                gio.step5_output_one(zones)
+        result[kind] = Analysis(meta, boxes, zones, log.getvalue())
+    if '5' in sinks:
+        land_boxes.join()
+    return Result(subboxes, result)
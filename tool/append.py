@@ -0,0 +1,240 @@
+#!/usr/local/bin/python3.4
+#
+# append.py -- bring the results up to date with new months of data
+
+"""Append mode (the --append option of tool/run.py): bring the results
+up to date with the input files, running only the steps that the
+changes to them need.
+
+Each run in append mode saves its state in the 'append' directory under
+the work directory of the workspace: the values of the parameters, the
+sha256 digest of each input file, the last month of the GHCN data and
+a digest of the data up to it, the digest of the records of each GHCN
+station (see tool/ghcndiff.py), and the output of Step 3 (pickled, as
+the checkpoints are, so that nothing is lost).  The next run in append
+mode compares them with the current ones, and takes one of three paths
+(which it logs, with the reason):
+
+'none'
+    Nothing has changed, and no step is run.
+'ocean'
+    Only the ocean data (see parameters.ocean_source) has changed, or
+    only parameters that affect Steps 4 and 5 (see
+    parameters/dependencies.py).  Step 3 does not use the ocean data,
+    so its output is taken from the saved state, and only Steps 4 and 5
+    are run.
+'full'
+    All the steps are run.  This is the path when there is no saved
+    state, when a parameter that affects Steps 0 to 3 has changed, or
+    when any input file other than the ocean data has changed, even
+    if the only change is new months appended to the GHCN data (which
+    is logged as such, apart from a change to the earlier data; the
+    stations added, removed, and changed are listed in the log
+    ghcn_changes.log).  A new
+    month changes the overlaps, and so the biases, with which the
+    records are combined into subboxes (Step 3) and the subboxes into
+    boxes (Step 5), and the trends fitted by the urban adjustment (Step
+    2), for the whole of each record: none of the earlier results can
+    be extended without changing them.
+
+Whichever the path, the results are those of an ordinary run.
+"""
+
+import hashlib
+import os
+import pickle
+
+import parameters
+from parameters.dependencies import first_step_of
+import settings
+from tool import checkpoint, ghcndiff, gio
+from tool.ghcndiff import ghcn_lines, has_data, month_name
+
+
+# The state of the current run, made by `plan` and saved by `save`.
+current = None
+
+# The stations of the GHCN data that have changed since the last run.
+changes_log = settings.Log('ghcn_changes.log')
+
+
+def directory():
+    """The directory of the saved state of the current workspace."""
+    return os.path.join(settings.workspace.work_dir, 'append')
+
+
+def path(name):
+    return os.path.join(directory(), name + '.pickle')
+
+
+def ghcn_fingerprint(filename, previous=None):
+    """Return a triple for the GHCN file *filename*: the last month
+    with data, the digest of the data up to it, and the digest of the
+    data up to the month *previous* (None if *previous* is None).
+    Lines with no data up to the month are left out of its digest, so
+    that a station whose first data is after it makes no difference.
+    """
+
+    last = 0
+    for _, year, fields in ghcn_lines(filename):
+        for m, field in enumerate(fields, 1):
+            if has_data(field):
+                last = max(last, year * 12 + m)
+
+    cutoffs = [last] if previous is None else [last, previous]
+    digests = [hashlib.sha256() for _ in cutoffs]
+    for key, year, fields in ghcn_lines(filename):
+        for cutoff, digest in zip(cutoffs, digests):
+            kept = fields[:max(0, min(12, cutoff - year * 12))]
+            if any(has_data(field) for field in kept):
+                digest.update(('%s%04d%s\n' %
+                               (key, year, ''.join(kept))).encode())
+    digests = [digest.hexdigest() for digest in digests]
+    if previous is None:
+        digests.append(None)
+    return tuple([last] + digests)
+
+
+def plan():
+    """Compare the input files and parameters with those saved by the
+    last run in append mode, and choose the path of this run (see
+    above).  Returns a pair: the path ('none', 'ocean', or 'full'), and
+    the reason for it.
+    """
+
+    global current
+
+    # Remove the Step 3 output of a run that did not finish.
+    if os.path.exists(path('land') + '.tmp'):
+        os.remove(path('land') + '.tmp')
+    try:
+        with open(path('state'), 'rb') as f:
+            previous = pickle.load(f)
+    except FileNotFoundError:
+        previous = None
+    current = dict(parameters=checkpoint.parameter_values(),
+                   inputs=gio.input_digests(), ghcn=None, stations=None)
+
+    ghcn_name = None
+    if 'ghcn' in parameters.data_sources.split():
+        ghcn_name = os.path.basename(gio.Input().ghcn_path('ghcn'))
+    ocean_name = os.path.basename(gio.find_ocean_file())
+
+    def is_ocean(name):
+        # The ocean data, or a compressed copy of it.
+        return name == ocean_name or name.startswith(ocean_name + '.')
+
+    if ghcn_name:
+        ghcn_file = os.path.join(settings.workspace.input_dir, ghcn_name)
+    # The stations that have changed, for the reason.
+    stations = ''
+    if previous is None:
+        if ghcn_name:
+            current['ghcn'] = ghcn_fingerprint(ghcn_file)[:2]
+            current['stations'] = ghcndiff.station_digests(ghcn_file)
+        return 'full', "no state saved by an earlier run in append mode"
+    if ghcn_name and previous['inputs'].get(ghcn_name) == \
+            current['inputs'].get(ghcn_name):
+        current['ghcn'] = previous['ghcn']
+        current['stations'] = previous.get('stations')
+    elif ghcn_name:
+        old = previous['ghcn'] and previous['ghcn'][0]
+        current['ghcn'] = ghcn_fingerprint(ghcn_file, old)
+        current['stations'] = ghcndiff.station_digests(ghcn_file)
+        if previous.get('stations') is not None:
+            stations = "; %s (see ghcn_changes.log)" % log_changes(
+                previous['stations'], current['stations'])
+
+    changed = sorted(name for name, value in current['parameters'].items()
+                     if previous['parameters'].get(name, value) != value)
+    land = [name for name in changed if first_step_of(name) <= 3]
+    if land:
+        return 'full', "parameters changed: %s" % ', '.join(land)
+
+    inputs = sorted(name for name in
+                    set(current['inputs']) | set(previous['inputs'])
+                    if current['inputs'].get(name) !=
+                    previous['inputs'].get(name))
+    others = [name for name in inputs if not is_ocean(name)]
+    if others == [ghcn_name] and previous['ghcn']:
+        old_last, old_digest = previous['ghcn']
+        last, _, digest = current['ghcn']
+        if digest != old_digest or last <= old_last:
+            return 'full', ("GHCN data up to %s changed%s" %
+                            (month_name(old_last), stations))
+        return 'full', ("new GHCN data, %s to %s (the whole record of "
+                        "each station is analysed again)%s" %
+                        (month_name(old_last + 1), month_name(last),
+                         stations))
+    if others:
+        return 'full', "input files changed: %s" % ', '.join(others)
+    if not os.path.exists(path('land')):
+        return 'full', "no Step 3 output saved"
+    if inputs:
+        return 'ocean', "ocean data changed: %s" % ', '.join(inputs)
+    if changed:
+        return 'ocean', ("parameters of Steps 4 and 5 changed: %s" %
+                         ', '.join(changed))
+    return 'none', "the input files and parameters are the same"
+
+
+def log_changes(old, new):
+    """Write the stations that differ between the dicts of station
+    digests *old* and *new* (see `ghcndiff.station_digests`) to the log
+    ghcn_changes.log.  Returns a summary of them."""
+
+    added, removed, changed = ghcndiff.diff_digests(old, new)
+    for kind, stations in [('added', added), ('removed', removed),
+                           ('changed', changed)]:
+        for uid in stations:
+            changes_log.write("%-9s %s\n" % (kind, uid))
+    summary = ("stations: %d added, %d removed, %d changed" %
+               (len(added), len(removed), len(changed)))
+    changes_log.write(summary + "\n")
+    return summary
+
+
+def keeping_land(run_step3):
+    """Return a version of the function *run_step3* (see run.py) that
+    also pickles the Step 3 output, for `save` to keep."""
+
+    def keep(data):
+        os.makedirs(directory(), exist_ok=True)
+        temp = path('land') + '.tmp'
+        with open(temp, 'wb') as f:
+            for item in run_step3(data):
+                # Later steps may modify the records, so each is
+                # pickled before it is passed on.
+                pickle.dump(item, f, protocol=pickle.HIGHEST_PROTOCOL)
+                yield item
+            f.flush()
+            os.fsync(f.fileno())
+    return keep
+
+
+def land():
+    """Iterate over the Step 3 output saved by the last run in append
+    mode."""
+
+    with open(path('land'), 'rb') as f:
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                return
+
+
+def save():
+    """The run is complete: save its state (see `plan`), for the next
+    run in append mode."""
+
+    os.makedirs(directory(), exist_ok=True)
+    # The old state goes first, so that a run that dies part way
+    # through leaves no state rather than one that does not match the
+    # saved Step 3 output.
+    if os.path.exists(path('state')):
+        os.remove(path('state'))
+    if os.path.exists(path('land') + '.tmp'):
+        checkpoint.commit(path('land') + '.tmp', path('land'))
+    current['ghcn'] = current['ghcn'] and current['ghcn'][:2]
+    checkpoint.dump(path('state'), current)
@@ -0,0 +1,183 @@
+#!/usr/local/bin/python3.4
+#
+# checkpoint.py -- checkpoints inside the long-running steps
+
+"""Checkpoints, so that a run of tool/run.py that dies part way through
+Step 2 or Step 3 can be resumed (with its --resume option) without
+starting again from Step 0.
+
+Step 2 saves its input once it has read it all, then its output after
+each batch of urban stations (see parameters.step2_checkpoint_stations).
+Step 3 saves its input once it has read it all, then its output after
+each region of `eqarea.gridsub`.  A resumed run starts again at the
+last step that saved a checkpoint, and takes its input, and the
+output of each completed part, from the checkpoints.  The records are
+pickled, so nothing is lost (unlike the work files).  The output files
+of the step are written again as the step runs, and the logs are cut
+back to where they were at the last checkpoint, so the final outputs
+are the same as those of a run that was not interrupted.  A run is
+only resumed with the same parameters and input files (their digests
+are saved when the run starts); otherwise it starts again.
+
+The checkpoints are in the 'checkpoint' directory under the work
+directory of the workspace; each is written to a temporary file,
+flushed to disk, then renamed.  They are removed when a run finishes,
+and when a run that is not resumed starts.
+"""
+
+import os
+import pickle
+import shutil
+
+import settings
+from tool import gio
+
+
+# Checkpoints are only written when *enabled* is True (see `start`),
+# and only read when *resuming* is True (see `resume`).
+enabled = False
+resuming = False
+
+
+def directory():
+    """The directory of the checkpoints of the current workspace."""
+    return os.path.join(settings.workspace.work_dir, 'checkpoint')
+
+
+def path(name):
+    return os.path.join(directory(), name + '.pickle')
+
+
+def parameter_values():
+    """The values of all the parameters; the checkpoints of a run can
+    only be used by a run with the same parameters (and input files,
+    see `run_state`)."""
+
+    import types
+    import parameters
+
+    return dict((name, value) for name, value in vars(parameters).items()
+                if not name.startswith('_')
+                and not isinstance(value, types.ModuleType))
+
+
+def run_state():
+    """The parameters and the digests of the input files (see
+    `gio.input_digests`) of the run, saved as the checkpoint 'run'."""
+    return dict(parameters=parameter_values(), inputs=gio.input_digests())
+
+
+def dump(filename, item):
+    """Pickle *item* to the file *filename*, replacing it in one go
+    once it is safely on disk."""
+
+    temp = filename + '.tmp'
+    with open(temp, 'wb') as f:
+        pickle.dump(item, f, protocol=pickle.HIGHEST_PROTOCOL)
+        f.flush()
+        os.fsync(f.fileno())
+    commit(temp, filename)
+
+
+def commit(temp, filename):
+    """Rename the file *temp* (already flushed to disk) to *filename*,
+    and flush the rename to disk."""
+
+    os.replace(temp, filename)
+    fd = os.open(os.path.dirname(filename) or '.', os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def write(name, item):
+    """Write *item* to the checkpoint file *name*, replacing it in one
+    go once it is safely on disk."""
+    dump(path(name), item)
+
+
+def read(name):
+    """The item in the checkpoint file *name*, or None if there is
+    none."""
+    try:
+        with open(path(name), 'rb') as f:
+            return pickle.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def clear():
+    """Remove all the checkpoints of the current workspace."""
+    shutil.rmtree(directory(), ignore_errors=True)
+
+
+def start(state=None):
+    """Start writing checkpoints for a new run, removing any left by
+    an earlier run.  *state* is the `run_state` of the run, if it is
+    already known."""
+
+    global enabled, resuming
+
+    clear()
+    os.makedirs(directory())
+    write('run', state or run_state())
+    enabled, resuming = True, False
+
+
+def resume(step_list):
+    """Prepare to resume a run of the steps *step_list*, from the
+    checkpoints left by an earlier run.  Returns the step to start at:
+    the last step in *step_list* that saved a checkpoint.  If there is
+    no such step, or the checkpoints were made with other parameters or
+    input files, returns None (and starts a new run, see `start`).
+    """
+
+    global enabled, resuming
+
+    state = run_state()
+    if read('run') != state:
+        start(state)
+        return None
+    for step in ['3', '2']:
+        if step in step_list and read('step%s.input' % step) is not None:
+            enabled, resuming = True, True
+            return step
+    start(state)
+    return None
+
+
+def finish():
+    """The run is complete: remove its checkpoints."""
+
+    global enabled, resuming
+
+    if enabled:
+        clear()
+    enabled, resuming = False, False
+
+
+def save(name, state):
+    """Save *state* (any picklable object) as the checkpoint *name*,
+    together with the sizes of the logs written so far.  The output
+    files that have been closed are finished first."""
+
+    if not enabled:
+        return
+    gio.wait_for_output()
+    write(name, dict(state=state, logs=settings.workspace.sync_logs()))
+
+
+def load(name):
+    """Return the state saved as the checkpoint *name*, and cut the
+    logs back to their sizes when it was saved.  Returns None if the
+    run is not being resumed, or there is no such checkpoint.
+    """
+
+    if not resuming:
+        return None
+    item = read(name)
+    if item is None:
+        return None
+    settings.workspace.restore_logs(item['logs'])
+    return item['state']
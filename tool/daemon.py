@@ -0,0 +1,400 @@
+#!/usr/local/bin/python3.4
+#
+# daemon.py -- rerun steps of the GISTEMP algorithm from a resident server
+
+"""daemon.py [options] -- run a local server that keeps the output of
+the steps of the GISTEMP algorithm in memory, and reruns steps on
+request; or (with --submit or --stop) send a request to the server.
+Options:
+   --help         Print this text.
+   --port=N       The server listens on localhost port N (default 8750).
+   --workspace=DIR
+                  Workspace of the jobs (by default tmp/); a job can
+                  ask for another.
+   --input=DIR    Read the input files from DIR (by default, the input
+                  directory of the workspace).
+   --cache=N      Keep at most N step outputs in memory (default 8).
+   --submit       Send a job to the server, and print its reply.  The
+                  job runs the steps given by:
+   -s STEPS, --steps=STEPS
+                  Steps to run, as for run.py (by default, all steps);
+   -p NAME=VALUE  with the parameter NAME redefined, as for run.py.
+   --stop         Ask the server to exit.
+
+The server speaks JSON over HTTP.  POST /run with a job such as
+{"steps": "3-5", "parameters": ["gridding_radius=250"]} (and optionally
+"workspace": DIR) runs the steps much as run.py would, and replies when
+they are done; GET /status lists the step outputs held in memory; POST
+/stop stops the server.
+
+The input of the first step of a job is not read from the work files:
+it is the output of the step before, made with the parameters of the
+job, and kept in memory.  The outputs of Steps 0 to 2 are kept as
+`giss_data.StationBatch` instances, and those of Steps 3 and 4 as
+lists; an output is used again by each later job whose parameters
+(those used by the steps up to it, see parameters/dependencies.py) are
+the same.  Each job runs in a process of its own, forked from the
+server, so that it can't change what is kept.  When any of the input
+files change (their sha256 digest is checked when their size or time
+changes) everything kept is discarded.
+
+Jobs are run one at a time, in the order they are received.
+"""
+
+import collections
+import json
+import os
+import sys
+import types
+
+# run.py puts the root of the project on sys.path.
+import run
+import parameters
+from parameters.dependencies import first_step_of
+import settings
+from tool import gio
+from steps.giss_data import StationBatch
+
+
+def parse_options(arglist):
+    import optparse
+
+    usage = "usage: %prog [options]"
+    parser = optparse.OptionParser(usage)
+
+    parser.add_option("--port", type="int", default=8750,
+                      help="Localhost port of the server")
+    parser.add_option("--workspace", action="store", metavar="DIR",
+                      help="Workspace of the jobs")
+    parser.add_option("--input", action="store", metavar="DIR",
+                      help="Read the input files from DIR")
+    parser.add_option("--cache", type="int", default=8,
+                      help="Number of step outputs to keep in memory")
+    parser.add_option("--submit", action="store_true", default=False,
+                      help="Send a job to the server")
+    parser.add_option("-s", "--steps", action="store", metavar="S[,S]",
+                      default="", help="Steps of the job")
+    parser.add_option('-p', '--parameter', action='append', default=[],
+                      help="Redefine parameter from parameters/*.py for the job")
+    parser.add_option("--stop", action="store_true", default=False,
+                      help="Ask the server to exit")
+
+    options, args = parser.parse_args(arglist)
+    if len(args) != 0:
+        parser.error("Unexpected arguments")
+    if options.cache < 1:
+        parser.error("--cache must be at least 1")
+    return options, args
+
+
+def parameter_values():
+    """Return a dict mapping the name of every parameter to its
+    current value (as a string)."""
+    return dict((name, repr(value)) for name, value in vars(parameters).items()
+                if not name.startswith('_')
+                and not isinstance(value, types.ModuleType))
+
+
+def step_output(step, data):
+    """Run Step *step* (0 to 4) on *data* (the output of the step
+    before), without writing any work or result files, and return its
+    output."""
+
+    from steps import step0, step1, step2, step3, step4
+    from extension import step1 as estep1
+
+    if step == 0:
+        return step0.step0(gio.step0_input())
+    if step == 1:
+        return estep1.post_step1(step1.step1(estep1.pre_step1(data)))
+    if step == 2:
+        return step2.step2(data)
+    if step == 3:
+        return step3.step3(data)
+    assert step == 4
+    return step4.step4(gio.step4_input(data))
+
+
+def run_job(steps, data):
+    """Run the steps *steps* on *data* (None, or the output kept for
+    the step before), writing their work and result files as run.py
+    does.  This runs in the forked process of the job."""
+
+    import traceback
+
+    run.log("====> STEPS %s  ====" % ', '.join(steps))
+    try:
+        if data is not None:
+            data = iter(data)
+        run.run_steps(steps, run.step_functions(), data)
+    except BaseException:
+        traceback.print_exc()
+        sys.exit(1)
+    finally:
+        settings.workspace.close()
+        sys.stdout.flush()
+
+
+class Daemon(object):
+    """The state that the server keeps between jobs.
+
+    :Ivar tmp_dir, input_dir:
+        The default workspace of the jobs, and their input directory
+        (see `settings.Workspace`).
+    :Ivar cache_size:
+        The largest number of step outputs kept.
+    :Ivar outputs:
+        Ordered dict of the outputs kept, least recently used first.
+        The key for the output of Step N is (N, params), where params
+        is a tuple of the (name, value) pairs of the parameters used
+        by Steps 0 to N.
+    :Ivar inputs:
+        Dict mapping the name of each input file to its (size, time,
+        digest), when last checked.
+    :Ivar stopping:
+        True when the server has been asked to exit.
+    """
+
+    def __init__(self, tmp_dir, input_dir, cache_size):
+        self.tmp_dir = tmp_dir
+        self.input_dir = input_dir
+        self.cache_size = cache_size
+        self.outputs = collections.OrderedDict()
+        self.inputs = {}
+        self.defaults = parameter_values()
+        self.stopping = False
+
+    def check_inputs(self):
+        """Check the files in the input directory, and discard the
+        outputs kept if any of them have changed."""
+
+        from steps import step0
+
+        # Step 0 adds the brightness index to the inventory; do it now,
+        # rather than see the inventory change under the first job.
+        step0.prepare_inventory()
+        inputs = {}
+        for name in sorted(os.listdir(self.input_dir)):
+            path = os.path.join(self.input_dir, name)
+            # Skip the manifest of tool/fetch.py, and the like.
+            if name.startswith('.') or not os.path.isfile(path):
+                continue
+            stat = os.stat(path)
+            old = self.inputs.get(name)
+            if old and old[:2] == (stat.st_size, stat.st_mtime_ns):
+                inputs[name] = old
+            else:
+                inputs[name] = (stat.st_size, stat.st_mtime_ns,
+                                gio.file_digest(path))
+        changed = sorted(name for name in set(inputs) | set(self.inputs)
+                         if inputs.get(name, [None] * 3)[2] !=
+                         self.inputs.get(name, [None] * 3)[2])
+        if changed and self.inputs:
+            run.log("... input files changed: %s; discarding %d outputs" %
+                    (' '.join(changed), len(self.outputs)))
+        if changed:
+            self.outputs.clear()
+        self.inputs = inputs
+
+    def key(self, step):
+        """The key of the output of Step *step*, made with the current
+        parameters (see *outputs*)."""
+        values = parameter_values()
+        return (step, tuple((name, values[name]) for name in sorted(values)
+                            if first_step_of(name) <= step))
+
+    def output(self, step):
+        """Return the output of Step *step* (0 to 4), made with the
+        current parameters: the one kept, if there is one, or else a
+        new one (which is kept)."""
+
+        key = self.key(step)
+        if key in self.outputs:
+            self.outputs.move_to_end(key)
+            return self.outputs[key]
+        data = None
+        if step > 0:
+            data = iter(self.output(step - 1))
+        run.log("... making the output of Step %d" % step)
+        result = step_output(step, data)
+        if step <= 2:
+            result = StationBatch.from_series(result)
+        else:
+            result = list(result)
+        self.outputs[key] = result
+        while len(self.outputs) > self.cache_size:
+            self.outputs.popitem(last=False)
+        return result
+
+    def status(self):
+        """A dict describing the inputs and the outputs kept."""
+        outputs = []
+        for step, params in self.outputs:
+            changed = dict((name, value) for name, value in params
+                           if self.defaults.get(name) != value)
+            outputs.append(dict(step=step, parameters=changed))
+        return dict(inputs=dict((name, value[2])
+                                for name, value in self.inputs.items()),
+                    outputs=outputs)
+
+    def run(self, job):
+        """Run the job *job* (a dict, see the module docstring), and
+        return a pair (HTTP status code, reply)."""
+
+        import multiprocessing
+        import time
+        import traceback
+
+        try:
+            steps = run.parse_steps(str(job.get('steps', '')))
+            params = [str(p) for p in job.get('parameters', [])]
+        except run.Fatal as e:
+            return 400, dict(status='error', message=str(e))
+        cannot = [s for s in steps if s not in run.step_functions()]
+        if cannot:
+            return 400, dict(status='error',
+                             message="Can't run steps %s" % str(cannot))
+
+        workspace = settings.Workspace(job.get('workspace') or self.tmp_dir,
+                                       self.input_dir)
+        workspace.makedirs()
+        previous = settings.use_workspace(workspace)
+        saved = dict((name, getattr(parameters, name))
+                     for name in (p.split('=', 1)[0] for p in params)
+                     if hasattr(parameters, name))
+        # The output of the steps goes to a file in the workspace.
+        console = sys.stdout
+        path = os.path.join(workspace.log_dir, 'daemon.txt')
+        sys.stdout = run.logfile = open(path, 'w')
+        start_time = time.time()
+        reused = False
+        try:
+            run.update_parameters(params)
+            self.check_inputs()
+            data = None
+            if steps[0].isdigit() and int(steps[0]) > 0:
+                reused = self.key(int(steps[0]) - 1) in self.outputs
+                data = self.output(int(steps[0]) - 1)
+            sys.stdout.flush()
+            workspace.flush()
+            process = multiprocessing.get_context('fork').Process(
+                target=run_job, args=(steps, data))
+            process.start()
+            process.join()
+            code, status = 200, 'ok' if process.exitcode == 0 else 'failed'
+        except run.Fatal as e:
+            code, status = 400, 'error'
+            print(e)
+        except Exception:
+            code, status = 500, 'failed'
+            traceback.print_exc()
+        finally:
+            for name, value in saved.items():
+                setattr(parameters, name, value)
+            sys.stdout.close()
+            sys.stdout = run.logfile = console
+            settings.use_workspace(previous)
+            workspace.close()
+        return code, dict(status=status, steps=steps, reused=reused,
+                          seconds=round(time.time() - start_time, 3),
+                          workspace=workspace.tmp_dir, output=path)
+
+
+def make_server(port, daemon):
+    """Return an HTTP server, on localhost port *port*, that handles
+    the requests for *daemon* (a `Daemon`)."""
+
+    import http.server
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def reply(self, code, body):
+            text = json.dumps(body, indent=1, sort_keys=True).encode()
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(text)))
+            self.end_headers()
+            self.wfile.write(text)
+
+        def do_GET(self):
+            if self.path == '/status':
+                self.reply(200, daemon.status())
+            else:
+                self.reply(404, dict(status='error', message='Not found'))
+
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length', 0))
+            try:
+                job = json.loads(self.rfile.read(length).decode() or '{}')
+            except ValueError:
+                self.reply(400, dict(status='error', message='Bad JSON'))
+                return
+            if self.path == '/run' and isinstance(job, dict):
+                self.reply(*daemon.run(job))
+            elif self.path == '/stop':
+                daemon.stopping = True
+                self.reply(200, dict(status='ok'))
+            else:
+                self.reply(404, dict(status='error', message='Not found'))
+
+        def log_message(self, format, *args):
+            run.log("... %s" % (format % args))
+
+    return http.server.HTTPServer(('127.0.0.1', port), Handler)
+
+
+def submit(options):
+    """Send the job given by *options* (or the request to stop) to the
+    server, and print its reply.  Returns 0 if the job succeeded."""
+
+    import urllib.error
+    import urllib.request
+
+    if options.stop:
+        path, job = 'stop', {}
+    else:
+        path = 'run'
+        job = dict(steps=options.steps, parameters=options.parameter)
+        if options.workspace:
+            job['workspace'] = os.path.abspath(options.workspace)
+    request = urllib.request.Request(
+        'http://127.0.0.1:%d/%s' % (options.port, path),
+        data=json.dumps(job).encode(),
+        headers={'Content-Type': 'application/json'})
+    try:
+        response = urllib.request.urlopen(request)
+    except urllib.error.HTTPError as e:
+        response = e
+    except urllib.error.URLError as e:
+        raise run.Fatal("Can't reach the server: %s" % e.reason)
+    reply = json.loads(response.read().decode())
+    print(json.dumps(reply, indent=1, sort_keys=True))
+    return 0 if reply.get('status') == 'ok' else 1
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+    options, args = parse_options(argv[1:])
+    if options.submit or options.stop:
+        return submit(options)
+
+    if options.workspace or options.input:
+        settings.use_workspace(settings.Workspace(
+            options.workspace or settings.TMP_DIR, options.input))
+    workspace = settings.workspace
+    workspace.makedirs()
+    run.dl_input_files()
+
+    daemon = Daemon(workspace.tmp_dir, workspace.input_dir, options.cache)
+    daemon.check_inputs()
+    server = make_server(options.port, daemon)
+    run.log("====> DAEMON listening on 127.0.0.1:%d  ====" % options.port)
+    while not daemon.stopping:
+        server.handle_request()
+    server.server_close()
+    run.log("====> DAEMON stopped  ====")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
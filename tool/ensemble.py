@@ -0,0 +1,221 @@
+#!/usr/local/bin/python3.4
+#
+# ensemble.py -- run an ensemble of Step 3 to 5 analyses
+
+"""ensemble.py [options] -- run Steps 3 to 5 for an ensemble of members,
+each using a resampled set of the Step 2 station records.
+Options:
+   --help         Print this text.
+   --members=N    Number of members (default 100).
+   --method=M     How the stations of each member are chosen:
+                  'jackknife': the stations are split at random into N
+                  groups, and member i leaves out group i;
+                  'subsample': each member keeps a random --fraction of
+                  the stations;
+                  'coverage': each member keeps the stations that have
+                  data in a year chosen at random from --years (so
+                  that the modern station set is reduced to the
+                  coverage of that year).
+   --fraction=F   Fraction of the stations kept by 'subsample' (0.8).
+   --years=Y1-Y2  Years for 'coverage' (by default, all the years).
+   --seed=S       Seed for the random choices (0).
+   --analysis=A   The Step 5 analysis ('land', 'ocean', or 'mixed';
+                  by default 'mixed').
+   --work-file    Read the Step 2 records from the Step 2 work file,
+                  instead of running Steps 0 to 2.
+   --processes=N  Number of worker processes (by default, the number
+                  of CPUs).
+   --output=FILE  Output file (by default, result/ensemble.npz).
+   -p NAME=VALUE  Redefine a parameter, as for run.py.
+
+The Step 2 records are loaded once, as a `giss_data.StationBatch`,
+and so is the ocean data (see `gio.step4_ocean`); both are shared by
+the worker processes (which are forked after they have been loaded).  Each member's analysis is made in memory (see
+`api.run_grid_steps`), and only its zonal series are kept: the output
+file holds a (members, 16, months) array *zones*, with the zones in the
+order of `gio.step5_zone_titles` (*titles*), the months starting with
+January of the year *first_year*, and MISSING for missing data.  The
+station masks of the members are saved as *masks*.  The analysis must
+be of the whole globe (see parameters.analysis_region), as only it has
+zonal series.
+"""
+
+import copy
+import os
+import sys
+
+import numpy as np
+
+# run.py puts the root of the project on sys.path.
+import run
+import api
+import parameters
+import settings
+from tool import gio
+from steps import region
+from steps.giss_data import StationBatch
+
+
+def parse_options(arglist):
+    import optparse
+
+    usage = "usage: %prog [options]"
+    parser = optparse.OptionParser(usage)
+
+    parser.add_option("--members", type="int", default=100,
+                      help="Number of members")
+    parser.add_option("--method", default="jackknife",
+                      choices=["jackknife", "subsample", "coverage"],
+                      help="How the stations of each member are chosen")
+    parser.add_option("--fraction", type="float", default=0.8,
+                      help="Fraction of the stations kept by 'subsample'")
+    parser.add_option("--years", metavar="Y1-Y2",
+                      help="Years for 'coverage'")
+    parser.add_option("--seed", type="int", default=0,
+                      help="Seed for the random choices")
+    parser.add_option("--analysis", default="mixed",
+                      choices=["land", "ocean", "mixed"],
+                      help="The Step 5 analysis")
+    parser.add_option("--work-file", action="store_true", default=False,
+                      help="Read the Step 2 records from the work file")
+    parser.add_option("--processes", type="int", default=os.cpu_count(),
+                      help="Number of worker processes")
+    parser.add_option("--output", metavar="FILE",
+                      help="Output file (default result/ensemble.npz)")
+    parser.add_option('-p', '--parameter', action='append',
+                      help="Redefine parameter from parameters/*.py during run")
+
+    options, args = parser.parse_args(arglist)
+    if len(args) != 0:
+        parser.error("Unexpected arguments")
+    if options.members < 1:
+        parser.error("--members must be at least 1")
+    if not 0 < options.fraction <= 1:
+        parser.error("--fraction must be more than 0 and at most 1")
+    run.update_parameters(options.parameter)
+    if region.regional():
+        parser.error("A regional analysis (analysis_region %r) has no "
+                     "zonal series" % parameters.analysis_region)
+    return options, args
+
+
+def masks(batch, options):
+    """Return a (members, stations) boolean array giving the stations
+    of *batch* used by each member, as chosen by *options*."""
+
+    rng = np.random.default_rng(options.seed)
+    members = options.members
+    stations = len(batch)
+    if options.method == 'jackknife':
+        group = rng.permutation(stations) % members
+        return group[None, :] != np.arange(members)[:, None]
+    if options.method == 'subsample':
+        keep = int(round(options.fraction * stations))
+        result = np.zeros((members, stations), dtype=bool)
+        for row in result:
+            row[rng.choice(stations, keep, replace=False)] = True
+        return result
+    assert options.method == 'coverage'
+    # valid[i, y] is True when station i has data in the year years[y].
+    month_year = (batch.base_month + np.arange(batch.values.shape[1]) - 1) // 12
+    years = np.unique(month_year)
+    valid = np.logical_or.reduceat(~batch.missing,
+                                   np.searchsorted(month_year, years), axis=1)
+    chosen = np.arange(len(years))
+    if options.years:
+        try:
+            y1, y2 = [int(y) for y in options.years.split('-')]
+        except ValueError:
+            raise run.Fatal("Can't understand --years %r" % options.years)
+        chosen = chosen[(y1 <= years) & (years <= y2)]
+        if not len(chosen):
+            raise run.Fatal("No data in the years %s" % options.years)
+    return valid[:, rng.choice(chosen, members)].T
+
+
+# The station records and the ocean data shared by the worker
+# processes, set by `init_worker`.
+worker_batch = None
+worker_ocean = None
+
+
+def init_worker(batch, ocean, analysis):
+    global worker_batch, worker_ocean
+    worker_batch = batch
+    worker_ocean = ocean
+    parameters.step5_analyses = analysis
+    # The analyses of the members are not logged.
+    settings.use_workspace(settings.Workspace(settings.workspace.tmp_dir,
+                                              settings.workspace.input_dir,
+                                              logs=False))
+    sys.stdout = open(os.devnull, 'w')
+
+
+def member(task):
+    """Run the analysis of one member, given by the pair *task* (the
+    member number and its station mask).  Returns the member number,
+    the first year, and the (16, months) array of zonal series."""
+
+    i, mask = task
+    # Steps 4 and 5 may modify the ocean subboxes (and the metadata),
+    # so each member is given copies of them.
+    cells, monthlies = worker_ocean
+    ocean = [copy.copy(cells[0])] + [cell.copy() for cell in cells[1:]]
+    result = api.run_grid_steps(iter(worker_batch.take(mask)), set(),
+                                ocean=(ocean, monthlies))
+    analysis = result.analyses[parameters.step5_analyses]
+    zones = analysis.zone_series
+    return i, analysis.meta.yrbeg, zones.reshape(len(zones), -1)
+
+
+def main(argv=None):
+    import multiprocessing
+    import time
+
+    if argv is None:
+        argv = sys.argv
+    options, args = parse_options(argv[1:])
+    workspace = settings.workspace
+    workspace.makedirs()
+    output = options.output or os.path.join(workspace.result_dir, 'ensemble.npz')
+
+    start_time = time.time()
+    if options.work_file:
+        batch = gio.step2_input(batch=True)
+    else:
+        run.dl_input_files()
+        batch = StationBatch.from_series(api.run_station_steps(None, set()))
+    gio.wait_for_output()
+    cells, monthlies = gio.step4_ocean()
+    ocean = (list(cells), monthlies)
+    run.log("====> ENSEMBLE: %d members (%s) of %d stations  ====" %
+            (options.members, options.method, len(batch)))
+
+    member_masks = masks(batch, options)
+    zones = None
+    first_year = None
+    context = multiprocessing.get_context('fork')
+    with context.Pool(max(options.processes, 1), initializer=init_worker,
+                      initargs=(batch, ocean, options.analysis)) as pool:
+        tasks = enumerate(member_masks)
+        for done, (i, yrbeg, series) in enumerate(pool.imap_unordered(member, tasks)):
+            if zones is None:
+                zones = np.empty((options.members,) + series.shape)
+                first_year = yrbeg
+            zones[i] = series
+            run.log("... member %d done (%d of %d)" % (i, done + 1, options.members))
+
+    np.savez_compressed(output, zones=zones, first_year=first_year,
+                        titles=np.array(gio.step5_zone_titles()),
+                        masks=member_masks)
+    workspace.close()
+
+    end_time = time.time()
+    run.log("====> Timing Summary ====")
+    run.log("Ensemble took %.1f seconds; written to %s" %
+            (end_time - start_time, output))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
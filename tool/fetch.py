@@ -8,7 +8,7 @@
 # Avi Persin, Revision 2017-07-28
 
 """
-fetch.py [--help] [--list] [--force] [--store <dir>] [--config <file>] [pattern] ...
+fetch.py [--help] [--list] [--force] [--update] [--stream] [--jobs <n>] [--mirror <dir>] [--store <dir>] [--config <file>] [pattern] ...
 
 Script to fetch (download from the internet) the inputs required for
 the cccgistemp program.
@@ -30,6 +30,34 @@ matching item for each argument is fetched.
 
 Unless --force is set, no file that already exists is created.
 
+--update checks each file that already exists with the server (using
+the Last-Modified and ETag headers of the previous download), and
+fetches it again only if it has changed.  The GHCN file is looked for
+again in the server's directory listing, so that a new release is
+fetched.
+
+--jobs <n> sets the number of items fetched at once (default 4).
+
+--stream extracts the members of gzip and tar bundles as the bundle is
+downloaded, checking its checksum as it goes, without saving the
+bundle itself.
+
+Files are downloaded to a '.part' file, which is renamed once the
+download is complete; an interrupted HTTP download is resumed (using a
+Range request) the next time it is fetched.  The headers needed for
+this, and for --update, are kept in a manifest, '.fetch-manifest.json',
+alongside the downloaded files.
+
+--mirror <dir> (default: the GISTEMP_MIRROR environment variable)
+names a local mirror shared by several runs (each with its own --store
+directory).  Files are downloaded into the mirror, stored there by
+their sha256 digest, and hard linked (or copied) into the store.  Runs
+that fetch the same URL at the same time take turns, so the file is
+downloaded only once.
+
+tool/fetchcheck.py checks these kinds of download against an HTTP
+server on localhost.
+
 --list lists all things that can be fetched.
 
 The config file syntax is as follows:
@@ -85,20 +113,32 @@ The config file syntax is as follows:
 # http://www.python.org/doc/2.4.4/lib/module-getopt.html
 import getopt
 # http://docs.python.org/release/2.4.4/lib/module-os.html
+import os
 # http://www.python.org/doc/2.4.4/lib/module-sys.html
 import sys
 # https://docs.python.org/2.6/library/urllib2.html
+import urllib.error
 import urllib.request
 import ssl
 
+import contextlib
+import hashlib
 import itertools
+import json
 import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 from settings import *
+import settings
 
+import shutil
 import tarfile
 import zipfile
 
+# Buffer size used when streaming bundles.
+BUFSIZE = 1 << 20
+
 
 class Fetcher(object):
     def __init__(self, **kwargs):
@@ -106,36 +146,61 @@ class Fetcher(object):
         self.force = kwargs.pop('force', False)
         self.output = kwargs.pop('output', sys.stdout)
         self.output.write("Fetching Input Files:\n")
-        self.prefix = kwargs.pop('prefix', INPUT_DIR)
+        self.prefix = kwargs.pop('prefix', settings.workspace.input_dir)
         self.config_file = kwargs.pop('config_file', SOURCES_DIR + 'sources.txt')
         self.requests = kwargs.pop('requests', None)
+        self.update = kwargs.pop('update', False)
+        self.stream = kwargs.pop('stream', False)
+        mirror = kwargs.pop('mirror', MIRROR_DIR)
+        self.mirror = mirror and Mirror(mirror)
+        self.jobs = kwargs.pop('jobs', 4)
+        # How long (in seconds) a cached directory listing is used
+        # without checking it with the server.
+        self.listing_age = kwargs.pop('listing_age', 3600)
+        # Progress of each download is only shown when there is just
+        # one at a time.
+        self.progress = self.output if self.jobs <= 1 else None
+        self.manifest_lock = threading.Lock()
 
     def fetch(self):
         (bundles, files) = self.find_requests(self.requests)
+        tasks = []
         for url, local in files:
-            # first, check if ghcn file exists
+            # first, check if ghcn file exists (with --update or
+            # --force, the latest release is looked for anyway)
             if "ghcnm.tavg.qcf.dat" in url:
-                if not os.path.exists(INPUT_DIR + "ghcnm.tavg.qcf.dat"):
-                    self.get_ghcn_file(url)
+                if self.update or self.force or \
+                        not os.path.exists(os.path.join(self.prefix, "ghcnm.tavg.qcf.dat")):
+                    tasks.append((self.get_ghcn_file, url))
             else:
-                self.fetch_one(url, local)
+                tasks.append((self.fetch_one, url, local))
         for ((url, local), members) in bundles.items():
-            self.fetch_one(url, local, members=members)
+            tasks.append((self.fetch_one, url, local, members))
+        self.run_tasks(tasks)
         sys.stdout.flush()
 
+    def run_tasks(self, tasks):
+        """Run each of *tasks*, a (function, arg, ...) tuple, using up
+        to self.jobs threads.  The first exception raised by a task is
+        re-raised once all the tasks have finished."""
+
+        if self.jobs <= 1 or len(tasks) <= 1:
+            for task in tasks:
+                task[0](*task[1:])
+            return
+        with ThreadPoolExecutor(self.jobs) as pool:
+            futures = [pool.submit(*task) for task in tasks]
+        for future in futures:
+            future.result()
+
     # Get most recent GHCN data file
     def get_ghcn_file(self, url):
         public_dir = url.replace("ghcnm.tavg.qcf.dat", "")
         import datetime
-        import urllib.request as urllib
-        response = urllib.urlopen(public_dir)
-        html = response.read().decode()
-        filenames = re.findall(r'href=[\'"]?([^\'" >]+)', html)
-        ghcn_filenames = [x for x in filenames if x[-4:] == ".dat" and "v4" in x]
+        name = os.path.join(self.prefix, "ghcnm.tavg.qcf.dat")
+        self.make_prefix()
         last_modifieds = []
-        for file in ghcn_filenames:
-            conn = urllib.urlopen(public_dir + file)
-            last_modified = conn.headers["last-modified"]
+        for file, last_modified in self.ghcn_listing(public_dir, name):
             last_modified = datetime.datetime.strptime(last_modified[5:-4], '%d %b %Y %H:%M:%S')
             last_modifieds.append((file, last_modified))
         last_modifieds.sort(key=lambda x: x[1])
@@ -145,7 +210,54 @@ class Fetcher(object):
         else:
             qcf_file = recent_ghcn[1]
         print(qcf_file)
-        urllib.urlretrieve(public_dir + qcf_file, INPUT_DIR + "ghcnm.tavg.qcf.dat")
+        self.download(public_dir + qcf_file, name)
+
+    def ghcn_listing(self, public_dir, name):
+        """Return a list of (filename, last-modified header) pairs for
+        the GHCNv4 .dat files in the directory listing at *public_dir*.
+
+        The Last-Modified headers are found with HEAD requests, made
+        concurrently.  The result is cached in the manifest for the
+        file *name*, and reused for self.listing_age seconds (unless
+        self.update or self.force is set), or for as long as the server
+        reports that the listing has not changed.
+        """
+
+        import time
+
+        cached = self.manifest_entry(name, key=public_dir)
+        if 'files' in cached and not (self.update or self.force) and \
+                time.time() - cached.get('time', 0) < self.listing_age:
+            return cached['files']
+        request = urllib.request.Request(public_dir)
+        if cached.get('etag'):
+            request.add_header('If-None-Match', cached['etag'])
+        if cached.get('last_modified'):
+            request.add_header('If-Modified-Since', cached['last_modified'])
+        try:
+            response = urllib.request.urlopen(request)
+        except urllib.error.HTTPError as e:
+            if e.code == 304 and 'files' in cached:
+                cached['time'] = time.time()
+                self.save_manifest_entry(name, cached, key=public_dir)
+                return cached['files']
+            raise
+        html = response.read().decode()
+        filenames = re.findall(r'href=[\'"]?([^\'" >]+)', html)
+        ghcn_filenames = [x for x in filenames if x[-4:] == ".dat" and "v4" in x]
+
+        def last_modified(file):
+            head = urllib.request.Request(public_dir + file, method='HEAD')
+            with urllib.request.urlopen(head) as conn:
+                return conn.headers["last-modified"]
+
+        with ThreadPoolExecutor(max(1, min(8, len(ghcn_filenames)))) as pool:
+            files = list(zip(ghcn_filenames, pool.map(last_modified, ghcn_filenames)))
+        self.save_manifest_entry(name, dict(
+            etag=response.headers.get('ETag'),
+            last_modified=response.headers.get('Last-Modified'),
+            files=files, time=time.time()), key=public_dir)
+        return files
 
     def make_prefix(self):
         try:
@@ -344,27 +456,269 @@ class Fetcher(object):
         if os.path.exists(name) and os.path.getsize(name) == 0:
             self.output.write("%s is empty; removing it.\n" % name)
             os.remove(name)
-        if os.path.exists(name) and not self.force:
+        if members and self.stream and bundle_kind(name) in ('gzip', 'tar'):
+            self.make_prefix()
+            self.stream_bundle(url, name, members)
+            return
+        changed = False
+        if os.path.exists(name) and not self.force and not (
+                self.update and url.startswith('http')):
             self.output.write("%s already exists.\n" % name)
         else:
             self.make_prefix()
-            self.output.write("Fetching %s to %s\n" % (url, name))
-            # We have to set a User-Agent header in order to
-            # fetch GISTEMPv4_sources.tar.gz (the web server
-            # rejects the HTTP request otherwise). urllib2 does
-            # this, but urllib does not.
-            remote = urllib.request.urlopen(url)
-            # Check getcode(), but only for HTTP.
-            if remote.getcode() and remote.getcode() != 200:
-                raise Error(
-                    "Fetching %s to %s failed (status code %s)." %
-                    (url, name, remote.getcode()))
-            with open(name, 'wb') as out:
-                copy_progress(remote, out, self.output)
+            changed = self.download(url, name)
         if os.path.getsize(name) == 0:
             raise Error("%s is empty." % name)
         if members:
-            self.extract(name, members)
+            # When a bundle has changed its members are extracted
+            # again.
+            self.extract(name, members, force=self.force or changed)
+
+    def download(self, url, name):
+        """Download *url* to the file *name*, by way of the mirror if
+        there is one (see `Mirror.fetch`).
+
+        True is returned if the file was downloaded, False if the
+        server reports that it has not changed.
+        """
+
+        if self.mirror:
+            return self.mirror.fetch(self, url, name)
+        return self.download_direct(url, name)
+
+    def download_direct(self, url, name):
+        """Download *url* to the file *name*.  The download is made to
+        a '.part' file first, and resumed from that file if possible.
+        When *name* already exists and was downloaded from *url* the
+        server is asked to send it only if it has changed.
+
+        True is returned if the file was downloaded, False if the
+        server reports that it has not changed.
+        """
+
+        part = name + '.part'
+        entry = self.manifest_entry(name)
+        if entry.get('url') != url:
+            entry = {}
+        http = url.startswith('http')
+
+        # We have to set a User-Agent header in order to
+        # fetch GISTEMPv4_sources.tar.gz (the web server
+        # rejects the HTTP request otherwise). urllib2 does
+        # this, but urllib does not.
+        request = urllib.request.Request(url)
+        offset = 0
+        if http and entry.get('complete') and os.path.exists(name) and not self.force:
+            if entry.get('etag'):
+                request.add_header('If-None-Match', entry['etag'])
+            if entry.get('last_modified'):
+                request.add_header('If-Modified-Since', entry['last_modified'])
+        elif http and not entry.get('complete') and os.path.exists(part):
+            # Resume, provided the remote file is the same one that
+            # the partial download came from (If-Range).
+            validator = entry.get('etag')
+            if not validator or validator.startswith('W/'):
+                validator = entry.get('last_modified')
+            if validator:
+                offset = os.path.getsize(part)
+                request.add_header('Range', 'bytes=%d-' % offset)
+                request.add_header('If-Range', validator)
+
+        try:
+            remote = urllib.request.urlopen(request)
+        except urllib.error.HTTPError as e:
+            if e.code == 304:
+                self.output.write("%s is unchanged.\n" % name)
+                return False
+            if e.code == 416 and offset:
+                # The partial download is no use; start again.
+                os.remove(part)
+                return self.download_direct(url, name)
+            raise Error("Fetching %s to %s failed (status code %s)." %
+                        (url, name, e.code))
+        # Check getcode(), but only for HTTP.
+        code = remote.getcode()
+        if code == 206:
+            if not (offset and re.match(r'bytes %d-' % offset,
+                                        remote.headers.get('Content-Range', ''))):
+                # Not the part we asked for; start again.
+                remote.close()
+                os.remove(part)
+                return self.download_direct(url, name)
+            self.output.write("Resuming %s to %s at %d\n" % (url, name, offset))
+            mode = 'ab'
+        elif code and code != 200:
+            raise Error(
+                "Fetching %s to %s failed (status code %s)." %
+                (url, name, code))
+        else:
+            self.output.write("Fetching %s to %s\n" % (url, name))
+            offset = 0
+            mode = 'wb'
+            entry = dict(url=url,
+                         etag=remote.headers.get('ETag'),
+                         last_modified=remote.headers.get('Last-Modified'),
+                         complete=False)
+            self.save_manifest_entry(name, entry)
+        length = remote.headers.get('Content-Length')
+        with open(part, mode) as out:
+            copy_progress(remote, out, self.progress, offset)
+        remote.close()
+        # A connection closed early just ends the data, so the size is
+        # checked; the '.part' file is kept, to be resumed.
+        if length is not None and os.path.getsize(part) != offset + int(length):
+            raise Error("Fetching %s to %s: got %d bytes, expected %d." %
+                        (url, name, os.path.getsize(part), offset + int(length)))
+        os.replace(part, name)
+        entry['complete'] = True
+        self.save_manifest_entry(name, entry)
+        return True
+
+    def stream_bundle(self, url, name, members):
+        """Fetch the bundle *url*, a gzip file or a (possibly
+        compressed) tar file, and extract *members* from it as it is
+        downloaded; the bundle itself is not saved.  The gzip (or
+        bzip2) checksums are checked as the data is decompressed, and
+        the sha256 digest of the bundle is recorded in the manifest
+        entry for *name*.
+        """
+
+        kind = bundle_kind(name)
+        if kind == 'gzip':
+            if len(members) > 1:
+                raise Error("Simple compressed file, %r, is only allowed exactly one member", name)
+            if not members:
+                basename = name.split('/')[-1]
+                # remove final extension (should be '.gz')
+                members.append(('.'.join(basename.split('.')[:-1]), None))
+            targets = [os.path.join(self.prefix, members[0][0])]
+        elif all(local is not None for _, local in members):
+            targets = [os.path.join(self.prefix, local.strip()) for _, local in members]
+        else:
+            # The names of the members are only known once the bundle
+            # has been read (they are kept in the manifest entry).
+            targets = None
+
+        entry = self.manifest_entry(name)
+        if entry.get('url') != url or not entry.get('streamed'):
+            entry = {}
+        if targets is None and entry.get('targets'):
+            targets = [os.path.join(self.prefix, target)
+                       for target in entry['targets']]
+        request = urllib.request.Request(url)
+        if targets and all(os.path.exists(target) and os.path.getsize(target)
+                           for target in targets) and not self.force:
+            if not (self.update and url.startswith('http') and entry):
+                for target in targets:
+                    self.output.write("  ... %s already exists.\n" % target)
+                return
+            if entry.get('etag'):
+                request.add_header('If-None-Match', entry['etag'])
+            if entry.get('last_modified'):
+                request.add_header('If-Modified-Since', entry['last_modified'])
+
+        try:
+            remote = urllib.request.urlopen(request)
+        except urllib.error.HTTPError as e:
+            if e.code == 304:
+                self.output.write("%s is unchanged.\n" % url)
+                return
+            raise Error("Fetching %s failed (status code %s)." % (url, e.code))
+        if remote.getcode() and remote.getcode() != 200:
+            raise Error("Fetching %s failed (status code %s)." % (url, remote.getcode()))
+        self.output.write("Streaming %s\n" % url)
+        source = ChecksumReader(remote)
+        if kind == 'gzip':
+            import gzip
+
+            local = os.path.join(self.prefix, members[0][0])
+            with gzip.GzipFile(fileobj=source) as inp:
+                self.output.write("  ... %s.\n" % local)
+                copy_to_file(inp, local)
+            targets = [local]
+        else:
+            targets = self.stream_tar(source, name, members)
+        # Read anything after the end of the compressed data (such as
+        # padding), so that the digest covers the whole bundle.
+        while source.read(BUFSIZE):
+            pass
+        remote.close()
+
+        length = remote.headers.get('Content-Length')
+        if length is not None and int(length) != source.size:
+            raise Error("Fetching %s: got %d bytes, expected %s." %
+                        (url, source.size, length))
+        self.save_manifest_entry(name, dict(
+            url=url,
+            etag=remote.headers.get('ETag'),
+            last_modified=remote.headers.get('Last-Modified'),
+            sha256=source.sha256.hexdigest(),
+            size=source.size,
+            targets=[os.path.basename(target) for target in targets],
+            complete=True,
+            streamed=True))
+
+    def stream_tar(self, source, name, members):
+        """Extract *members* from the tar file read from the stream
+        *source*; *name* is the bundle's name, which gives its
+        compression.  Returns the list of the files extracted."""
+
+        import bz2
+        import gzip
+
+        exts = name.split('.')
+        if exts[-1] in 'gz tgz'.split():
+            inp = gzip.GzipFile(fileobj=source)
+        elif exts[-1] in 'bz bz2 tbz tbz2'.split():
+            inp = bz2.BZ2File(source)
+        else:
+            inp = source
+        tar = tarfile.open(fileobj=inp, mode='r|', bufsize=BUFSIZE)
+        extracted = []
+        for info in tar:
+            matches = [member for member in members if re.search(member[0] + '$', info.name)]
+            if matches:
+                if len(matches) > 1:
+                    raise Error("Multiple patterns match '%s': %s" % (info.name, matches))
+                members.remove(matches[0])
+                local = matches[0][1]
+                if local is None:
+                    local = info.name.split('/')[-1]
+                local = os.path.join(self.prefix, local.strip())
+                self.output.write("  ... %s from %s.\n" % (local, info.name))
+                copy_to_file(tar.extractfile(info), local)
+                extracted.append(local)
+        tar.close()
+        # Reading to the end checks the checksum.
+        while inp.read(BUFSIZE):
+            pass
+        if members:
+            raise Error("Couldn't find these members in '%s': %s" % (name, [member[0] for member in members]))
+        return extracted
+
+    def manifest_entry(self, name, key=None):
+        """The manifest entry, a dict, for the downloaded file *name*.
+        *key* selects a different entry in the same manifest."""
+
+        with self.manifest_lock:
+            return dict(self.read_manifest(name).get(key or os.path.basename(name), {}))
+
+    def save_manifest_entry(self, name, entry, key=None):
+        with self.manifest_lock:
+            manifest = self.read_manifest(name)
+            manifest[key or os.path.basename(name)] = entry
+            path = manifest_path(name)
+            with open(path + '.tmp', 'w') as f:
+                json.dump(manifest, f, indent=1, sort_keys=True)
+            os.replace(path + '.tmp', path)
+
+    @staticmethod
+    def read_manifest(name):
+        try:
+            with open(manifest_path(name)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
 
     def ftpmatch(self, host, path, pattern, local, members):
         regexp = re.compile(pattern)
@@ -383,20 +737,20 @@ class Fetcher(object):
         path = path.strip('/')
         self.fetch_url('ftp://%s/%s/%s' % (host, path, remotename), local, members)
 
-    def extract(self, name, members):
-        exts = name.split('.')
-        if exts[-1] in 'gz bz bz2'.split():
-            exts = exts[:-1]
-        if exts[-1] in 'tar tgz tbz tbz2'.split():
-            self.extract_tar(name, members)
-        elif exts[-1] in 'zip'.split():
-            self.extract_zip(name, members)
-        elif name.endswith('.gz'):
-            self.extract_gzip(name, members)
+    def extract(self, name, members, force=None):
+        if force is None:
+            force = self.force
+        kind = bundle_kind(name)
+        if kind == 'tar':
+            self.extract_tar(name, members, force)
+        elif kind == 'zip':
+            self.extract_zip(name, members, force)
+        elif kind == 'gzip':
+            self.extract_gzip(name, members, force)
         else:
             raise Error("Can't extract members from this type of file: %r", name)
 
-    def extract_tar(self, archive, members):
+    def extract_tar(self, archive, members, force=False):
         """
         `archive` is the name of a tar file (possibly
         compressed). `members` is a list of members to extract
@@ -421,7 +775,7 @@ class Fetcher(object):
                 if local is None:
                     local = info.name.split('/')[-1]
                 local = os.path.join(self.prefix, local.strip())
-                if os.path.exists(local) and not self.force:
+                if os.path.exists(local) and not force:
                     self.output.write("  ... %s already exists.\n" % local)
                 else:
                     self.make_prefix()
@@ -439,7 +793,7 @@ class Fetcher(object):
         if members:
             raise Error("Couldn't find these members in '%s': %s" % (archive, [member[0] for member in members]))
 
-    def extract_zip(self, name, members):
+    def extract_zip(self, name, members, force=False):
         z = zipfile.ZipFile(name)
         for entry in z.namelist():
             matches = [member for member in members if re.search(member[0] + '$', entry)]
@@ -451,7 +805,7 @@ class Fetcher(object):
                 if local is None:
                     local = entry.split('/')[-1]
                 local = os.path.join(self.prefix, local.strip())
-                if os.path.exists(local) and not self.force:
+                if os.path.exists(local) and not force:
                     self.output.write("  ... %s already exists.\n" % local)
                 else:
                     self.make_prefix()
@@ -469,7 +823,7 @@ class Fetcher(object):
         if members:
             raise Error("Couldn't find these members in '%s': %s" % (name, [member[0] for member in members]))
 
-    def extract_gzip(self, name, members):
+    def extract_gzip(self, name, members, force=False):
         import gzip
         import shutil
 
@@ -487,7 +841,7 @@ class Fetcher(object):
         if os.path.exists(local) and os.path.getsize(local) == 0:
             self.output.write("%s is empty; removing it.\n" % local)
             os.remove(local)
-        if os.path.exists(local) and not self.force:
+        if os.path.exists(local) and not force:
             self.output.write("  ... %s already exists.\n" % local)
             return
 
@@ -499,11 +853,13 @@ class Fetcher(object):
         out.close()
 
 
-def copy_progress(source, destination, progress):
+def copy_progress(source, destination, progress, got=0):
     """
     Copy the contents of open readable stream `source` to open
     writable stream `destination`. Progress is written to the
-    open writable stream `progress`.
+    open writable stream `progress` (if it is not None).  `got` is
+    the number of bytes already in `destination`, when resuming a
+    download.
 
     Typically `source` will be a remote file fetched with
     urllib2.urlopen, and `destination` will be a local disk
@@ -511,29 +867,204 @@ def copy_progress(source, destination, progress):
     """
 
     try:
-        content_length = int(source.info()['Content-Length'])
+        content_length = got + int(source.info()['Content-Length'])
     except (AttributeError, KeyError, TypeError, ValueError):
         content_length = None
 
-    got = 0
     while True:
         chunk = source.read(8000)
         got += len(chunk)
-        if content_length is not None:
-            outof = '/%d [%d%%]' % (
-                content_length, 100 * got // content_length)
-        else:
-            outof = ''
-        progress.write("\r  %d%s" % (got, outof))
+        if progress is not None:
+            if content_length:
+                outof = '/%d [%d%%]' % (
+                    content_length, 100 * got // content_length)
+            else:
+                outof = ''
+            progress.write("\r  %d%s" % (got, outof))
         if not chunk:
             break
         destination.write(chunk)
 
-    progress.write('\n')
-    progress.flush()
+    if progress is not None:
+        progress.write('\n')
+        progress.flush()
     return 0
 
 
+class Mirror(object):
+    """A local mirror of fetched files, in the directory *path*, that
+    can be shared by many runs on the same host.  It contains:
+
+    objects/<xx>/<sha256>
+        the files, stored by the sha256 digest of their contents (xx
+        is the first 2 digits of the digest);
+    index.json
+        a map from each URL to the digest of its latest download;
+    downloads/<key>/
+        the latest download of each URL (see `Fetcher.download_direct`);
+    locks/
+        lock files.
+
+    The index, and each URL, is protected by its own lock (using
+    flock), so any number of processes can share a mirror.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def fetch(self, fetcher, url, name):
+        """Fetch *url* into the mirror (using *fetcher*), unless it is
+        already there, and link it to *name*.  The file is downloaded
+        again only when *fetcher* has its force or update flags set.
+        While the URL is being fetched any other process fetching it
+        waits; then it finds it in the mirror.
+
+        True is returned if *name* has changed.
+        """
+
+        key = hashlib.sha256(url.encode()).hexdigest()[:32]
+        with self.lock('url-' + key):
+            entry = self.index().get(url, {})
+            obj = entry.get('sha256') and self.object_path(entry['sha256'])
+            if not (obj and os.path.exists(obj)) or fetcher.force or fetcher.update:
+                stored = os.path.join(self.path, 'downloads', key, url.split('/')[-1])
+                make_dirs(os.path.dirname(stored))
+                changed = fetcher.download_direct(url, stored)
+                if changed or not (obj and os.path.exists(obj)):
+                    obj = self.store(url, stored)
+            else:
+                fetcher.output.write("%s is in the mirror.\n" % url)
+            if os.path.exists(name) and os.path.samefile(name, obj):
+                return False
+            link_or_copy(obj, name)
+            return True
+
+    def store(self, url, path):
+        """Add the file *path* to the objects, and record it as the
+        latest download of *url*.  The object's path is returned."""
+
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(BUFSIZE), b''):
+                digest.update(chunk)
+        digest = digest.hexdigest()
+        obj = self.object_path(digest)
+        if not os.path.exists(obj):
+            make_dirs(os.path.dirname(obj))
+            link_or_copy(path, obj)
+            # Objects are shared (as hard links) so must not be changed.
+            os.chmod(obj, 0o444)
+        with self.lock('index'):
+            index = self.index()
+            index[url] = dict(sha256=digest, size=os.path.getsize(obj))
+            path = os.path.join(self.path, 'index.json')
+            with open(path + '.tmp', 'w') as f:
+                json.dump(index, f, indent=1, sort_keys=True)
+            os.replace(path + '.tmp', path)
+        return obj
+
+    def index(self):
+        try:
+            with open(os.path.join(self.path, 'index.json')) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def object_path(self, digest):
+        return os.path.join(self.path, 'objects', digest[:2], digest)
+
+    @contextlib.contextmanager
+    def lock(self, name):
+        """Hold the lock *name* (exclusively) for the duration of the
+        with statement."""
+
+        import fcntl
+
+        make_dirs(os.path.join(self.path, 'locks'))
+        with open(os.path.join(self.path, 'locks', name), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def make_dirs(path):
+    try:
+        os.makedirs(path)
+    except OSError:
+        # Expected if the directories already exist.
+        pass
+
+
+def link_or_copy(source, name):
+    """Make *name* a hard link to the file *source*, or a copy of it
+    if a link cannot be made (for example, when they are on different
+    file systems).  An existing *name* is replaced."""
+
+    temp = name + '.link'
+    if os.path.exists(temp):
+        os.remove(temp)
+    try:
+        os.link(source, temp)
+    except OSError:
+        shutil.copyfile(source, temp)
+    os.replace(temp, name)
+
+
+class ChecksumReader(object):
+    """A readable stream that passes on the data read from *source*,
+    keeping its sha256 digest and its size."""
+
+    def __init__(self, source):
+        self.source = source
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def read(self, n=-1):
+        data = self.source.read(n)
+        self.sha256.update(data)
+        self.size += len(data)
+        return data
+
+
+def copy_to_file(source, name):
+    """Copy the readable stream *source* to the file *name*.  The data
+    are written to a '.part' file, which replaces *name* once all the
+    data have been copied."""
+
+    try:
+        with open(name + '.part', 'wb') as out:
+            shutil.copyfileobj(source, out, BUFSIZE)
+    except:
+        os.remove(name + '.part')
+        raise
+    os.replace(name + '.part', name)
+
+
+def bundle_kind(name):
+    """The kind of the bundle *name*: 'tar', 'zip', or 'gzip' (or None,
+    if it is none of these).  See `Fetcher.extract`."""
+
+    exts = name.split('.')
+    if exts[-1] in 'gz bz bz2'.split():
+        exts = exts[:-1]
+    if exts[-1] in 'tar tgz tbz tbz2'.split():
+        return 'tar'
+    if exts[-1] in 'zip'.split():
+        return 'zip'
+    if name.endswith('.gz'):
+        return 'gzip'
+    return None
+
+
+def manifest_path(name):
+    """The manifest that records how the file *name* was downloaded
+    (see `Fetcher.download`)."""
+
+    return os.path.join(os.path.dirname(name), '.fetch-manifest.json')
+
+
 class Error(Exception):
     """Some sort of problem with fetch."""
 
@@ -551,7 +1082,8 @@ def main(argv=None):
     kwargs = dict()
     try:
         try:
-            opts, args = getopt.getopt(argv[1:], "", ["help", "list", "force", "store=", "config="])
+            opts, args = getopt.getopt(argv[1:], "", ["help", "list", "force", "update", "stream", "jobs=", "mirror=",
+                                                      "store=", "config="])
             for o, a in opts:
                 if o in ('--help',):
                     print(__doc__)
@@ -560,6 +1092,17 @@ def main(argv=None):
                     write_list = True
                 if o == '--force':
                     kwargs.update(force=True)
+                if o == '--update':
+                    kwargs.update(update=True)
+                if o == '--stream':
+                    kwargs.update(stream=True)
+                if o == '--mirror':
+                    kwargs.update(mirror=a)
+                if o == '--jobs':
+                    try:
+                        kwargs.update(jobs=int(a))
+                    except ValueError:
+                        raise Usage("--jobs needs a number, not %r" % a)
                 if o == '--config':
                     kwargs.update(config_file=a)
                 if o == '--store':
@@ -0,0 +1,504 @@
+#!/usr/local/bin/python3.4
+#
+# fetchcheck.py -- check tool/fetch.py against a local HTTP server
+
+"""fetchcheck.py [options] -- check the downloads made by tool/fetch.py,
+using an HTTP server on localhost (so no network is needed).
+Options:
+   --help         Print this text.
+   --verbose      Print the output of each run of fetch.py.
+   --keep         Keep the temporary directory of the checks (its name
+                  is printed).
+
+The server (see `Server`) sends ETag and Last-Modified headers, answers
+If-None-Match with 304, and Range requests (with If-Range) with 206; it
+can also be told to cut a download short, or to send it slowly.  Each
+check runs fetch.py (as a separate process, with --config and --store
+in the temporary directory) and looks at the files it makes and the
+requests the server saw:
+
+fetch       a file and a gzip bundle are downloaded, and the bundle's
+            member extracted;
+unchanged   --update gets 304 and leaves the files alone;
+changed     --update downloads a file that has changed;
+ghcn        the GHCN file is found in a directory listing, and --update
+            gets 304 for it, until a new release is listed, which it
+            downloads;
+resume      a download that was cut short is resumed with a Range
+            request;
+if-range    ... unless the file has changed since, when it is
+            downloaded again from the start;
+stream      --stream extracts the members of a gzip bundle and a tar
+            bundle without saving the bundles, and records their
+            digests (and --update then gets 304);
+mirror      several runs started at once with the same --mirror (and
+            their own --store) download the file only once.
+
+The exit status is the number of checks that failed.
+"""
+
+import email.utils
+import gzip
+import hashlib
+import http.server
+import io
+import json
+import os
+import re
+import shutil
+import socketserver
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+
+# The root of the project, which fetch.py needs on sys.path.
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn,
+                          http.server.HTTPServer):
+    daemon_threads = True
+
+
+class Server(object):
+    """An HTTP server on localhost, in a thread of its own, for the
+    files in the dict *files* (mapping a path such as '/pub/data.txt' to
+    its contents); change them with `put`.
+
+    :Ivar cut:
+        Dict mapping a path to a number of bytes: the next GET of the
+        path is cut short (the connection is closed) after them.
+    :Ivar delay:
+        Dict mapping a path to the time (in seconds) to wait before
+        sending its contents.
+    :Ivar requests:
+        List of the requests seen, each a tuple of the method, the
+        path, the status sent, and the Range header (or None).
+    """
+
+    def __init__(self):
+        self.files = {}
+        self.modified = {}
+        self.cut = {}
+        self.delay = {}
+        self.requests = []
+        self.lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), self.handler())
+        self.thread = threading.Thread(target=self.httpd.serve_forever,
+                                       daemon=True)
+        self.thread.start()
+
+    def url(self, path):
+        return 'http://127.0.0.1:%d%s' % (self.httpd.server_port, path)
+
+    def put(self, path, data, modified=None):
+        """Make *data* the contents of *path*, modified at the time
+        *modified* (by default, now, so that it gets a new Last-Modified
+        header as well as a new ETag)."""
+        with self.lock:
+            self.files[path] = data
+            if modified is None:
+                # Last-Modified has a resolution of one second.
+                modified = max(time.time(), self.modified.get(path, 0) + 1)
+            self.modified[path] = modified
+
+    def gets(self, path):
+        """The requests for *path* seen so far, as (status, range)
+        pairs."""
+        with self.lock:
+            return [(status, range_) for method, p, status, range_
+                    in self.requests if method == 'GET' and p == path]
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def handler(self):
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_HEAD(self):
+                self.respond(body=False)
+
+            def do_GET(self):
+                self.respond(body=True)
+
+            def respond(self, body):
+                with server.lock:
+                    data = server.files.get(self.path)
+                    modified = server.modified.get(self.path)
+                    cut = body and server.cut.pop(self.path, None)
+                    delay = server.delay.get(self.path, 0)
+                range_ = self.headers.get('Range')
+                status, start = self.status(data, modified, range_)
+                with server.lock:
+                    server.requests.append((self.command, self.path,
+                                            status, range_))
+                self.send_response(status)
+                if data is None or status in (304, 416):
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                self.send_header('ETag', etag(data))
+                self.send_header('Last-Modified',
+                                 email.utils.formatdate(modified, usegmt=True))
+                if status == 206:
+                    self.send_header('Content-Range', 'bytes %d-%d/%d' %
+                                     (start, len(data) - 1, len(data)))
+                self.send_header('Content-Length', str(len(data) - start))
+                self.end_headers()
+                if not body:
+                    return
+                time.sleep(delay)
+                data = data[start:]
+                if cut is not None:
+                    self.wfile.write(data[:cut])
+                    self.wfile.flush()
+                    self.close_connection = True
+                    return
+                self.wfile.write(data)
+
+            def status(self, data, modified, range_):
+                """The status of the response, and the offset of the
+                first byte to send."""
+
+                if data is None:
+                    return 404, 0
+                if self.headers.get('If-None-Match') == etag(data):
+                    return 304, 0
+                m = range_ and re.match(r'bytes=(\d+)-$', range_)
+                if not m:
+                    return 200, 0
+                validator = self.headers.get('If-Range')
+                if validator not in (None, etag(data),
+                                     email.utils.formatdate(modified,
+                                                            usegmt=True)):
+                    # The file has changed: send all of it.
+                    return 200, 0
+                start = int(m.group(1))
+                if start >= len(data):
+                    return 416, 0
+                return 206, start
+
+        return Handler
+
+
+def etag(data):
+    return '"%s"' % hashlib.sha256(data).hexdigest()[:16]
+
+
+def gzipped(data):
+    out = io.BytesIO()
+    with gzip.GzipFile(fileobj=out, mode='wb', mtime=0) as f:
+        f.write(data)
+    return out.getvalue()
+
+
+def tarred(members):
+    """A gzipped tar file of *members*, a dict mapping each name to its
+    contents."""
+    out = io.BytesIO()
+    with tarfile.open(fileobj=out, mode='w:gz') as tar:
+        for name, data in sorted(members.items()):
+            info = tarfile.TarInfo('bundle/' + name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return out.getvalue()
+
+
+def lines(first, count):
+    return b''.join(b'%07d\n' % i for i in range(first, first + count))
+
+
+class Failure(Exception):
+    """A check has failed."""
+
+
+def expect(condition, message):
+    if not condition:
+        raise Failure(message)
+
+
+def read(name):
+    with open(name, 'rb') as f:
+        return f.read()
+
+
+# The checks (the methods of `Checks`), in the order they are made.
+CHECKS = ['fetch', 'unchanged', 'changed', 'ghcn', 'resume', 'if_range',
+          'stream', 'mirror']
+
+
+class Checks(object):
+    """The checks, made in order (each may depend on the ones before)
+    in the directory *directory*."""
+
+    def __init__(self, directory, verbose=False):
+        self.directory = directory
+        self.verbose = verbose
+        self.server = Server()
+        self.server.put('/pub/data.txt', lines(0, 50000))
+        self.member = lines(1000000, 20000)
+        self.server.put('/pub/member.txt.gz', gzipped(self.member))
+        self.tar_members = {'a.txt': lines(2000000, 1000),
+                            'b.txt': lines(3000000, 3000)}
+        self.server.put('/pub/bundle.tar.gz', tarred(self.tar_members))
+
+    def path(self, *names):
+        return os.path.join(self.directory, *names)
+
+    def config(self, name, *items):
+        """Write the fetch.py config file *name*, with a line for each
+        of *items* (a 'file:', 'bundle:' or 'member:' keyword and a
+        path, which for 'file:' and 'bundle:' is made into a URL).
+        Returns its path."""
+        path = self.path(name + '.config')
+        with open(path, 'w') as f:
+            for keyword, value in items:
+                if keyword != 'member':
+                    value = self.server.url(value)
+                f.write('%s: %s\n' % (keyword, value))
+        return path
+
+    def start(self, config, store, *args):
+        """Start fetch.py, with the --config *config*, the --store
+        *store* (a directory in *directory*), and the options *args*."""
+        env = dict(os.environ)
+        env.pop('GISTEMP_MIRROR', None)
+        env['PYTHONPATH'] = os.pathsep.join(
+            [ROOT] + [p for p in env.get('PYTHONPATH', '').split(os.pathsep) if p])
+        command = [sys.executable, os.path.join(ROOT, 'tool', 'fetch.py'),
+                   '--config', config, '--store', self.path(store) + '/'] + list(args)
+        return subprocess.Popen(command, cwd=ROOT, env=env,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT)
+
+    def finish(self, process, ok=True):
+        """Wait for the fetch.py *process*, and return its output.  Its
+        exit status must be zero if *ok* is True, and non-zero if it
+        is False."""
+        output = process.communicate()[0].decode(errors='replace')
+        if self.verbose:
+            print(output.rstrip())
+        if ok:
+            expect(process.returncode == 0,
+                   "fetch.py failed:\n" + output)
+        else:
+            expect(process.returncode != 0,
+                   "fetch.py should have failed:\n" + output)
+        return output
+
+    def fetch(self, config, store, *args, ok=True):
+        return self.finish(self.start(config, store, *args), ok)
+
+    def manifest(self, store):
+        with open(self.path(store, '.fetch-manifest.json')) as f:
+            return json.load(f)
+
+    def check_fetch(self):
+        config = self.config('plain', ('file', '/pub/data.txt'),
+                             ('bundle', '/pub/member.txt.gz'),
+                             ('member', 'member.txt'))
+        self.fetch(config, 'plain')
+        expect(read(self.path('plain', 'data.txt')) ==
+               self.server.files['/pub/data.txt'], "data.txt differs")
+        expect(read(self.path('plain', 'member.txt')) == self.member,
+               "member.txt differs")
+        entry = self.manifest('plain')['data.txt']
+        expect(entry.get('complete') and entry.get('etag') ==
+               etag(self.server.files['/pub/data.txt']),
+               "bad manifest entry %r" % entry)
+        expect(self.server.gets('/pub/data.txt') == [(200, None)],
+               "requests %r" % self.server.gets('/pub/data.txt'))
+
+    def check_unchanged(self):
+        before = os.stat(self.path('plain', 'data.txt')).st_mtime_ns
+        output = self.fetch(self.path('plain.config'), 'plain', '--update')
+        expect(self.server.gets('/pub/data.txt')[-1][0] == 304,
+               "requests %r" % self.server.gets('/pub/data.txt'))
+        expect('is unchanged' in output, "no 'is unchanged' in output")
+        expect(os.stat(self.path('plain', 'data.txt')).st_mtime_ns == before,
+               "data.txt was written again")
+
+    def check_changed(self):
+        self.server.put('/pub/data.txt', lines(100, 50000))
+        self.fetch(self.path('plain.config'), 'plain', '--update')
+        expect(self.server.gets('/pub/data.txt')[-1][0] == 200,
+               "requests %r" % self.server.gets('/pub/data.txt'))
+        expect(read(self.path('plain', 'data.txt')) ==
+               self.server.files['/pub/data.txt'], "data.txt differs")
+
+    def ghcn_release(self, date, data, modified):
+        """Add a GHCN release to the directory /ghcn/: a qcu file and a
+        qcf file (with the contents *data*), named for *date* (such as
+        '20261001') and modified at the time *modified*."""
+        for kind in ['qcu', 'qcf']:
+            self.server.put('/ghcn/ghcnm.tavg.v4.0.1.%s.%s.dat' % (date, kind),
+                            data, modified)
+        names = sorted(path[6:] for path in self.server.files
+                       if path.startswith('/ghcn/') and path.endswith('.dat'))
+        self.server.put('/ghcn/', ''.join('<a href="%s">%s</a>\n' % (name, name)
+                                          for name in names).encode())
+
+    def check_ghcn(self):
+        config = self.config('ghcn', ('file', '/ghcn/ghcnm.tavg.qcf.dat'))
+        name = self.path('ghcn', 'ghcnm.tavg.qcf.dat')
+        old = '/ghcn/ghcnm.tavg.v4.0.1.20261001.qcf.dat'
+        self.ghcn_release('20261001', lines(4000000, 10000), time.time() - 3600)
+        self.fetch(config, 'ghcn')
+        expect(read(name) == self.server.files[old], "the GHCN file differs")
+        self.fetch(config, 'ghcn', '--update')
+        expect(self.server.gets(old)[-1][0] == 304,
+               "requests %r" % self.server.gets(old))
+        new = '/ghcn/ghcnm.tavg.v4.0.1.20261101.qcf.dat'
+        self.ghcn_release('20261101', lines(5000000, 10000), time.time())
+        self.fetch(config, 'ghcn', '--update')
+        expect(self.server.gets(new) == [(200, None)],
+               "requests %r" % self.server.gets(new))
+        expect(read(name) == self.server.files[new],
+               "the GHCN file is not the new release")
+
+    def interrupted(self, store, cut):
+        """Run fetch.py for data.txt with a download that is cut short
+        after *cut* bytes; returns the size of the partial download."""
+        config = self.config(store, ('file', '/pub/data.txt'))
+        self.server.cut['/pub/data.txt'] = cut
+        self.fetch(config, store, ok=False)
+        part = self.path(store, 'data.txt.part')
+        expect(os.path.exists(part), "no data.txt.part")
+        expect(not os.path.exists(self.path(store, 'data.txt')),
+               "data.txt was made from an incomplete download")
+        size = os.path.getsize(part)
+        expect(0 < size <= cut, "data.txt.part has %d bytes" % size)
+        return config, size
+
+    def check_resume(self):
+        config, size = self.interrupted('resume', 100000)
+        output = self.fetch(config, 'resume')
+        expect(self.server.gets('/pub/data.txt')[-1] ==
+               (206, 'bytes=%d-' % size),
+               "requests %r" % self.server.gets('/pub/data.txt'))
+        expect('Resuming' in output, "no 'Resuming' in output")
+        expect(read(self.path('resume', 'data.txt')) ==
+               self.server.files['/pub/data.txt'], "data.txt differs")
+        expect(not os.path.exists(self.path('resume', 'data.txt.part')),
+               "data.txt.part was left")
+
+    def check_if_range(self):
+        config, size = self.interrupted('if-range', 100000)
+        self.server.put('/pub/data.txt', lines(200, 50000))
+        self.fetch(config, 'if-range')
+        expect(self.server.gets('/pub/data.txt')[-1] ==
+               (200, 'bytes=%d-' % size),
+               "requests %r" % self.server.gets('/pub/data.txt'))
+        expect(read(self.path('if-range', 'data.txt')) ==
+               self.server.files['/pub/data.txt'], "data.txt differs")
+
+    def check_stream(self):
+        config = self.config('stream', ('bundle', '/pub/member.txt.gz'),
+                             ('member', 'member.txt'),
+                             ('bundle', '/pub/bundle.tar.gz'),
+                             ('member', 'a.txt'), ('member', 'b.txt'))
+        self.fetch(config, 'stream', '--stream')
+        expect(read(self.path('stream', 'member.txt')) == self.member,
+               "member.txt differs")
+        for name, data in self.tar_members.items():
+            expect(read(self.path('stream', name)) == data,
+                   "%s differs" % name)
+        manifest = self.manifest('stream')
+        for name in ['member.txt.gz', 'bundle.tar.gz']:
+            expect(not os.path.exists(self.path('stream', name)),
+                   "the bundle %s was saved" % name)
+            entry = manifest.get(name, {})
+            digest = hashlib.sha256(self.server.files['/pub/' + name]).hexdigest()
+            expect(entry.get('streamed') and entry.get('sha256') == digest,
+                   "bad manifest entry %r" % entry)
+        self.fetch(config, 'stream', '--stream', '--update')
+        for name in ['member.txt.gz', 'bundle.tar.gz']:
+            requests = self.server.gets('/pub/' + name)
+            expect(requests[-1][0] == 304,
+                   "requests for %s %r" % (name, requests))
+
+    def check_mirror(self):
+        config = self.config('mirror', ('file', '/pub/data.txt'))
+        mirror = self.path('mirror')
+        before = len(self.server.gets('/pub/data.txt'))
+        # The download is slow, so the runs overlap.
+        self.server.delay['/pub/data.txt'] = 1.0
+        try:
+            processes = [self.start(config, 'store%d' % i, '--mirror', mirror)
+                         for i in range(3)]
+            for process in processes:
+                self.finish(process)
+        finally:
+            del self.server.delay['/pub/data.txt']
+        expect(len(self.server.gets('/pub/data.txt')) == before + 1,
+               "requests %r" % self.server.gets('/pub/data.txt')[before:])
+        names = [self.path('store%d' % i, 'data.txt') for i in range(3)]
+        for name in names:
+            expect(read(name) == self.server.files['/pub/data.txt'],
+                   "%s differs" % name)
+        expect(all(os.path.samefile(names[0], name) for name in names),
+               "the stores do not share the mirror's file")
+
+    def run(self):
+        """Make the checks, printing the result of each.  Returns the
+        number that failed."""
+        failed = 0
+        for name in CHECKS:
+            try:
+                getattr(self, 'check_' + name)()
+            except Failure as e:
+                failed += 1
+                print("FAIL %s: %s" % (name, e))
+            except Exception as e:
+                failed += 1
+                print("FAIL %s: %s: %s" % (name, type(e).__name__, e))
+            else:
+                print("ok   %s" % name)
+        return failed
+
+    def close(self):
+        self.server.close()
+
+
+def parse_options(arglist):
+    import optparse
+
+    usage = "usage: %prog [options]"
+    parser = optparse.OptionParser(usage)
+    parser.add_option("--verbose", action="store_true", default=False,
+                      help="Print the output of each run of fetch.py")
+    parser.add_option("--keep", action="store_true", default=False,
+                      help="Keep the temporary directory")
+    options, args = parser.parse_args(arglist)
+    if len(args) != 0:
+        parser.error("Unexpected arguments")
+    return options, args
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+    options, args = parse_options(argv[1:])
+    directory = tempfile.mkdtemp(prefix='fetchcheck.')
+    checks = Checks(directory, verbose=options.verbose)
+    try:
+        failed = checks.run()
+    finally:
+        checks.close()
+        if options.keep:
+            print("The files are in %s" % directory)
+        else:
+            shutil.rmtree(directory)
+    return failed
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,37 +1,154 @@
-from settings import *
-import os
-
-
-# This method is used to generate the nigh time brightness index.
-# It expects wrld-rad.data.txt and v4.inv to be in the /tmp/input dir.
-# The resulting file v4.inv will be placed in the /tmp/input dir as well.
-def run():
-    night_file = open(INPUT_DIR + 'wrld-rad.data.txt', 'r')
-    inv_file = open(INPUT_DIR + 'v4.inv', 'r')
-    new_inv = open(INPUT_DIR + 'v4_tmp.inv', 'w+')
-    i_j_dict = {}
-    for line in night_file:
-        line = line.split()
-        i = line[0]
-        j = line[1]
-        i_j = (i, j)
-        i_j_dict[i_j] = line[2]
-
-    for line in inv_file:
-        inv_line = line.split()
-        lon = inv_line[2]
-        lat = inv_line[1]
-        search_i = str(round((float(lon) + 180) * 120 + 1))
-        search_j = str(round((21600 + .5 - (float(lat) + 90) * 120)))
-        if int(search_j) >= 21600:
-            search_j = '21600'
-        if int(search_i) >= 43200:
-            search_i = '1'
-        try:
-            new_inv.write(line.replace('\n', ' ' + i_j_dict[(search_i, search_j)]) + "     " + '\n')
-        except:
-            new_inv.write(line.replace('\n', ' ' + '0' + '     ' + '\n'))
-    inv_file.close()
-    new_inv.close()
-    os.remove(INPUT_DIR + "v4.inv")
-    os.rename(INPUT_DIR + "v4_tmp.inv", INPUT_DIR + "v4.inv")
+from settings import *
+import settings
+import contextlib
+import os
+import stat
+import tempfile
+
+import numpy as np
+
+# The radiance grid is 43200 (longitude, i) by 21600 (latitude, j)
+# pixels, numbered from 1.
+NI = 43200
+NJ = 21600
+
+
+@contextlib.contextmanager
+def locked(directory):
+    """Hold an exclusive lock on *directory* for the duration of the
+    with statement.  The input directory may be shared by runs in
+    several workspaces (see `settings.Workspace`), so the files made in
+    it are only checked and made while it is locked."""
+
+    import fcntl
+
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+    finally:
+        os.close(fd)
+
+
+def temp_file(path, like):
+    """Return the name of a new temporary file, in the directory of
+    *path* and with the permissions of the file *like*, to be renamed
+    (with os.replace) to *path* when it is complete."""
+
+    fd, temp = tempfile.mkstemp(dir=os.path.dirname(path) or '.',
+                                prefix=os.path.basename(path) + '.',
+                                suffix='.tmp')
+    os.close(fd)
+    os.chmod(temp, stat.S_IMODE(os.stat(like).st_mode))
+    return temp
+
+
+def load_radiance(path, cache=None):
+    """Load the night time radiance file *path* (lines of 'i j value')
+    as a 2-D array indexed by [j - 1, i - 1].  Pixels that are not in
+    the file hold the largest value of the array's type (255 or 65535).
+
+    The array is saved in the .npy file *cache* (by default *path* with
+    its extension replaced by '.npy'), which is memory mapped, and is
+    only made again when *path* is newer.
+    """
+
+    if cache is None:
+        cache = os.path.splitext(path)[0] + '.npy'
+    if os.path.exists(cache) and os.path.getmtime(cache) >= os.path.getmtime(path):
+        return np.load(cache, mmap_mode='r')
+
+    temp = temp_file(cache, path)
+    try:
+        make_radiance_grid(path, temp)
+    except BaseException:
+        os.remove(temp)
+        raise
+    os.replace(temp, cache)
+    return np.load(cache, mmap_mode='r')
+
+
+def make_radiance_grid(path, temp):
+    """Make the .npy file *temp* from the radiance file *path* (see
+    `load_radiance`)."""
+
+    grid = np.lib.format.open_memmap(temp, mode='w+', dtype=np.uint8, shape=(NJ, NI))
+    grid[:] = np.iinfo(grid.dtype).max
+    with open(path) as night_file:
+        while True:
+            lines = night_file.readlines(1 << 24)
+            if not lines:
+                break
+            a = np.array(''.join(lines).split(), dtype=float).reshape(-1, 3)
+            i, j, value = a.T
+            if not (value == np.floor(value)).all() or (value < 0).any():
+                raise ValueError("%s: radiance values must be whole numbers." % path)
+            if value.max() >= np.iinfo(grid.dtype).max:
+                # Values do not fit (leaving room for the absent
+                # pixels); widen the array.
+                grid.flush()
+                del grid
+                narrow = np.load(temp, mmap_mode='r')
+                wide_temp = temp_file(temp, path)
+                try:
+                    wide = np.lib.format.open_memmap(wide_temp, mode='w+', dtype=np.uint16, shape=(NJ, NI))
+                    for row in range(0, NJ, 1000):
+                        block = narrow[row:row + 1000]
+                        wide[row:row + 1000] = np.where(block == np.iinfo(narrow.dtype).max,
+                                                        np.iinfo(wide.dtype).max, block)
+                except BaseException:
+                    os.remove(wide_temp)
+                    raise
+                del narrow
+                os.replace(wide_temp, temp)
+                grid = wide
+                if value.max() >= np.iinfo(grid.dtype).max:
+                    raise ValueError("%s: radiance values are too large." % path)
+            inside = (1 <= i) & (i <= NI) & (1 <= j) & (j <= NJ)
+            grid[j[inside].astype(int) - 1, i[inside].astype(int) - 1] = value[inside]
+    grid.flush()
+    del grid
+
+
+def lookup(radiance, lon, lat):
+    """Return the radiance of the pixels containing the points with
+    longitudes *lon* and latitudes *lat* (arrays), as an array of
+    integers; -1 where a pixel is not in the radiance file."""
+
+    i = np.rint((lon + 180) * 120 + 1).astype(np.int64)
+    j = np.rint(21600 + .5 - (lat + 90) * 120).astype(np.int64)
+    j = np.where(j >= 21600, 21600, j)
+    i = np.where(i >= 43200, 1, i)
+    inside = (1 <= i) & (i <= NI) & (1 <= j) & (j <= NJ)
+    result = np.full(len(i), -1, dtype=np.int64)
+    value = radiance[j[inside] - 1, i[inside] - 1].astype(np.int64)
+    result[inside] = np.where(value == np.iinfo(radiance.dtype).max, -1, value)
+    return result
+
+
+# This method is used to generate the nigh time brightness index.
+# It expects wrld-rad.data.txt and v4.inv to be in the /tmp/input dir.
+# The resulting file v4.inv will be placed in the /tmp/input dir as well.
+# The input directory should be locked (see `locked`).
+def run():
+    input_dir = settings.workspace.input_dir
+    radiance = load_radiance(input_dir + 'wrld-rad.data.txt')
+    inv_file = open(input_dir + 'v4.inv', 'r')
+    temp = temp_file(input_dir + 'v4.inv', input_dir + 'v4.inv')
+    new_inv = open(temp, 'w')
+    lines = inv_file.readlines()
+    lat = np.array([float(line.split()[1]) for line in lines])
+    lon = np.array([float(line.split()[2]) for line in lines])
+    values = lookup(radiance, lon, lat)
+
+    for line, value in zip(lines, values):
+        if value >= 0:
+            new_inv.write(line.replace('\n', ' ' + str(value)) + "     " + '\n')
+        else:
+            new_inv.write(line.replace('\n', ' ' + '0' + '     ' + '\n'))
+    inv_file.close()
+    new_inv.close()
+    os.replace(temp, input_dir + "v4.inv")
@@ -0,0 +1,228 @@
+#!/usr/local/bin/python3.4
+#
+# ghcndiff.py -- report the stations that differ between two GHCN-M files
+
+"""ghcndiff.py [options] OLD NEW -- report the stations whose records
+differ between two files in GHCN-M format, such as consecutive releases
+of ghcnm.tavg.qcf.dat (or the work files of Steps 0 to 2 of two runs,
+which are in the same format).
+Options:
+   --help         Print this text.
+   --months       List every month that changed, for each modified
+                  station (by default, only how many, and the first
+                  and last).
+   --json=FILE    Also write the change set to FILE, as JSON.
+
+The lines of each station are hashed as the files are read (ignoring
+trailing white space), and only the stations whose digests differ are
+compared month by month, in a second pass over the files.  A station is
+modified when the value or the flags of any month with data differ (a
+month with no data is the same as a missing line).  Files whose names
+end in '.gz' are uncompressed as they are read.
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import sys
+
+
+def month_name(month):
+    """The name, such as '2026-08', of *month* (numbered as by
+    `giss_data.Series.first_valid_month`)."""
+    year, m = divmod(month - 1, 12)
+    return '%04d-%02d' % (year, m + 1)
+
+
+def open_ghcn(filename):
+    """Open the GHCN-M file *filename*, in binary."""
+    if filename.endswith('.gz'):
+        return gzip.open(filename, 'rb')
+    return open(filename, 'rb')
+
+
+def ghcn_lines(filename):
+    """Iterate over the lines of the GHCN-M file *filename*, yielding
+    for each a triple: the station ID and element, the year, and the
+    list of the 12 monthly fields (value and flags)."""
+
+    with open_ghcn(filename) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            line = line.decode('ascii').rstrip().ljust(115)
+            yield (line[:11] + line[15:19], int(line[11:15]),
+                   [line[19 + 8 * i:27 + 8 * i] for i in range(12)])
+
+
+def has_data(field):
+    return field[:5].strip() not in ('', '-9999')
+
+
+def station_digests(filename):
+    """Return a dict mapping the ID of each station in the GHCN-M file
+    *filename* to the sha256 digest of its lines."""
+
+    digests = {}
+    with open_ghcn(filename) as f:
+        for line in f:
+            line = line.rstrip()
+            if not line:
+                continue
+            digest = digests.get(line[:11])
+            if digest is None:
+                digest = digests[line[:11]] = hashlib.sha256()
+            digest.update(line + b'\n')
+    return dict((uid.decode('ascii'), digest.hexdigest())
+                for uid, digest in digests.items())
+
+
+def diff_digests(old, new):
+    """Compare two dicts made by `station_digests`.  Returns a triple
+    of sorted lists: the stations added, removed, and changed."""
+
+    added = sorted(set(new) - set(old))
+    removed = sorted(set(old) - set(new))
+    changed = sorted(uid for uid in set(old) & set(new)
+                     if old[uid] != new[uid])
+    return added, removed, changed
+
+
+def station_months(filename, stations):
+    """Return a dict mapping the ID of each of *stations* found in the
+    GHCN-M file *filename* to a dict mapping each month with data to
+    its element and field."""
+
+    result = dict((uid, {}) for uid in stations)
+    for key, year, fields in ghcn_lines(filename):
+        months = result.get(key[:11])
+        if months is None:
+            continue
+        for m, field in enumerate(fields, 1):
+            if has_data(field):
+                months[year * 12 + m] = (key[11:], field)
+    return result
+
+
+class ChangeSet(object):
+    """The differences between two GHCN-M files, made by `compare`.
+
+    :Ivar added, removed:
+        Dicts mapping the ID of each station only in the new (or only
+        in the old) file to the pair of its first and last months with
+        data (None for a station with no data).
+    :Ivar modified:
+        Dict mapping the ID of each station in both files whose data
+        differ to the sorted list of the months that differ.
+    :Ivar unchanged:
+        The number of stations in both files with the same data.
+    """
+
+    def __init__(self, added, removed, modified, unchanged):
+        self.added = added
+        self.removed = removed
+        self.modified = modified
+        self.unchanged = unchanged
+
+    def summary(self):
+        return ("stations: %d added, %d removed, %d modified, "
+                "%d unchanged" % (len(self.added), len(self.removed),
+                                  len(self.modified), self.unchanged))
+
+    def report(self, months=False):
+        """Iterate over the lines of a report of the changes, one for
+        each station; with *months* True, every month that changed is
+        listed."""
+
+        def span(pair):
+            if pair is None:
+                return "no data"
+            return "%s to %s" % tuple(month_name(m) for m in pair)
+
+        for uid, pair in sorted(self.added.items()):
+            yield "added     %s  %s" % (uid, span(pair))
+        for uid, pair in sorted(self.removed.items()):
+            yield "removed   %s  %s" % (uid, span(pair))
+        for uid, changed in sorted(self.modified.items()):
+            if months:
+                text = ' '.join(month_name(m) for m in changed)
+            else:
+                text = "%d month%s, %s" % (len(changed),
+                                           's'[:len(changed) != 1],
+                                           span((changed[0], changed[-1])))
+            yield "modified  %s  %s" % (uid, text)
+
+    def as_json(self):
+        def span(pair):
+            return pair and [month_name(m) for m in pair]
+
+        return dict(
+            added=dict((uid, span(pair)) for uid, pair in self.added.items()),
+            removed=dict((uid, span(pair))
+                         for uid, pair in self.removed.items()),
+            modified=dict((uid, [month_name(m) for m in changed])
+                          for uid, changed in self.modified.items()),
+            unchanged=self.unchanged)
+
+
+def compare(old_file, new_file):
+    """Compare the GHCN-M files *old_file* and *new_file*, and return
+    a `ChangeSet`."""
+
+    old = station_digests(old_file)
+    new = station_digests(new_file)
+    added, removed, changed = diff_digests(old, new)
+    old_months = station_months(old_file, removed + changed)
+    new_months = station_months(new_file, added + changed)
+
+    def span(months):
+        return months and (min(months), max(months)) or None
+
+    modified = {}
+    for uid in changed:
+        a, b = old_months[uid], new_months[uid]
+        months = sorted(m for m in set(a) | set(b) if a.get(m) != b.get(m))
+        # The lines may differ only in months with no data.
+        if months:
+            modified[uid] = months
+    return ChangeSet(dict((uid, span(new_months[uid])) for uid in added),
+                     dict((uid, span(old_months[uid])) for uid in removed),
+                     modified,
+                     len(set(old) & set(new)) - len(modified))
+
+
+def parse_options(arglist):
+    import optparse
+
+    usage = "usage: %prog [options] OLD NEW"
+    parser = optparse.OptionParser(usage)
+    parser.add_option("--months", action="store_true", default=False,
+                      help="List every month that changed")
+    parser.add_option("--json", metavar="FILE",
+                      help="Also write the change set to FILE, as JSON")
+    options, args = parser.parse_args(arglist)
+    if len(args) != 2:
+        parser.error("Expected two files, OLD and NEW")
+    for arg in args:
+        if not os.path.isfile(arg):
+            parser.error("No such file: %s" % arg)
+    return options, args
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+    options, (old_file, new_file) = parse_options(argv[1:])
+    changes = compare(old_file, new_file)
+    for line in changes.report(options.months):
+        print(line)
+    print(changes.summary())
+    if options.json:
+        with open(options.json, 'w') as f:
+            json.dump(changes.as_json(), f, indent=1, sort_keys=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
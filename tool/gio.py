@@ -16,10 +16,12 @@ used by other bodies (such as NOAA's v2.mean format).
 # Clear Climate Code
 import copy
 import itertools
-import math
+import os
 import re
 import struct
 import csv
+import queue
+import threading
 
 import warnings
 
@@ -28,6 +30,7 @@ import numpy as np
 
 import parameters
 from settings import *
+import settings
 from steps import giss_data
 
 #: Integer code used to indicate missing data.
@@ -107,6 +110,40 @@ def open_or_uncompress(filename):
         raise (exception[0], exception[1], exception[2])
 
 
+def file_digest(path):
+    """The sha256 digest of the contents of the file *path*."""
+    import hashlib
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def input_digests():
+    """Return a dict mapping the name of each file in the input
+    directory to its digest (see `file_digest`).  The caches made from
+    other input files (the .npy file of
+    `generate_brightness.load_radiance`) are left out."""
+
+    # Step 0 adds the brightness index to the inventory; do it now, so
+    # that the inventory does not change under the run.
+    from steps import step0
+    step0.prepare_inventory()
+
+    input_dir = settings.workspace.input_dir
+    result = {}
+    for name in sorted(os.listdir(input_dir)):
+        filename = os.path.join(input_dir, name)
+        # Skip the manifest of tool/fetch.py, and the like.
+        if name.startswith('.') or name.endswith('.npy') or \
+                not os.path.isfile(filename):
+            continue
+        result[name] = file_digest(filename)
+    return result
+
+
 class SubboxWriter(object):
     """Produces a GISTEMP SBBX (subbox); typically the output of
     step3 (and 4), and the input to step 5.
@@ -145,9 +182,130 @@ class SubboxWriter(object):
             self.result.append(self._flush(record))
 
     def close(self):
+        np.savez_compressed(self.file, *self.result, meta=self.meta)
+        self.file.close()
+
+
+class BoxWriter(object):
+    """Produces a Step 5 box (BX) file, a .npz file containing numpy
+    arrays.  The records written are the (*anom*, *weight*, *ngood*,
+    *box*) tuples produced by `step5.subbox_to_box_array`.
+    """
+
+    def __init__(self, file, info):
+        self.file = open(file, 'wb')
+        self.info = info
+        self.result = []
+
+    def write(self, record):
+        avgr, wtr, ngood, box = record
+        self.result.append([np.asarray(avgr), np.asarray(wtr), [ngood, box]])
+
+    def close(self):
+        np.savez_compressed(self.file, *self.result, meta=self.info)
         self.file.close()
 
 
+# The background writers that have been closed, but may not have
+# finished writing.  See `wait_for_output`.
+pending_writers = []
+
+
+class BackgroundWriter(object):
+    """Write records, using *writer* (an object with `write` and
+    `close` methods, such as `GHCNV3Writer`), in a background thread.
+
+    Records are passed to the thread through a queue that holds at
+    most *size* records (by default parameters.output_queue_size);
+    when the queue is full `write` waits for the thread to catch up.
+    An exception raised by *writer* is re-raised by the next call to
+    `write`, or by `wait`.  When *size* is 0 no thread is used, and
+    each record is written immediately.
+
+    The records must not be changed once they have been written; see
+    `snapshot`.
+    """
+
+    def __init__(self, writer, size=None):
+        if size is None:
+            size = parameters.output_queue_size
+        self.writer = writer
+        self.error = None
+        self.thread = None
+        if size > 0:
+            self.queue = queue.Queue(size)
+            self.thread = threading.Thread(target=self._run,
+                                           name='BackgroundWriter')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            # After an error, keep taking records from the queue (so
+            # that a producer is never stuck waiting), but ignore
+            # them.
+            if self.error is None:
+                try:
+                    item[0](*item[1:])
+                except BaseException as e:
+                    self.error = e
+
+    def _put(self, *item):
+        if self.error is not None:
+            raise self.error
+        if self.thread is None:
+            item[0](*item[1:])
+        else:
+            self.queue.put(item)
+
+    def write(self, record):
+        self._put(self.writer.write, record)
+
+    def write_batch(self, batch):
+        """Write all the records in the giss_data.StationBatch
+        *batch* (with the writer's `write_batch` method)."""
+        self._put(self.writer.write_batch, batch)
+
+    def close(self):
+        """Close the writer once all the records have been written.
+        This does not wait for that to happen, see `wait`."""
+
+        self._put(self.writer.close)
+        if self.thread is not None:
+            self.queue.put(None)
+            pending_writers.append(self)
+
+    def wait(self):
+        """Wait for the thread to finish writing."""
+
+        if self.thread is not None:
+            self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+
+def wait_for_output():
+    """Wait until all the closed background writers (see
+    `BackgroundWriter`) have finished writing their files, re-raising
+    the first error (if any)."""
+
+    while pending_writers:
+        pending_writers.pop(0).wait()
+
+
+def snapshot(record):
+    """Return a copy of *record* that can be given to a
+    `BackgroundWriter`: later steps may modify the records that they
+    are given, and that must not affect what is written."""
+
+    if isinstance(record, giss_data.Series):
+        return record.copy()
+    return record
+
+
 class SubboxReader(object):
     """Reads GISS subbox files (SBBX).  These files are output by Step
     3, and consumed by Step 5.  Step 4 both reads and writes a subbox
@@ -226,7 +384,7 @@ class SubboxReaderNpz(object):
     """
 
     def __init__(self, file, celltype=None):
-        self.f = np.load(file + '.npz')
+        self.f = np.load(file + '.npz', allow_pickle=True)
         meta = self.f['meta']
         title = meta[-1]
         self.meta = giss_data.SubboxMetaData(*meta)
@@ -386,6 +544,138 @@ def GHCNV4Reader(path=None, file=None, meta=None,
             yield record
 
 
+def GHCNV4BatchReader(path=None, file=None, meta=None,
+                      year_min=None, scale=None, element=None):
+    """Reads a file in GHCN V4 .dat format, just like GHCNV4Reader
+    (see that function for the arguments), but returns all of its
+    records as a single giss_data.StationBatch.  The file is parsed a
+    chunk of lines at a time, with array operations.
+    """
+
+    if path:
+        inp = open(path)
+    else:
+        inp = file
+
+    element_scale = dict(TAVG=0.01, TMIN=0.01, TMAX=0.01)
+    reject = list('DKOSTW')
+
+    ids = []
+    years = []
+    elements = []
+    values = []
+    bad = []
+    while True:
+        lines = inp.readlines(1 << 24)
+        if not lines:
+            break
+        n = len(lines)
+        chars = np.array(lines, dtype='U115').view('U1').reshape(n, 115)
+
+        def field(a, b):
+            return np.ascontiguousarray(chars[:, a:b]).view('U%d' % (b - a)).reshape(n)
+
+        ids.append(field(0, 11))
+        years.append(field(11, 15).astype(np.int64))
+        elements.append(field(15, 19))
+        # Each value is 8 characters: 5 for the value, and 3 flags for
+        # Measurement (missing days), Quality, and Source.
+        cells = chars[:, 19:115].reshape(n, 12, 8)
+        v = np.ascontiguousarray(cells[:, :, :5]).view('U5').reshape(n, 12).astype(np.int64)
+        values.append(v)
+        bad.append(np.isin(cells[:, :, 6], reject) | (v == -9999))
+    if ids:
+        ids = np.concatenate(ids)
+        years = np.concatenate(years)
+        elements = np.concatenate(elements)
+        values = np.concatenate(values)
+        bad = np.concatenate(bad)
+    else:
+        ids = np.zeros(0, dtype='U11')
+        years = np.zeros(0, dtype=np.int64)
+        elements = np.zeros(0, dtype='U4')
+        values = np.zeros((0, 12), dtype=np.int64)
+        bad = np.zeros((0, 12), dtype=bool)
+
+    # A record is each run of lines with the same station identifier.
+    group = np.concatenate([[0], np.cumsum(ids[1:] != ids[:-1])]).astype(np.int64)
+    starts = np.flatnonzero(np.concatenate([[True], ids[1:] != ids[:-1]]))
+
+    # Choose the lines for the element; there must be only one sort
+    # of element.
+    used = elements == element if element else np.ones(len(ids), dtype=bool)
+    found = list(dict.fromkeys(elements[used].tolist()))
+    if found:
+        friendly = dict(TAVG='average temperature',
+                        TMIN='mean minimum temperature',
+                        TMAX='mean maximum temperature')
+        print("(Reading %s)" % friendly[found[0]])
+    if len(found) > 1:
+        raise Exception("File contains more than one sort of element: %r" % found)
+    multiplier = np.zeros(len(ids))
+    for e in found:
+        multiplier[elements == e] = scale or element_scale[e]
+    values = np.where(bad, MISSING, values * multiplier[:, None])
+    # Years with no valid data are not added.
+    used &= ~bad.all(axis=1)
+
+    ngroups = len(starts)
+    if year_min:
+        first_year = np.full(ngroups, year_min, dtype=np.int64)
+    else:
+        # The year of the first line that is added to each record.
+        first_year = np.full(ngroups, np.iinfo(np.int64).max, dtype=np.int64)
+        line = np.flatnonzero(used)
+        g, first = np.unique(group[line], return_index=True)
+        first_year[g] = years[line[first]]
+    # Years before the first year are ignored.
+    used &= years >= first_year[group]
+    line = np.flatnonzero(used)
+    same = group[line[1:]] == group[line[:-1]]
+    assert (years[line[1:]][same] > years[line[:-1]][same]).all()
+    last_year = np.full(ngroups, -1, dtype=np.int64)
+    np.maximum.at(last_year, group[line], years[line])
+
+    # Records with no data are not returned.
+    keep = last_year >= 0
+    row = np.cumsum(keep) - 1
+    first_month = first_year[keep] * 12 + 1
+    length = (last_year[keep] - first_year[keep] + 1) * 12
+    base_month, months = giss_data.extent(first_month, length)
+    matrix = np.full((len(first_month), months), giss_data.MISSING)
+    column = years[line] * 12 + 1 - base_month
+    matrix[row[group[line]][:, None], column[:, None] + np.arange(12)] = values[line]
+
+    uids = ids[starts[keep]]
+    stations = []
+    for id in uids.tolist():
+        if meta and meta.get(id):
+            stations.append(meta[id])
+        else:
+            stations.append(None)
+    return giss_data.StationBatch(uids, stations, first_month, length,
+                                  base_month, matrix)
+
+
+def source_flag(uid):
+    """The (*uid*, *sflag*) pair that is written to a GHCN v3 file for
+    a record with uid *uid*; see `GHCNV3Writer`."""
+
+    if len(uid) > 11:
+        # Convert GHCN v2 style identifier into 11-digit v3
+        # identifier; use 12th digit for the source flag.
+        uid = uid[:12]
+        assert len(uid) == 12
+        sflag = uid[11]
+    elif len(uid) == 6:
+        # Assume it's a 6 digit identifier from USHCN.
+        uid = '42500' + uid
+        sflag = 'U'
+    else:
+        sflag = ' '
+    return uid, sflag
+
+
 class GHCNV3Writer(object):
     """Write a file in GHCN v3 format. See also GHCNV4Reader.  The
     format is documented in
@@ -420,18 +710,7 @@ class GHCNV3Writer(object):
         """Write a single year's worth of data out.  *temps* should
         contain 12 monthly values."""
 
-        if len(uid) > 11:
-            # Convert GHCN v2 style identifier into 11-digit v3
-            # identifier; use 12th digit for the source flag.
-            uid = uid[:12]
-            assert len(uid) == 12
-            sflag = uid[11]
-        elif len(uid) == 6:
-            # Assume it's a 6 digit identifier from USHCN.
-            uid = '42500' + uid
-            sflag = 'U'
-        else:
-            sflag = ' '
+        uid, sflag = source_flag(uid)
         id11 = "%-11.11s" % uid
         assert len(element) == 4
 
@@ -442,6 +721,40 @@ class GHCNV3Writer(object):
         self.f.write('%s%04d%s%s\n' % (uid, year, element,
                                        ''.join(t + flag for t, flag in zip(tstrings, flags))))
 
+    def write_batch(self, batch):
+        """Write all the records in *batch*, a giss_data.StationBatch,
+        just as `write` would write each of them."""
+
+        if batch.base_month % 12 != 1 or (batch.first_month % 12 != 1).any():
+            # Records that do not start in January.
+            for record in batch:
+                self.write(record)
+            return
+
+        n, months = batch.values.shape
+        years = -(-months // 12)
+        values = np.full((n, years * 12), giss_data.MISSING)
+        values[:, :months] = batch.values
+        values = values.reshape(n, years, 12)
+        # The years with data, in record order; see internal_to_external.
+        row, year = np.nonzero((values != giss_data.MISSING).any(axis=2))
+        data = values[row, year]
+        ints = np.where(np.abs(data - giss_data.MISSING) < 0.01, MISSING,
+                        np.rint(data * (1.0 / self.scale))).astype(np.int64)
+        text = np.where(ints == MISSING, '-9999', np.char.mod('%5d', ints))
+        first_year = (batch.base_month - 1) // 12
+
+        prefixes = []
+        flags = []
+        for uid in batch.uid.tolist():
+            uid, sflag = source_flag(uid)
+            prefixes.append(uid)
+            flags.append('  ' + sflag)
+        for r, y, t in zip(row.tolist(), year.tolist(), text.tolist()):
+            flag = flags[r]
+            self.f.write('%s%04d%s%s\n' % (prefixes[r], first_year + y, 'TAVG',
+                                           ''.join(x + flag for x in t)))
+
     def close(self):
         self.f.close()
 
@@ -549,7 +862,9 @@ def read_antarc_station_ids(path, discriminator):
 
 
 def station_metadata(path=None, file=None, format='giss_v4'):
-    """Read station metadata from file, return it as a dictionary.
+    """Read station metadata from file, return it as a
+    giss_data.StationTable (which is used like a dictionary of
+    giss_data.Station instances, keyed by uid).
     *format* specifies the format of the metadata can be:
     'giss_v4' for GHCN v4 ;
 
@@ -683,11 +998,42 @@ def station_metadata(path=None, file=None, format='giss_v4'):
     elif 'v3' == format:
         fields = v3_ghcn_fields
 
-    result = {}
-    for line in file:
-        d = dict((field, convert(line[a:b])) for field, (a, b, convert) in fields.items())
-        result[d['uid']] = giss_data.Station(**d)
-    return result
+    return giss_data.StationTable(parse_columns(file.readlines(), fields))
+
+
+def parse_columns(lines, fields):
+    """Parse the fixed width *fields* of every line in *lines* at once,
+    returning a NumPy structured array with a row per line.  *fields*
+    is a dict that maps field name to (start, stop, convert) triples,
+    as used by station_metadata(); *convert* is one of str, int, float,
+    or a function that treats a blank field as None (which is held as
+    giss_data.BLANK).
+    """
+
+    width = max(b for a, b, convert in fields.values())
+    # A (line, character) array; short lines are padded with NULs,
+    # which disappear when the characters are joined up again.
+    chars = np.array(lines, dtype='U%d' % width)
+    chars = chars.view('U1').reshape(len(lines), width)
+
+    names = sorted(fields, key=lambda field: fields[field][0])
+    columns = []
+    for field in names:
+        a, b, convert = fields[field]
+        column = np.ascontiguousarray(chars[:, a:b]).view('U%d' % (b - a))
+        column = column.reshape(len(lines))
+        if convert is str:
+            pass
+        elif convert is float:
+            column = column.astype(np.float64)
+        elif convert is int:
+            column = column.astype(np.int64)
+        else:
+            blank = np.char.strip(column) == ''
+            column = np.where(blank, '0', column).astype(np.int64)
+            column[blank] = giss_data.BLANK
+        columns.append(column)
+    return np.rec.fromarrays(columns, names=names).view(np.ndarray)
 
 
 def augmented_station_metadata(path=None, file=None, format='v3'):
@@ -717,7 +1063,7 @@ def augmented_station_metadata(path=None, file=None, format='v3'):
                 d[k] = v
             uid = d['uid']
             if uid in meta:
-                meta[uid].__dict__.update(d)
+                meta.augment(uid, d)
     return meta
 
 
@@ -758,12 +1104,15 @@ def read_float(s):
         return giss_data.MISSING
 
 
-_v3meta = None
+# The pair of the key and the value of the last `v3meta`.
+_v3meta = (None, None)
 
 
 def v3meta():
     """Return the GHCN v3 metadata.  Loading it (from the modified
-    version of the file supplied by GISS) if necessary.
+    version of the file supplied by GISS) if necessary: it is loaded
+    again when the input directory, parameters.augment_metadata, or
+    the file itself has changed since it was last loaded.
     """
 
     # It's important that this file be opened lazily, and not at module
@@ -772,10 +1121,13 @@ def v3meta():
 
     global _v3meta
 
-    v3inv = os.path.join(INPUT_DIR, 'v4.inv')
-    if not _v3meta:
-        _v3meta = augmented_station_metadata(v3inv, format='giss_v4')
-    return _v3meta
+    v3inv = os.path.join(settings.workspace.input_dir, 'v4.inv')
+    stat = os.stat(v3inv)
+    key = (settings.workspace.input_dir, parameters.augment_metadata,
+           stat.st_size, stat.st_mtime_ns)
+    if _v3meta[0] != key:
+        _v3meta = (key, augmented_station_metadata(v3inv, format='giss_v4'))
+    return _v3meta[1]
 
 
 def maskboxes(inp, grid):
@@ -799,30 +1151,53 @@ class Input:
     def __init__(self):
         self.sources = parameters.data_sources.split()
 
+    def ghcn_path(self, source):
+        """The path of the GHCN file for *source*, or None if it is
+        not a GHCN source."""
+        if source == 'ghcn':
+            return settings.workspace.input_dir + 'ghcnm.tavg.qcf.dat'
+        if re.match('ghcnm.(tavg|tmax|tmin)', source):
+            if not source.endswith('.dat'):
+                source += '.qca.dat'
+            return os.path.join(settings.workspace.input_dir, source)
+        return None
+
+    def is_sorted(self, source):
+        """True if the records from the source are in uid order (for a
+        file in GHCN format, its lines are in station ID order)."""
+        if self.ghcn_path(source):
+            path = self.ghcn_path(source)
+        elif source.endswith('.dat'):
+            path = os.path.join(BASE_PATH + "input", source)
+        else:
+            return False
+        previous = ''
+        with open(path) as f:
+            for line in f:
+                id11 = line[:11]
+                if id11 < previous:
+                    return False
+                previous = id11
+        return True
+
     def open(self, source):
         """Open the source (specified as a string), and return an
         iterator."""
-        if source == 'ghcn' or re.match('ghcnm.(tavg|tmax|tmin)', source):
-            if source == 'ghcn':
-                ghcn4file = INPUT_DIR + 'ghcnm.tavg.qcf.dat'
-            else:
-                if source.endswith('.dat'):
-                    pass
-                else:
-                    source += '.qca.dat'
-                ghcn4file = os.path.join(INPUT_DIR, source)
-            invfile = INPUT_DIR + 'v4.inv'
+        if self.ghcn_path(source):
+            ghcn4file = self.ghcn_path(source)
+            invfile = settings.workspace.input_dir + 'v4.inv'
 
             return GHCNV4Reader(file=open(ghcn4file),
                                 meta=augmented_station_metadata(invfile, format='giss_v4'),
                                 year_min=giss_data.BASE_YEAR)
         if source == 'scar':
+            input_dir = settings.workspace.input_dir
             return itertools.chain(
-                read_antarctic(INPUT_DIR + "antarc1.txt", INPUT_DIR + "antarc1.list", '8',
+                read_antarctic(input_dir + "antarc1.txt", input_dir + "antarc1.list", '8',
                                meta=v3meta(), year_min=giss_data.BASE_YEAR),
-                read_antarctic(INPUT_DIR + "antarc3.txt", INPUT_DIR + "antarc3.list", '9',
+                read_antarctic(input_dir + "antarc3.txt", input_dir + "antarc3.list", '9',
                                meta=v3meta(), year_min=giss_data.BASE_YEAR),
-                read_australia(INPUT_DIR + "antarc2.txt", INPUT_DIR + "antarc2.list", '7',
+                read_australia(input_dir + "antarc2.txt", input_dir + "antarc2.list", '7',
                                meta=v3meta(), year_min=giss_data.BASE_YEAR))
         if source.endswith('.dat'):
             return read_generic_v3(source)
@@ -833,7 +1208,9 @@ class Input:
 # yields that data for that step feeding from data files.
 # Each of the stepN_output functions below is effectively a "tee" that
 # writes the data to a file; they each take a data object (an
-# iterator), write each item to a file, and yield each item.
+# iterator), write each item to a file, and yield each item.  (The
+# outputs of Steps 0 to 2 also take a giss_data.StationBatch, which
+# they write and return.)
 def step0_input():
     input = Input()
     return input
@@ -854,69 +1231,100 @@ def generic_output_step(n):
     """Return a generic output routine for step *n*."""
 
     def output(data):
-        writer, ext = choose_writer()
-        path = os.path.join(WORK_DIR, 'step%d.%s' % (n, ext))
-        out = writer(path=path)
+        if isinstance(data, giss_data.StationBatch):
+            # A batch is not changed once it is made, so it can be
+            # written as it is.
+            out = work_file_writer(n)
+            out.write_batch(data)
+            close_work_file(n, out)
+            return data
+        return tee(data)
+
+    def tee(data):
+        out = work_file_writer(n)
         for thing in data:
-            out.write(thing)
+            out.write(snapshot(thing))
             yield thing
-        print("Step %d: closing output file." % n)
-        out.close()
-        progress = open(PROGRESS_DIR + 'progress.txt', 'a')
-        progress.write("\nStep %d: closing output file.\n" % n)
+        close_work_file(n, out)
 
     return output
 
 
+def work_file_writer(n):
+    """Return a `BackgroundWriter` for the work file that holds the
+    records output by step *n*."""
+
+    writer, ext = choose_writer()
+    path = os.path.join(settings.workspace.work_dir, 'step%d.%s' % (n, ext))
+    return BackgroundWriter(writer(path=path))
+
+
+def close_work_file(n, out):
+    """Close *out*, the writer made by work_file_writer(*n*)."""
+
+    print("Step %d: closing output file." % n)
+    out.close()
+    progress = open(settings.workspace.progress_dir + 'progress.txt', 'a')
+    progress.write("\nStep %d: closing output file.\n" % n)
+
+
 step0_output = generic_output_step(0)
 
 
-def step1_input():
-    return GHCNV4Reader(WORK_DIR + "step0.v4",
-                        meta=v3meta(),
-                        year_min=giss_data.BASE_YEAR)
+# The stepN_input functions for Steps 1 to 3 return a
+# giss_data.StationBatch, rather than an iterator, when *batch* is True.
+def step1_input(batch=False):
+    reader = GHCNV4BatchReader if batch else GHCNV4Reader
+    return reader(settings.workspace.work_dir + "step0.v4",
+                  meta=v3meta(),
+                  year_min=giss_data.BASE_YEAR)
 
 
 step1_output = generic_output_step(1)
 
 
-def step2_input():
-    return GHCNV4Reader(WORK_DIR + "step1.v4", meta=v3meta())
+def step2_input(batch=False):
+    reader = GHCNV4BatchReader if batch else GHCNV4Reader
+    return reader(settings.workspace.work_dir + "step1.v4", meta=v3meta())
 
 
 step2_output = generic_output_step(2)
 
 
-def step3_input():
-    return GHCNV4Reader(WORK_DIR + "step2.v4", meta=v3meta())
+def step3_input(batch=False):
+    reader = GHCNV4BatchReader if batch else GHCNV4Reader
+    return reader(settings.workspace.work_dir + "step2.v4", meta=v3meta())
 
 
-STEP3_OUT = os.path.join(RESULT_DIR, 'SBBX1880.Ts.GHCN.CL.PA.1200')
+def step3_out():
+    """The name (less the .npz extension) of the Step 3 output file."""
+    return os.path.join(settings.workspace.result_dir, 'SBBX1880.Ts.GHCN.CL.PA.1200')
 
 
 def step3_output(data):
-    out = SubboxWriter(STEP3_OUT)
+    out = BackgroundWriter(SubboxWriter(step3_out()))
     writer, ext = choose_writer()
-    textout = writer(path=(WORK_DIR + 'step3.%s' % ext), scale=0.01)
+    textout = BackgroundWriter(
+        writer(path=(settings.workspace.work_dir + 'step3.%s' % ext), scale=0.01))
     gotmeta = False
     for thing in data:
-        out.write(thing)
+        record = snapshot(thing)
+        out.write(record)
         if gotmeta:
-            textout.write(thing)
+            textout.write(record)
         gotmeta = True
         yield thing
-    np.savez_compressed(out.file, *out.result, meta=out.meta)
     print("Step 3: closing output file")
     out.close()
     textout.close()
-    progress = open(PROGRESS_DIR + 'progress.txt', 'a')
+    progress = open(settings.workspace.progress_dir + 'progress.txt', 'a')
     progress.write("\nStep3: closing output file\n")
 
 
 def step3c_input():
     """Use the output from the ordinary Step 3."""
 
-    land = SubboxReaderNpz(STEP3_OUT)
+    land = SubboxReaderNpz(step3_out())
     return iter(land)
 
 
@@ -938,7 +1346,7 @@ def make_3d_array(a, b, c):
 def step4_find_monthlies(latest_year, latest_month):
     dates = {}
     filename_re = re.compile('^oiv2mon\.([0-9][0-9][0-9][0-9])([0-9][0-9])(\.gz)?$')
-    for f in os.listdir(INPUT_DIR):
+    for f in os.listdir(settings.workspace.input_dir):
         m = filename_re.match(f)
         if m:
             year = int(m.group(1))
@@ -946,7 +1354,7 @@ def step4_find_monthlies(latest_year, latest_month):
             if (year, month) > (latest_year, latest_month):
                 if m.group(3):
                     f = f[:-3]
-                dates[(year, month)] = 'input/' + f
+                dates[(year, month)] = os.path.join(settings.workspace.input_dir, f)
     l = list(dates.items())
     l.sort()
     return l
@@ -1010,7 +1418,7 @@ def find_ocean_file():
     """
 
     source = parameters.ocean_source.upper()
-    dir = INPUT_DIR
+    dir = settings.workspace.input_dir
     for name in os.listdir(dir):
         if name.upper() == "SBBX." + source:
             return os.path.join(dir, name)
@@ -1019,11 +1427,24 @@ def find_ocean_file():
                     parameters.ocean_source)
 
 
-def step4_input(land):
+def step4_input(land, ocean=None):
     # The "land is None" check allows Step 4 to be run on its
     # own, loading the land data from work files in that case.
+    # *ocean* is the pair returned by `step4_ocean`, for a caller that
+    # runs Step 4 more than once (see tool/ensemble.py).
     if land is None:
-        land = SubboxReaderNpz(STEP3_OUT)
+        land = SubboxReaderNpz(step3_out())
+    if ocean is None:
+        ocean = step4_ocean()
+    ocean, monthlies = ocean
+    return land, ocean, monthlies
+
+
+def step4_ocean():
+    """Read the ocean data for Step 4.  Returns a pair: the ocean
+    subboxes (a `SubboxReader`, which yields the metadata first) and
+    the SST monthlies (see `step4_load_sst_monthlies`)."""
+
     ocean_file = find_ocean_file()
     ocean = SubboxReader(open(ocean_file, 'rb'))
     ocean.meta.ocean_source = parameters.ocean_source
@@ -1037,7 +1458,7 @@ def step4_input(land):
     end_month = int(m.group(1))
     end_year = int(m.group(2))
     monthlies = step4_load_sst_monthlies(end_year, end_month)
-    return land, ocean, monthlies
+    return ocean, monthlies
 
 
 def step4_output(data):
@@ -1045,22 +1466,21 @@ def step4_output(data):
     # We only want to write the records from the right-hand item (the
     # ocean data).  The left-hand items are land data, already written
     # by Step 3.
-    out = SubboxWriter(RESULT_DIR + "SBBX.SST")
+    out = BackgroundWriter(SubboxWriter(settings.workspace.result_dir + "SBBX.SST"))
     for land, ocean in data:
-        out.write(ocean)
+        out.write(snapshot(ocean))
         yield land, ocean
-    np.savez_compressed(out.file, *out.result, meta=out.meta)
     print("Step4: closing output file")
     out.close()
-    progress = open(PROGRESS_DIR + 'progress.txt', 'a')
+    progress = open(settings.workspace.progress_dir + 'progress.txt', 'a')
     progress.write("\nStep4: closing output file\n")
 
 
 def step5_input(data):
     if not data:
-        land = SubboxReaderNpz(STEP3_OUT)
+        land = SubboxReaderNpz(step3_out())
         try:
-            ocean = SubboxReaderNpz(RESULT_DIR + 'SBBX.SST')
+            ocean = SubboxReaderNpz(settings.workspace.result_dir + 'SBBX.SST')
             ocean.meta.ocean_source = parameters.ocean_source
         except IOError:
             data = ensure_landocean(iter(land))
@@ -1149,23 +1569,22 @@ def step5_bx_output(meta, data):
     title = meta.title
     # Usually one of 'land', 'ocean', 'mixed'.
     mode = meta.mode
-    result = []
-    boxf = open(os.path.join(RESULT_DIR, make_filename(meta, 'BX') + '.npz'), 'wb')
+    name = os.path.join(settings.workspace.result_dir,
+                        make_filename(meta, 'BX') + '.npz')
     info = info_from_meta(meta)
     info.append(title)
     info = np.array(info, dtype=object)
+    out = BackgroundWriter(BoxWriter(name, info))
 
     for record in data:
         avgr, wtr, ngood, box = record
-        rec = [np.asarray(avgr), np.asarray(wtr), [ngood, box]]
-        result.append(rec)
+        out.write((np.array(avgr), np.array(wtr), ngood, box))
         yield record
 
-    np.savez_compressed(boxf, *result, meta=info)
-    print("Step 5: Closing box file:", boxf.name)
-    boxf.close()
-    progress = open(PROGRESS_DIR + 'progress.txt', 'a')
-    progress.write("\nStep 5: Closing box file:" + boxf.name + '\n')
+    print("Step 5: Closing box file:", name)
+    out.close()
+    progress = open(settings.workspace.progress_dir + 'progress.txt', 'a')
+    progress.write("\nStep 5: Closing box file:" + name + '\n')
 
 
 def make_filename(meta, kind):
@@ -1227,7 +1646,7 @@ def step5_mask_output(data):
     # metadata
     yield next(data)
 
-    out = open(os.path.join(WORK_DIR, 'step5mask'), 'w')
+    out = open(os.path.join(settings.workspace.work_dir, 'step5mask'), 'w')
 
     for datum in data:
         mask, land, ocean = datum
@@ -1285,47 +1704,23 @@ def step5_output(results):
     """Generate final Step 5 output files.  *results* is a sequence of
     tuples, each tuples corresponding to the zonal results for
     an entire analysis (typically 3 analyses: land, ocean, mixed).  The
-    contents of the tuple itself are a bit baroque, see `annzon` for
+    contents of the tuple itself are a bit baroque, see `step5.annzon_array` for
     details.
+
+    Analyses whose files have already been written (by a Step 5
+    worker process, see `step5.run_analyses`) are skipped.  The CSV
+    versions of the tables are written alongside the text files by
+    `step5_output_one`.  In a regional analysis (see steps/region.py)
+    there are no zonal results, and each item is None.
     """
     for item in results:
-        step5_output_one(item)
-    to_csv(['mixedGLB.Ts.ERSSTV5.GHCN.CL.PA.txt', 'mixedNH.Ts.ERSSTV5.GHCN.CL.PA.txt',
-            'mixedSH.Ts.ERSSTV5.GHCN.CL.PA.txt', 'mixedZonAnn.Ts.ERSSTV5.GHCN.CL.PA.txt',
-            'landGLB.Ts.GHCN.CL.PA.txt', 'landNH.Ts.GHCN.CL.PA.txt', 'landSH.Ts.GHCN.CL.PA.txt',
-            'landZonAnn.Ts.GHCN.CL.PA.txt'])
+        if item is None:
+            continue
+        if not getattr(item[0], 'output_written', False):
+            step5_output_one(item)
     return "Step 5 Completed"
 
 
-def to_csv(filenames=''):
-    for filename in filenames:
-        create_csv(RESULT_DIR + filename)
-
-
-def create_csv(dir_name, txt_title=""):
-    if "/graph.txt" in dir_name:
-        file = open(dir_name.replace('/graph.txt', '/graph.csv'), 'w')
-    else:
-        file = open(dir_name.replace('.txt', '.csv'), 'w')
-    wr = csv.writer(file, lineterminator='\n')
-    if txt_title == "":
-        txt_title = set_display_name(dir_name.split('/')[-1][:-4])
-    wr.writerow([txt_title])
-    for line in open(dir_name).readlines():
-        if re.match(r'\d{4}', line) or line[:4] == "Year" or line[:4] == "Year":
-            csv_line = line.split()
-            if "|" in csv_line:
-                csv_line.remove("|")
-            if csv_line == ['Year', 'Glob', 'NHem', 'SHem', '-90N', '-24N', '-24S', '-90N', '-64N', '-44N', '-24N',
-                            '-EQU', '-24S', '-44S', '-64S']:
-                file.seek(0)
-                csv_line = ['Year', 'Glob', 'NHem', 'SHem', '24N-90N', '24S-24N', '90S-24S', '64N-90N', '44N-64N',
-                            '24N-44N', 'EQU-24N', '24S-EQU', '44S-24S', '64S-44S', '90S-64S']
-            if len(csv_line) == 16:
-                csv_line = csv_line[:-1]
-            wr.writerow(csv_line)
-
-
 def set_display_name(filename):
     display_names = {"landGLB.Ts.GHCN.CL.PA": "Station: Global Means",
                      "landNH.Ts.GHCN.CL.PA": "Station: Northern Hemispheric Means",
@@ -1342,6 +1737,99 @@ def set_display_name(filename):
         return ""
 
 
+def hundredths_as_text(x, width, overflow):
+    """Format the array *x*, in hundredths of a degree, as strings like
+    '-1.25', '-.05', or '.50', right justified to (at least) *width*
+    characters.  Values that do not fit into a '%5d' field (which
+    includes the missing value 999900) are replaced with *overflow*.
+    """
+
+    x = np.asarray(x).astype(np.int64)
+    a = np.abs(x)
+    whole = a // 100
+    s = np.char.add(np.where(x < 0, '-', ''),
+                    np.where(whole > 0, whole.astype(str), ''))
+    s = np.char.add(s, np.char.add('.', np.char.zfill((a % 100).astype(str), 2)))
+    # np.char.rjust truncates strings that are already wider.
+    s = np.where(np.char.str_len(s) < width, np.char.rjust(s, width), s)
+    return np.where((x > 99999) | (x < -9999), overflow, s)
+
+
+def step5_zonann_rows(ann, iord, iyrbeg, iy1, iy2):
+    """Return the rows (as lines of text) of the annual zonal means
+    table for the years with index *iy1* to *iy2* (exclusive).  *iord*
+    gives the zones in column order.
+    """
+
+    ann = np.asarray(ann, dtype=float)[iord, iy1:iy2]
+    cells = hundredths_as_text(np.floor(100 * ann + 0.5), 5, '*****')
+    formatting = '%4d' + ' %s' * 3 + '  ' + ' %s' * 3 + '  ' + ' %s' * 8
+    return [formatting % ((iyrbeg + iy1 + i,) + tuple(row))
+            for i, row in enumerate(cells.T)]
+
+
+def step5_monthly_rows(zdata, zann, iyrbeg, iy1, iy2):
+    """Return the rows (as lines of text) of the monthly table (GLB, NH,
+    SH) for a single zone, for the years with index *iy1* to *iy2*
+    (exclusive).  *zdata* is the monthly data for the zone, *zann* its
+    annual anomalies.
+
+    Each year is a row of 18 numbers: 12 months, 2 different annual
+    anomalies, and 4 seasonal.
+    """
+
+    XBAD = 9999
+    zdata = np.asarray(zdata, dtype=float)[:iy2]
+    zann = np.asarray(zann, dtype=float)[:iy2]
+    row = np.full((len(zdata), 18), 100 * XBAD, dtype=np.int64)
+
+    # 4 seasons.
+    season = np.full((len(zdata), 4), float(XBAD))
+    season[1:, 0] = zdata[:-1, 11] + zdata[1:, 0] + zdata[1:, 1]
+    for s in range(1, 4):
+        season[:, s] = zdata[:, s * 3 - 1] + zdata[:, s * 3] + zdata[:, s * 3 + 1]
+    # Each season slots into slots 14 to 17 of *row*.
+    ok = season < 8000
+    row[:, 14:][ok] = np.rint(100.0 * season / 3)[ok]
+    # Meteorological Year is average of 4 seasons.
+    metann = season[:, 0] + season[:, 1] + season[:, 2] + season[:, 3]
+    ok = metann < 8000
+    row[ok, 13] = np.rint(100.0 * metann / 12)[ok]
+    # Calendar year as previously computed.  For final year of data,
+    # suppress annual anomaly value unless December is present
+    # (assuming a full year of data?).
+    calann = zann.copy()
+    if len(zdata) and zdata[-1, -1] > 8000:
+        calann[-1] = XBAD
+    ok = calann < 8000
+    row[ok, 12] = np.rint(100.0 * zann)[ok]
+    # Fill in the months.
+    row[:, :12] = np.rint(100.0 * zdata)
+
+    cells = hundredths_as_text(row[iy1:], 6, '   ***')
+    formatting = '%4d ' + '%s' * 12 + '  %s%s  ' + '%s' * 4
+    return [formatting % ((iyrbeg + iy1 + i,) + tuple(r))
+            for i, r in enumerate(cells)]
+
+
+def csv_fields(line):
+    """Split a row of a Step 5 text table into CSV fields."""
+
+    fields = line.split()
+    if len(fields) == 16:
+        fields = fields[:-1]
+    return fields
+
+
+def step5_csv_output(name, rows):
+    """Write *rows* to the CSV companion of the Step 5 text table
+    *name*.
+    """
+
+    with open(os.path.join(settings.workspace.result_dir, name.replace('.txt', '.csv')), 'w') as f:
+        csv.writer(f, lineterminator='\n').writerows(rows)
+
+
 def step5_output_one(item):
     (meta, data, wt, ann, monmin) = item
     title = meta.title
@@ -1351,7 +1839,6 @@ def step5_output_one(item):
     except:
         pass
 
-    XBAD = 9999
     iy1tab = 1880
     zone_titles = step5_zone_titles()
     months_data = meta.months_data
@@ -1371,7 +1858,10 @@ def step5_output_one(item):
     monm = iyrs * 12
 
     mode = meta.mode
+    names = [make_text_filename(meta, mode, part)
+             for part in ['ZonAnn', 'GLB', 'NH', 'SH']]
     out = open_step5_outputs(meta, mode)
+    tainted = False
     if mode == 'mixed':
         # Check that land and ocean have same range, otherwise, divert
         # output.
@@ -1379,7 +1869,10 @@ def step5_output_one(item):
             # Send output to a set of files starting with "tainted".
             # Note that the original, "mixed", files will have been
             # truncated: This stops anyone using their contents.
+            for f in out:
+                f.close()
             out = open_step5_outputs(meta, 'tainted')
+            tainted = True
 
     # Create and write out the header record of the output files.
     # Remove everything up to the first ')' of the title.
@@ -1398,137 +1891,65 @@ def step5_output_one(item):
              sources + ' ' * 20 + \
              'using elimination of outliers and homogeneity adjustment\n' + ' ' * 25 + \
              'Note: ***** = missing - base period: 1951-1980\n'
-    print(header, file=out[0])
     # iord literal borrowed exactly from Fortran...
     iord = [16, 14, 15, 9, 10, 11, 1, 2, 3, 4, 5, 6, 7, 8]
     # ... and then adjusted for Python index convention.
     iord = list(map(lambda x: x - 1, iord))
 
-    # Display the annual means.
-
-    def annasstr(z):
-        """Helper function that returns the annual anomaly for zone *z*
-        as a string representation of an integer (the integer is the
-        anomaly scaled by 100 to convert to centikelvin).
-
-        The returned value is a string that is 5 characters long.  If
-        the integer will not fit into a 5 character string, '*****' is
-        returned (this emulates the Fortran convention of formatting
-        999900 (which is the XBAD value in centikelvin) as a '*****'.
-
-        The year, *iy*, is lexically captured which is a bit horrible.
-        """
-        x = int(math.floor(100 * ann[z][iy] + 0.5))
-        x = '%5d' % x
-        if len(x) > 5:
-            return '*****'
-        return x
-
+    # Display the annual means.  Values are scaled by 100 to convert to
+    # centikelvin, and those that do not fit into 5 characters are
+    # shown as '*****' (this emulates the Fortran convention of
+    # formatting 999900, the XBAD value in centikelvin).
     banner = """
                            24N   24S   90S     64N   44N   24N   EQU   24S   44S   64S   90S
 Year  Glob  NHem  SHem    -90N  -24N  -24S    -90N  -64N  -44N  -24N  -EQU  -24S  -44S  -64S
 """.strip('\n')
-    print(banner, file=out[0])
-    for iy in range(iy1tab - iyrbeg, iyrsp):
-        iyr = iyrbeg + iy
-        row_data = [annasstr(zone) for zone in iord]
-        row_data = [str(int(x) / 100) if "*" not in x else x for x in row_data]
-        row_data = ["-" + x[2:] if x[:2] == "-0" else x for x in row_data]
-        row_data = [x[1:] if x[0] == "0" else x for x in row_data]
-        for i in range(len(row_data)):
-            if str(row_data[i])[-2] == '.':
-                row_data[i] = (str(row_data[i]) + "0").rjust(5)
-            else:
-                row_data[i] = str(row_data[i]).rjust(5)
-
-        formatting = '%4d' + ' %s' * 3 + '  ' + ' %s' * 3 + '  ' + ' %s' * 8
-        values = tuple([iyr] + row_data)
-        print(formatting % values, file=out[0])
-    # The trailing banner is just like the repeated banner, except that
-    # "Year  Glob  NHem  SHem" appears on on the first line, not the
-    # second line (and the same for the "Year" that appears at the end
-    # of the line).  *sigh*.
-    banner = banner.split('\n')
-
-    banner[0] = banner[1][:24] + banner[0][24:] + ' Year'
-    banner[1] = ' ' * 24 + banner[1][24:-5]
-    banner = '\n'.join(banner)
+    rows = step5_zonann_rows(ann, iord, iyrbeg, iy1tab - iyrbeg, iyrsp)
+    tables = [(header, banner, rows)]
+    # The CSV version has the zone boundaries in its column names and
+    # no title.
+    csv_tables = [[['Year', 'Glob', 'NHem', 'SHem', '24N-90N', '24S-24N',
+                    '90S-24S', '64N-90N', '44N-64N', '24N-44N', 'EQU-24N',
+                    '24S-EQU', '44S-24S', '64S-44S', '90S-64S']] +
+                  [csv_fields(row) for row in rows]]
 
     tit = ['GLOBAL', 'N.HEMISPH.', 'S.HEMISPH.']
-    # Shift the remaining 3 output files so that the indexing works out.
-    out = out[1:]
     banner = 'Year    Jan   Feb   Mar   Apr   May   Jun   Jul   Aug   Sep   Oct   Nov   Dec     J-D   D-N     DJF   MAM   JJA   SON'
     # All the "WRITE(96+J" stuff in the Fortran is replaced with this
-    # enumeration into the *out* array (an array of file descriptors).
-    for j, outf in enumerate(out):
+    # enumeration into the remaining 3 output files.
+    for j, name in enumerate(names[1:]):
         header = ' ' * 18 + tit[j] + ' ' + data_category + \
                  ' Temperature Index in degrees Celsius   base period: 1951-1980\n\n' + \
                  ' ' * 30 + sources + \
                  ' ' * 30 + 'using elimination of outliers and homogeneity adjustment\n' + \
                  ' ' * 30 + 'Notes: 1950 DJF = Dec 1949 - Feb 1950 ;  ***** = missing\n\n' + \
                  ' ' * 83 + 'AnnMean'
+        rows = step5_monthly_rows(data[iord[j]], ann[iord[j]], iyrbeg,
+                                  iy1tab - iyrbeg, iyrs)
+        tables.append((header, banner, rows))
+        csv_tables.append([[set_display_name(name[:-4])], banner.split()] +
+                          [csv_fields(row) for row in rows])
+
+    for outf, (header, banner, rows) in zip(out, tables):
         print(header, file=outf)
         print(banner, file=outf)
-        for iy in range(iy1tab - iyrbeg, iyrs):
-            # Each year is formatted as a row of 18 numbers (12 months,
-            # 2 different annual anomalies, and 4 seasonal).
-            row = [100 * XBAD] * 18
-
-            # *data* for this zone, avoids some duplication of code.
-
-            zdata = data[iord[j]]
-
-            # 4 seasons.
-            season = [9999] * 4
-            if iy > 0:
-                season[0] = zdata[iy - 1][11] + zdata[iy][0] + zdata[iy][1]
-            for s in range(1, 4):
-                season[s] = sum(zdata[iy][s * 3 - 1:s * 3 + 2])
-            # Each season slots into slots 14 to 17 of *row*.
-            for s, x in enumerate(season):
-                if x < 8000:
-                    row[14 + s] = int(round(100.0 * x / 3))
-            # Meteorological Year is average of 4 seasons.
-            metann = sum(season)
-            if metann < 8000:
-                row[13] = int(round(100.0 * metann / 12))
-            # Calendar year as previously computed.
-            calann = ann[iord[j]][iy]
-
-            # For final year of data, suppress annual anomaly value unless
-            # December is present (assuming a full year of data?).
-            if iy == iyrs - 1 and zdata[iy][-1] > 8000:
-                calann = 9999
-
-            if calann < 8000:
-                row[12] = int(round(100.0 * ann[iord[j]][iy]))
-            # Fill in the months.
-            for m in range(12):
-                row[m] = int(round(100.0 * zdata[iy][m]))
-
-            # Convert each of *row* to a string, storing the results in
-            # *sout*.
-            formatted_row = [None] * len(row)
-            for i, x in enumerate(row):
-                x = '%5d' % x
-                if len(x) > 5:
-                    x = '  ***'
-                formatted_row[i] = x
-            year = iyrbeg + iy
-
-            formatted_row = [str(int(x) / 100) if "*" not in x else x for x in formatted_row]
-            formatted_row = ["-" + x[2:] if x[:2] == "-0" else x for x in formatted_row]
-            formatted_row = [x[1:] if x[0] == "0" else x for x in formatted_row]
-            for i in range(len(formatted_row)):
-                if str(formatted_row[i])[-2] == '.':
-                    formatted_row[i] = (str(formatted_row[i]) + "0").rjust(6)
-                else:
-                    formatted_row[i] = str(formatted_row[i]).rjust(6)
-            print(('%4d ' + '%s' * 12 + '  %s%s  ' + '%s' * 4) % tuple([year] + formatted_row),
-                  file=outf)
+        for row in rows:
+            print(row, file=outf)
+        outf.close()
+
+    # CSV versions of the tables, for those analyses that have a
+    # display name.  A diverted ("tainted") analysis leaves only the
+    # title in the CSV.
+    for name, rows in zip(names, csv_tables):
+        display_name = set_display_name(name[:-4])
+        if display_name:
+            if tainted:
+                rows = [[display_name]]
+            step5_csv_output(name, rows)
 
     # Save monthly means on disk.
-    zono = open(os.path.join(RESULT_DIR, make_filename(meta, 'ZON') + '.npz'), 'wb')
+    zono = open(os.path.join(settings.workspace.result_dir,
+                             make_filename(meta, 'ZON') + '.npz'), 'wb')
     result = []
 
     titl2 = titl2.encode()
@@ -1540,6 +1961,7 @@ Year  Glob  NHem  SHem    -90N  -24N  -24S    -90N  -64N  -44N  -24N  -EQU  -24S
         result.append([[zone_titles[jz].encode()], np.array(data[jz]).ravel()])
     np.savez_compressed(zono, *result, meta=meta_data)
     zono.close()
+    meta.output_written = True
 
 
 def open_step5_outputs(meta, mode):
@@ -1552,6 +1974,6 @@ def open_step5_outputs(meta, mode):
 
     parts = ['ZonAnn', 'GLB', 'NH', 'SH']
     files = [
-        open(os.path.join(RESULT_DIR, make_text_filename(meta, mode, part)), 'w')
+        open(os.path.join(settings.workspace.result_dir, make_text_filename(meta, mode, part)), 'w')
         for part in parts]
     return files
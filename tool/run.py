@@ -12,6 +12,26 @@ Options:
                   numbers from 0 to 5.  For example, --steps=2,3,5
                   The steps are run in the order you specify.
                   If this option is omitted, run all steps in order.
+   --fuse         Run Steps 1 and 2 as one pass over the records; the
+                  Step 1 work file is then only written with --work-files.
+   --batches      Pass the station records between Steps 0 to 3 as column
+                  arrays (giss_data.StationBatch) rather than one by one.
+   --workspace=DIR
+                  Write the work, result, log, and progress files under
+                  DIR instead of tmp/, so that several runs (say, with
+                  different parameters) can be made at once.
+   --input=DIR    Read the input files from DIR (by default, the input
+                  directory of the workspace).
+   --resume       Resume a run that died in (or after) Step 2 or Step 3,
+                  from its last checkpoint; the steps before are not
+                  run again.  See tool/checkpoint.py.
+   --no-checkpoints
+                  Do not save checkpoints in Steps 2 and 3.
+   --append       Run only the steps that the changes to the input files
+                  (and parameters) since the last run with --append
+                  need: none, Steps 4 and 5 (when only the ocean data
+                  has changed), or all of them; the path taken is
+                  logged.  See tool/append.py.
 """
 
 # http://www.python.org/doc/2.4.4/lib/module-os.html
@@ -21,22 +41,15 @@ import re
 # http://www.python.org/doc/2.4.4/lib/module-sys.html
 import sys
 
-try:
-    rootdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-    if os.getcwd() != rootdir:
-        print("The GISTEMP procedure must be run from the root "
-              "directory of the project.\nPlease change directory "
-              "to %s and try again." % rootdir)
-        sys.exit()
-except:
-    sys.exit()
-
-sys.path.append(os.getcwd())
+rootdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(rootdir)
 
 from settings import *
+import settings
 
 # Clear Climate Code
-import gio
+from tool import append, checkpoint, gio
+from steps.giss_data import StationBatch
 
 
 class Fatal(Exception):
@@ -51,7 +64,7 @@ logfile = sys.stdout
 
 def log(msg):
     print(msg, file=logfile)
-    progress = open(PROGRESS_DIR + 'progress.txt', 'a')
+    progress = open(settings.workspace.progress_dir + 'progress.txt', 'a')
     progress.write(msg + '\n\n')
     progress.flush()
 
@@ -69,40 +82,90 @@ def mkdir(path):
 # are iterators, either produced from the previous step, or an iterator
 # that feeds from a file.
 
-def run_step0(data):
+# When *batches* is True, Steps 0 to 2 produce a giss_data.StationBatch
+# (instead of an iterator of records), and Steps 1 to 3 read their input
+# files as one.
+
+def run_step0(data, batches=False):
     from steps import step0
     if data is None:
         data = gio.step0_input()
     result = step0.step0(data)
+    if batches:
+        result = StationBatch.from_series(result)
     return gio.step0_output(result)
 
 
-def run_step1(data):
+def run_step1(data, batches=False):
     from steps import step1
     from extension import step1 as estep1
 
     if data is None:
-        data = gio.step1_input()
+        data = gio.step1_input(batch=batches)
     pre = estep1.pre_step1(data)
     result = step1.step1(pre)
     post = estep1.post_step1(result)
     return gio.step1_output(post)
 
 
-def run_step2(data):
+def run_step2(data, batches=False):
     from steps import step2
 
     if data is None:
-        data = gio.step2_input()
+        data = gio.step2_input(batch=batches)
     result = step2.step2(data)
+    if batches:
+        result = StationBatch.from_series(result)
+    return gio.step2_output(result)
+
+
+def run_step1_2(data, save_work=None, batches=False):
+    """Steps 1 and 2, with the record by record filters of both steps
+    (Step 1's drop_strange and Step 2's drop_short_records) fused into
+    a single pass over the records.  The Step 1 work file is only
+    written when *save_work* is True.
+    """
+    from steps import step1, step2, read_config
+    from steps.giss_data import BASE_YEAR
+    from extension import step1 as estep1
+
+    if data is None:
+        data = gio.step1_input(batch=batches)
+    pre = estep1.pre_step1(data)
+    if isinstance(pre, StationBatch):
+        # The filters for a batch each work on all the records at once.
+        result = step1.step1(pre)
+        if save_work is True:
+            result = gio.step1_output(result)
+        result = step2.step2(estep1.post_step1(result))
+        if batches:
+            result = StationBatch.from_series(result)
+        return gio.step2_output(result)
+    changes_index = read_config.get_changes_index()
+
+    def filtered(records):
+        out = save_work is True and gio.work_file_writer(1)
+        for record in records:
+            if not step1.remove_strange(record, changes_index):
+                continue
+            assert record.first_year == BASE_YEAR
+            if out:
+                out.write(gio.snapshot(record))
+            if step2.long_enough(record):
+                yield record
+        if out:
+            gio.close_work_file(1, out)
+
+    post = estep1.post_step1(filtered(pre))
+    result = step2.urban_adjustments(step2.near_region(post))
     return gio.step2_output(result)
 
 
-def run_step3(data):
+def run_step3(data, batches=False):
     from steps import step3
 
     if data is None:
-        data = gio.step3_input()
+        data = gio.step3_input(batch=batches)
     result = step3.step3(data)
     return gio.step3_output(result)
 
@@ -135,6 +198,39 @@ def run_step5(data):
     return gio.step5_output(result)
 
 
+def step_functions(batches=False):
+    """Return a dict mapping the name of each step (as for the --steps
+    option) to the function that runs it."""
+    return {
+        '0': lambda data: run_step0(data, batches),
+        '1': lambda data: run_step1(data, batches),
+        '2': lambda data: run_step2(data, batches),
+        '3': lambda data: run_step3(data, batches),
+        '3c': run_step3c,
+        '4': run_step4,
+        '5': run_step5,
+    }
+
+
+def run_steps(step_list, step_fn, data=None):
+    """Run the steps named in *step_list*, in order, using the functions
+    in *step_fn* (see `step_functions`): the output of each step is the
+    input of the next.  *data* is the input of the first step (None to
+    read it from the files of the previous step).  Returns when all the
+    output files have been written."""
+
+    for step in step_list:
+        data = step_fn[step](data)
+    # Consume the data in whatever the last step was, in order to
+    # write its output, and hence suck data through the whole
+    # pipeline.  (A batch has been written already.)
+    if not isinstance(data, StationBatch):
+        for _ in data:
+            pass
+    # Wait for the output files to be written.
+    gio.wait_for_output()
+
+
 def parse_steps(steps):
     """Parse the -s, steps, option.  Produces a list of strings."""
     steps = steps.strip()
@@ -169,12 +265,37 @@ def parse_options(arglist):
 
     parser.add_option("-s", "--steps", action="store", metavar="S[,S]", default="", help="Select range of steps to run")
     parser.add_option('-p', '--parameter', action='append', help="Redefine parameter from parameters/*.py during run")
-    parser.add_option("--no-work_files", "--suppress-work-files", action="store_false", default=True, dest="save_work",
+    parser.add_option("--no-work_files", "--suppress-work-files", action="store_false", default=None, dest="save_work",
                       help="Do not save intermediate files in the work sub-directory")
+    parser.add_option("--work-files", action="store_true", dest="save_work",
+                      help="Save intermediate files in the work sub-directory, "
+                           "including those that --fuse would skip")
+    parser.add_option("--fuse", action="store_true", default=False,
+                      help="Run the record filters of Steps 1 and 2 in a single "
+                           "pass, without writing the Step 1 work file")
+    parser.add_option("--batches", action="store_true", default=False,
+                      help="Pass the station records between Steps 0 to 3 as "
+                           "column arrays (giss_data.StationBatch)")
+    parser.add_option("--workspace", action="store", metavar="DIR",
+                      help="Write the work, result, log, and progress files "
+                           "under DIR (instead of tmp/)")
+    parser.add_option("--input", action="store", metavar="DIR",
+                      help="Read the input files from DIR")
+    parser.add_option("--resume", action="store_true", default=False,
+                      help="Resume an interrupted run from its last checkpoint")
+    parser.add_option("--no-checkpoints", action="store_false", default=True,
+                      dest="checkpoints",
+                      help="Do not save checkpoints in Steps 2 and 3")
+    parser.add_option("--append", action="store_true", default=False,
+                      help="Run only the steps that the changes to the "
+                           "input files since the last --append run need")
 
     options, args = parser.parse_args(arglist)
     if len(args) != 0:
         parser.error("Unexpected arguments")
+    if options.append and (options.steps or options.resume):
+        parser.error("--append chooses the steps itself; it can't be "
+                     "used with --steps or --resume")
 
     options.steps = parse_steps(options.steps)
 
@@ -236,29 +357,28 @@ def main(argv=None):
 
     step_list = list(options.steps)
 
+    if options.workspace or options.input:
+        settings.use_workspace(settings.Workspace(options.workspace or TMP_DIR,
+                                                  options.input))
+    workspace = settings.workspace
+
     # overwrite progress popup
-    if not os.path.exists(PROGRESS_DIR):
-        os.makedirs(PROGRESS_DIR)
-    progress = open(PROGRESS_DIR + "progress.txt", 'w')
+    if not os.path.exists(workspace.progress_dir):
+        os.makedirs(workspace.progress_dir)
+    progress = open(workspace.progress_dir + "progress.txt", 'w')
     progress.write("Setting up parameters...\n\n")
 
     # Create all the temporary directories we're going to use.
-    for d in ['log', 'result', 'work', "input"]:
-        mkdir(TMP_DIR + '/' + d)
+    for d in [workspace.log_dir, workspace.result_dir, workspace.work_dir,
+              workspace.input_dir]:
+        mkdir(d)
 
     # delete files in /tmp/input to re-download the input data files
     # otherwise the files in /tmp/input will be used.
     dl_input_files()
 
-    step_fn = {
-        '0': run_step0,
-        '1': run_step1,
-        '2': run_step2,
-        '3': run_step3,
-        '3c': run_step3c,
-        '4': run_step4,
-        '5': run_step5,
-    }
+    batches = options.batches
+    step_fn = step_functions(batches)
 
     # Record start time now, and ending times for each step.
     start_time = time.time()
@@ -267,6 +387,34 @@ def main(argv=None):
     if cannot:
         raise Fatal("Can't run steps %s" % str(cannot))
 
+    data = None
+    if options.resume:
+        step = checkpoint.resume(step_list)
+        if step is None:
+            log("No checkpoint to resume from; starting again")
+        else:
+            log("Resuming at Step %s, from its checkpoints" % step)
+            step_list = step_list[step_list.index(step):]
+            # The input of the step is taken from its checkpoints.
+            data = iter(())
+    elif options.checkpoints:
+        checkpoint.start()
+    else:
+        checkpoint.clear()
+
+    if options.append:
+        path, reason = append.plan()
+        log("====> APPEND MODE: %s path; %s  ====" % (path, reason))
+        if path == 'none':
+            checkpoint.finish()
+            workspace.close()
+            return 0
+        if path == 'ocean':
+            # The Step 3 output is the one saved by the last run.
+            step_list = ['4', '5']
+            data = append.land()
+        step_fn['3'] = append.keeping_land(step_fn['3'])
+
     # Create a message for stdout.
     if len(step_list) == 1:
         logit = "STEP %s" % step_list[0]
@@ -278,15 +426,18 @@ def main(argv=None):
         else:
             logit = "STEPS %s" % ', '.join(step_list)
     log("====> %s  ====" % logit)
-    data = None
 
-    for step in step_list:
-        data = step_fn[step](data)
-    # Consume the data in whatever the last step was, in order to
-    # write its output, and hence suck data through the whole
-    # pipeline.
-    for _ in data:
-        pass
+    if options.fuse and '1' in step_list:
+        i = step_list.index('1')
+        if step_list[i + 1:i + 2] == ['2']:
+            step_list[i:i + 2] = ['1+2']
+            step_fn['1+2'] = lambda data: run_step1_2(data, options.save_work, batches)
+            log("Steps 1 and 2 fused")
+    run_steps(step_list, step_fn, data)
+    if options.append:
+        append.save()
+    checkpoint.finish()
+    workspace.close()
 
     end_time = time.time()
     log("====> Timing Summary ====")
@@ -0,0 +1,285 @@
+#!/usr/local/bin/python3.4
+#
+# sweep.py -- run the GISTEMP algorithm for a grid of parameter variants
+
+"""sweep.py [options] -- run the GISTEMP algorithm for a grid of
+parameter variants.
+Options:
+   --help         Print this text.
+   -p NAME=VALUE  Redefine a parameter, as for run.py.  A parameter
+                  given more than once is swept: each of its values
+                  makes a variant, and every combination of the values
+                  of the swept parameters is run.
+   --workspace=DIR
+                  Directory for the workspaces of the variants (by
+                  default tmp/sweep).  DIR/variants.txt lists the
+                  parameters of each variant, and the log, work, and
+                  result files of variant N are in DIR/variantN.
+   --input=DIR    Read the input files from DIR (by default, the usual
+                  input directory).
+   --processes=N  Run up to N workspaces at once (by default, the
+                  number of CPUs).
+
+The first step affected by each parameter is declared in
+parameters/dependencies.py.  The steps before the first step affected
+by a swept parameter are run once, in a shared workspace, for all the
+variants that have the same values of the parameters used by those
+steps.  The variants then continue from the output of those steps,
+each in a process of its own, forked from the process that made the
+output (so the output is not read from the work files, which do not
+hold it exactly).  The files of the shared workspace are copied to the
+workspace of each variant.
+"""
+
+import itertools
+import os
+import shutil
+import sys
+
+# run.py puts the root of the project on sys.path.
+import run
+import parameters
+from parameters.dependencies import first_step_of
+import settings
+from tool import gio
+
+
+class Node(object):
+    """A run of the steps *steps* (a list of step names, as for the
+    --steps option of run.py), with the parameters *params* (a list of
+    'NAME=VALUE' strings), in the workspace *path*.  Unless *parent*
+    is None, the run continues from the output of *parent* (another
+    `Node`), and its workspace starts with a copy of the files of
+    *parent*.  *variants* is the number of variants that use the
+    results of the run.
+    """
+
+    def __init__(self, path, steps, params, parent):
+        self.path = path
+        self.steps = steps
+        self.params = params
+        self.parent = parent
+        self.children = []
+        if parent is not None:
+            parent.children.append(self)
+        self.variants = 0
+
+
+def parse_options(arglist):
+    import optparse
+
+    usage = "usage: %prog [options]"
+    parser = optparse.OptionParser(usage)
+
+    parser.add_option('-p', '--parameter', action='append', default=[],
+                      help="Redefine parameter from parameters/*.py; "
+                           "give a parameter more than once to sweep it")
+    parser.add_option("--workspace", action="store", metavar="DIR",
+                      default=os.path.join(settings.TMP_DIR, 'sweep'),
+                      help="Directory for the workspaces of the variants")
+    parser.add_option("--input", action="store", metavar="DIR",
+                      help="Read the input files from DIR")
+    parser.add_option("--processes", action="store", type="int",
+                      default=os.cpu_count(),
+                      help="Number of workspaces to run at once")
+
+    options, args = parser.parse_args(arglist)
+    if len(args) != 0:
+        parser.error("Unexpected arguments")
+    return options, args
+
+
+def parse_grid(parm):
+    """Take the -p options and return a list of (name, values) pairs,
+    one for each parameter, in the order they are first given."""
+
+    grid = {}
+    for p in parm:
+        try:
+            key, value = p.split('=', 1)
+        except ValueError:
+            raise run.Fatal("Can't understand parameter option: %r" % p)
+        if not hasattr(parameters, key):
+            raise run.Fatal("Ignoring unknown parameter %r" % key)
+        values = grid.setdefault(key, [])
+        if value not in values:
+            values.append(value)
+    return list(grid.items())
+
+
+def plan(grid, directory):
+    """Make the `Node` instances for the parameters *grid* (see
+    `parse_grid`).  Returns a pair (*nodes*, *variants*): *nodes* is the
+    list of all the nodes, each after its parent; *variants* is a list
+    of (node, params) pairs, one for each variant, giving the last node
+    of the variant.
+    """
+
+    # The steps are split into segments at the first step of each
+    # swept parameter.  Every variant runs each segment with the swept
+    # parameters that are used by that segment, in a node shared with
+    # the other variants that have the same values for them.
+    # A parameter may be used by an earlier step when any variant is
+    # a regional analysis.
+    regions = dict(grid).get('analysis_region', [parameters.analysis_region])
+    regional = any(region.strip() for region in regions)
+
+    def first(name):
+        return first_step_of(name, regional)
+
+    fixed = ['%s=%s' % (name, values[0])
+             for name, values in grid if len(values) == 1]
+    swept = [(name, values) for name, values in grid if len(values) > 1]
+    starts = sorted(set([0] + [first(name) for name, _ in swept]))
+    segments = list(zip(starts, starts[1:] + [6]))
+
+    nodes = []
+    variants = []
+    shared = {}
+    for values in itertools.product(*[values for _, values in swept]):
+        params = ['%s=%s' % (name, value)
+                  for (name, _), value in zip(swept, values)]
+        node = None
+        for i, (start, stop) in enumerate(segments):
+            used = tuple(p for (name, _), p in zip(swept, params)
+                         if first(name) <= start)
+            key = (start, used)
+            if key not in shared:
+                if i == len(segments) - 1:
+                    path = 'variant%d' % (len(variants) + 1)
+                else:
+                    n = len([k for k in shared if k[0] == start])
+                    path = 'steps%d-%d.%d' % (start, stop - 1, n + 1)
+                shared[key] = Node(os.path.join(directory, path),
+                                   [str(s) for s in range(start, stop)],
+                                   fixed + list(used), node)
+                nodes.append(shared[key])
+            node = shared[key]
+            node.variants += 1
+        variants.append((node, fixed + params))
+    return nodes, variants
+
+
+def copy_workspace(source, dest):
+    """Copy the log, work, and result files of the workspace *source*
+    to the workspace *dest* (replacing any it has already)."""
+    for d in ['log', 'work', 'result']:
+        shutil.rmtree(os.path.join(dest.path, d), ignore_errors=True)
+        shutil.copytree(os.path.join(source.path, d),
+                        os.path.join(dest.path, d))
+
+
+def run_node(node, input_dir, data, slots, console):
+    """Run *node*, in a new workspace, on *data* (the output of its
+    parent node, or None).  Then run each of its children, each in a
+    forked process of its own (so that they all start from the output
+    of *node*, without it being written and read again).  At most one
+    node runs for each of the *slots* (a semaphore); progress messages
+    are written to *console*.  Exits with status 1 if *node*, or any of
+    the nodes after it, fails.
+    """
+
+    import traceback
+
+    with slots:
+        workspace = settings.Workspace(node.path, input_dir)
+        workspace.makedirs()
+        settings.use_workspace(workspace)
+        if node.parent is not None:
+            copy_workspace(node.parent, node)
+        # The output of the steps goes to a file in the workspace.
+        sys.stdout = run.logfile = open(os.path.join(node.path, 'output.txt'), 'w')
+        try:
+            run.update_parameters(node.params)
+            run.log("====> STEPS %s to %s  ====" % (node.steps[0], node.steps[-1]))
+            step_fn = run.step_functions()
+            if data is not None:
+                data = iter(data)
+            for step in node.steps:
+                data = step_fn[step](data)
+            if node.children:
+                data = list(data)
+            else:
+                for _ in data:
+                    pass
+            gio.wait_for_output()
+        except BaseException:
+            traceback.print_exc()
+            print("... steps %s to %s FAILED in %s, see %s" %
+                  (node.steps[0], node.steps[-1], node.path,
+                   sys.stdout.name), file=console)
+            sys.exit(1)
+        finally:
+            workspace.close()
+            sys.stdout.flush()
+        print("... steps %s to %s done in %s (used by %d variants)" %
+              (node.steps[0], node.steps[-1], node.path, node.variants),
+              file=console)
+        console.flush()
+
+    sys.exit(run_nodes(node.children, input_dir, data, slots, console))
+
+
+def run_nodes(nodes, input_dir, data, slots, console):
+    """Run each of *nodes* on *data*, each in a forked process of its
+    own (see `run_node`).  Returns 1 if any of them fail, 0 otherwise.
+    """
+
+    import multiprocessing
+
+    context = multiprocessing.get_context('fork')
+    processes = [context.Process(target=run_node,
+                                 args=(node, input_dir, data, slots, console))
+                 for node in nodes]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    return int(any(process.exitcode != 0 for process in processes))
+
+
+def main(argv=None):
+    import time
+
+    if argv is None:
+        argv = sys.argv
+    options, args = parse_options(argv[1:])
+
+    grid = parse_grid(options.parameter)
+    directory = os.path.abspath(options.workspace)
+    input_dir = options.input or settings.workspace.input_dir
+    # The workspace of the sweep itself is only used for the progress
+    # messages and the input directory.
+    settings.use_workspace(settings.Workspace(directory, input_dir))
+    os.makedirs(settings.workspace.progress_dir, exist_ok=True)
+    run.mkdir(settings.workspace.input_dir)
+
+    nodes, variants = plan(grid, directory)
+    with open(os.path.join(directory, 'variants.txt'), 'w') as f:
+        for node, params in variants:
+            f.write('%s %s\n' % (os.path.basename(node.path), ' '.join(params)))
+    run.log("====> SWEEP: %d variants, %d workspaces  ====" %
+            (len(variants), len(nodes)))
+
+    start_time = time.time()
+    run.dl_input_files()
+    # Prepare the inventory once, rather than in each workspace that
+    # runs Step 0.
+    from steps import step0
+    step0.prepare_inventory()
+
+    import multiprocessing
+    slots = multiprocessing.get_context('fork').BoundedSemaphore(
+        max(options.processes, 1))
+    roots = [node for node in nodes if node.parent is None]
+    sys.stdout.flush()
+    failed = run_nodes(roots, input_dir, None, slots, sys.stdout)
+
+    end_time = time.time()
+    run.log("====> Timing Summary ====")
+    run.log("Sweep took %.1f seconds" % (end_time - start_time))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())